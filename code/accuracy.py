@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+"""
+Accuracy against speed
+
+Functionality
+-------------
+- Generate pairs of recordings with known integer and
+  fractional delays and noise (see `synthetic.py`)
+- Estimate the lag of every pair with every configuration
+  (full in double or single precision, windowed, streamed,
+  pyramid, GCC weightings, and resampled to lower rates with
+  either engine first)
+- Record, for every estimate, the error against the true lag
+  (both the arg max, through `Analysis.correlation_lags()`,
+  and the interpolated lag of `Analysis.lag()`) and the time
+  it took
+- Print a table of every configuration's worst and RMS error
+  and mean time, marking the ones on the Pareto front (no
+  other configuration is both faster and more precise), and
+  the cheapest one within a precision budget
+- Flag every configuration whose worst error is over
+  `--max-error-samples`, and exit with a non-zero status if
+  there is any, so a regression doesn't go unnoticed
+
+Outputs
+-------
+- accuracy : JSON
+      Every estimate and the summary of every configuration,
+      stored in `./results/` as `accuracy_<timestamp>.json` (or
+      wherever `--output` says)
+
+Execution
+---------
+$ python ./code/accuracy.py
+$ python ./code/accuracy.py --precision-samples 0.1 --snr-db 10 0 -10
+$ python ./code/accuracy.py --configurations full pyramid phat \
+         --delays 0 12.5 -700.25 --seconds 60 --sample-rate 44100
+
+Notes
+-----
+- Errors are in samples at the native rate (`--sample-rate`),
+  also for configurations that resample first
+- A lag is `one[n + lag]` matching `two[n]`; the pairs are made
+  so that the true lag is the delay given (see `synthetic.py`)
+- Time is that of `correlation()` and `lag()` (plus resampling
+  both signals, for the configurations that resample), not of
+  reading the files, which is the same for all of them
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import collections
+
+import numpy
+
+import synthetic
+
+#
+# Seconds of lag searched by the configurations that bound it,
+# enough for the default delays
+#
+MAX_LAG_SECONDS = 0.5
+
+#
+# Configurations: keyword arguments for `Analysis`, and
+# optionally a rate and engine to resample both signals to
+# before the analysis (rates are fractions of the native one)
+#
+CONFIGURATIONS = collections.OrderedDict([
+    ('full', {}),
+    ('full_float32', {'precision': 'float32'}),
+    ('normalized', {'normalized': True}),
+    ('windowed', {'max_lag_seconds': MAX_LAG_SECONDS}),
+    ('streamed', {'max_lag_seconds': MAX_LAG_SECONDS, 'block_size': 65536}),
+    ('pyramid', {'pyramid_fractions': [1 / 8.0]}),
+    ('pyramid_two_levels', {'pyramid_fractions': [1 / 16.0, 1 / 4.0]}),
+    ('phat', {'weighting': 'phat'}),
+    ('scot', {'weighting': 'scot'}),
+    ('roth', {'weighting': 'roth'}),
+    ('ht', {'weighting': 'ht'}),
+    ('resampled_fft', {'resample': (1 / 4.0, 'fft')}),
+    ('resampled_polyphase', {'resample': (1 / 4.0, 'polyphase')}),
+])
+
+DEFAULT_DELAYS = [0.0, 1.0, 37.0, -1234.0, 0.5, 100.25, -3.7]
+
+#
+# Worst error (in samples) above which a configuration is
+# flagged as failed. Every configuration stays within one
+# sample on the default cases (those that resample to a
+# quarter of the rate included), so anything past two is a
+# misplaced peak, not a matter of precision.
+#
+DEFAULT_MAX_ERROR_SAMPLES = 2.0
+
+
+def run(configurations, signals, delays, snrs_db, seconds, sample_rate,
+        seed=0):
+    """Run
+
+    Outputs
+    -------
+    - estimates : list of dict
+          One per pair and configuration, with the true lag
+          (`delay`), the estimates and their errors (in native
+          samples) and the time
+    """
+    import analysis
+    import downsampling
+    estimates = []
+    number_of_samples = int(seconds * sample_rate)
+    directory = tempfile.mkdtemp(prefix='accuracy_')
+    try:
+        for kind in signals:
+            data = synthetic.make_signal(
+                kind, number_of_samples, sample_rate, 1, seed
+            )[:, 0]
+            for delay in delays:
+                for snr_db in snrs_db:
+                    pair = synthetic.delayed_pair(data, delay, snr_db, seed)
+                    for name in configurations:
+                        estimate = _estimate(
+                            analysis, downsampling, directory, pair,
+                            sample_rate, CONFIGURATIONS[name]
+                        )
+                        estimate.update({
+                            'configuration': name,
+                            'signal': kind,
+                            'delay': delay,
+                            'snr_db': snr_db,
+                            'error': estimate['estimated_samples'] - delay,
+                            'arg_max_error': (
+                                estimate['arg_max_samples'] - delay
+                            ),
+                        })
+                        estimates.append(estimate)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return(estimates)
+
+
+def summarize(estimates):
+    """Summarize
+
+    Outputs
+    -------
+    - summary : list of dict
+          One per configuration, sorted by mean time, with the
+          worst (`max_error`) and RMS interpolated errors, the
+          worst arg max error, the mean time and whether it's on
+          the Pareto front of time and worst error
+    """
+    by_configuration = collections.OrderedDict()
+    for estimate in estimates:
+        by_configuration.setdefault(estimate['configuration'], []).append(
+            estimate
+        )
+    summary = []
+    for name, group in by_configuration.items():
+        errors = numpy.array([e['error'] for e in group])
+        summary.append({
+            'configuration': name,
+            'max_error': float(numpy.max(abs(errors))),
+            'rms_error': float(numpy.sqrt(numpy.mean(errors ** 2))),
+            'max_arg_max_error': float(max(
+                abs(e['arg_max_error']) for e in group
+            )),
+            'mean_seconds': float(numpy.mean([e['seconds'] for e in group])),
+        })
+    for row in summary:
+        row['pareto'] = not any(
+            other['mean_seconds'] <= row['mean_seconds'] and
+            other['max_error'] <= row['max_error'] and
+            (other['mean_seconds'] < row['mean_seconds'] or
+             other['max_error'] < row['max_error'])
+            for other in summary
+        )
+    return(sorted(summary, key=lambda row: row['mean_seconds']))
+
+
+def cheapest(summary, precision_samples):
+    """Cheapest
+
+    Fastest configuration whose worst error is within
+    `precision_samples`, or None.
+    """
+    within = [r for r in summary if r['max_error'] <= precision_samples]
+    if not within:
+        return(None)
+    return(min(within, key=lambda row: row['mean_seconds']))
+
+
+def failed(summary, max_error_samples):
+    """Failed
+
+    Configurations whose worst error is over `max_error_samples`.
+    """
+    return([r for r in summary if r['max_error'] > max_error_samples])
+
+
+def print_summary(summary, precision_samples):
+    width = max(len(row['configuration']) for row in summary)
+    print('*' * 70)
+    print('* Errors in samples (worst, RMS, worst arg max), mean time')
+    print('*' * 70)
+    for row in summary:
+        print('{} {:10.4f} {:10.4f} {:10.4f} {:9.4f}s {}'.format(
+            row['configuration'].ljust(width),
+            row['max_error'],
+            row['rms_error'],
+            row['max_arg_max_error'],
+            row['mean_seconds'],
+            'pareto' if row['pareto'] else ''
+        ))
+    print('*' * 70)
+    best = cheapest(summary, precision_samples)
+    if best is None:
+        print('No configuration is within {} samples'.format(
+            precision_samples
+        ))
+    else:
+        print('Cheapest within {} samples: {}'.format(
+            precision_samples, best['configuration']
+        ))
+    print('*' * 70)
+
+
+def _estimate(analysis, downsampling, directory, pair, sample_rate,
+              configuration):
+    configuration = dict(configuration)
+    resample = configuration.pop('resample', None)
+    pyramid_fractions = configuration.pop('pyramid_fractions', None)
+    if pyramid_fractions is not None:
+        configuration['pyramid_rates'] = [
+            int(sample_rate * fraction) for fraction in pyramid_fractions
+        ]
+    rate = sample_rate
+    start = time.perf_counter()
+    if resample is not None:
+        fraction, engine = resample
+        rate = int(sample_rate * fraction)
+        pair = [
+            downsampling.resample(data, sample_rate, rate, engine=engine)
+            for data in pair
+        ]
+    resampling_seconds = time.perf_counter() - start
+    files = [
+        os.path.join(directory, 'one.wav'),
+        os.path.join(directory, 'two.wav')
+    ]
+    for audio_file, data in zip(files, pair):
+        synthetic.write_wav(audio_file, data, rate, encoding='float32')
+    estimator = analysis.Analysis(files[0], files[1], **configuration)
+    start = time.perf_counter()
+    estimator.correlation()
+    lag = estimator.lag()
+    seconds = time.perf_counter() - start + resampling_seconds
+    arg_max_seconds = estimator.correlation_lags()[
+        int(numpy.argmax(abs(estimator.correlation)))
+    ] / float(rate)
+    return({
+        'estimated_seconds': lag.seconds,
+        'estimated_samples': lag.seconds * sample_rate,
+        'arg_max_samples': arg_max_seconds * sample_rate,
+        'seconds': seconds,
+    })
+
+
+def main(argv):
+
+    arguments = _parse_arguments(argv)
+
+    estimates = run(
+        arguments.configurations,
+        arguments.signals,
+        arguments.delays,
+        [None if snr == 'clean' else float(snr) for snr in arguments.snr_db],
+        arguments.seconds,
+        arguments.sample_rate,
+        arguments.seed
+    )
+    summary = summarize(estimates)
+    print_summary(summary, arguments.precision_samples)
+
+    output = arguments.output or (
+        "./results/accuracy_" + time.strftime('%Y%m%dT%H%M%S') + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as json_file:
+        json.dump({
+            'options': vars(arguments),
+            'summary': summary,
+            'estimates': estimates,
+        }, json_file, indent=2)
+    print("Saved: {}".format(output))
+
+    failures = failed(summary, arguments.max_error_samples)
+    for row in failures:
+        print("FAILED: {} (worst error of {:.4f} samples, over {})".format(
+            row['configuration'], row['max_error'],
+            arguments.max_error_samples
+        ))
+    if failures:
+        return(1)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Lag error against time of every configuration"
+    )
+    parser.add_argument(
+        '--configurations', nargs='+', choices=list(CONFIGURATIONS),
+        default=list(CONFIGURATIONS)
+    )
+    parser.add_argument(
+        '--signals', nargs='+', choices=synthetic.SIGNALS,
+        default=list(synthetic.SIGNALS)
+    )
+    parser.add_argument(
+        '--delays', type=float, nargs='+', default=DEFAULT_DELAYS,
+        help="True lags, in samples (fractional ones too)"
+    )
+    parser.add_argument(
+        '--snr-db', nargs='+', default=['clean', '10', '0'],
+        help="Signal to noise ratios in dB (`clean` for no noise)"
+    )
+    parser.add_argument(
+        '--seconds', type=float, default=10.0,
+        help="Length of the signals"
+    )
+    parser.add_argument('--sample-rate', type=int, default=8192)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--precision-samples', type=float, default=0.5,
+        help="Precision budget: worst error allowed, in samples"
+    )
+    parser.add_argument(
+        '--max-error-samples', type=float,
+        default=DEFAULT_MAX_ERROR_SAMPLES,
+        help="Fail (non-zero exit status) if any configuration's " +
+             "worst error is over this many samples"
+    )
+    parser.add_argument(
+        '--output', default=None,
+        help="JSON file to save the results to"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
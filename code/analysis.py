@@ -16,13 +16,19 @@ Inputs
 - audio_file_input_two : str
       Should point to a WAV file
 
+HDF5 files (`.h5` or `.hdf5`, as written by
+`hdf5_wav_translator.py`) are read directly, without
+translating them back to WAV first. When streaming, only
+the frames of each block are read from them.
+
 Outputs
 -------
 - correlation_graph : PNG
       A graph will be created everytime the `.graph()`
-      method is called and it will be be stored with
-      the name of the two filenames supplied concatenated
-      and appending "_correlation.png" at the end
+      method is called (with `--graph` from the terminal)
+      and it will be be stored with the name of the two
+      filenames supplied concatenated and appending
+      "_correlation.png" at the end
 
 Results are stored in the `./results/` directory
 
@@ -50,9 +56,107 @@ $ python ./code/analysis.py \
          ./audio/audio_file_one.wav \
          ./audio/audio_file_two.wav
 
+Add `--graph` to also graph the signals and the correlation.
+
+To keep memory bounded on long recordings, stream both
+files in blocks instead of loading them into memory:
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --block-size 65536
+
+If the two recordings are known to be at most a few seconds
+apart, only compute the lags within that window (this is much
+faster and, with `--block-size`, keeps memory bounded):
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --max-lag-seconds 5
+
+To get native-rate precision without a full-rate correlation
+(and without downsampling the files to `./results/` first),
+estimate the lag on resampled copies and refine it:
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --pyramid-rates 512 4096
+
+On reverberant recordings, a generalized cross-correlation
+weighting (`phat`, `scot`, `roth` or `ht`) sharpens the peak:
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --weighting phat
+
+Multi-channel files are correlated channel by channel (or
+every channel against every other one), with a lag reported
+for each pair of channels:
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_4ch_one.wav \
+         ./audio/audio_file_4ch_two.wav \
+         --channel-mode cross
+
+The in-memory correlation can run its FFTs in single
+precision, which takes about half the memory and time (the
+error is documented in `correlators.PRECISIONS`):
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --precision float32
+
+To compare peaks across files of any gain and length (e.g. to
+reject pairs that don't match with a fixed threshold), divide
+every lag by the energy of the overlapping parts:
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --normalized
+
+Repeated analyses of the same files can reuse their real
+FFTs (and the resampled copies of `--pyramid-rates`) from an
+on-disk cache, keyed by the content of the files:
+
+$ python ./code/analysis.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --cache-directory ./results/cache/
+
 Notes
 -----
-- Third and following arguments are ignored
+- With `--backend memmap`, uncompressed WAV files are memory
+  mapped instead of decoded: opening them is instant and only
+  the frames actually used are read from disk
+- Streaming (`--block-size`) produces the same correlation
+  as the default path, multi-channel files included (every
+  block is read once, with all of its channels, for all the
+  channel pairs), but memory still grows with the number of
+  lags computed (use `--max-lag-seconds` to bound it)
+- `--workers` sets how many threads the FFTs use (pyFFTW is
+  used if it's installed). Without pyFFTW, threads only help
+  transforms that can be split: multi-channel files and the
+  two signals of the default correlation
+- With `--normalized`, lags where the files overlap by less
+  than `correlators.NORMALIZED_MIN_OVERLAP` of the shorter one
+  are set to zero (with only a few frames overlapping, any two
+  signals are close to one). The energies come from cumulative
+  sums, so it costs a pass over the files, not one per lag
+- When both inputs are the same file (like the white noise
+  test below), it's only read once and the correlation is
+  computed as an autocorrelation: one real FFT and its power
+  spectrum instead of a real FFT per file
+- `Analysis.correlation_lags()` gives the lag of every value
+  of the correlation, whichever way it was computed
+- Graphs are only made with `--graph`. They draw the min/max
+  of every pixel column instead of every sample (see
+  `plotting.py`), so they take about the same time however
+  long the files are
 - Results are stored in the `./results/` directory
 - If you get the:
   `IOError: [Errno 2] No such file or directory: './results/...`
@@ -85,50 +189,291 @@ Author
 
 import os
 import sys
+import argparse
+import collections
 import numpy
-import scipy.signal
-import scikits.audiolab
-import matplotlib
-import matplotlib.pyplot
 
-matplotlib.use('agg')
+import audio_io
+import cache
+import correlators
+import downsampling
+import parallel
+import plotting
+
+#
+# Half-width of the search window at each pyramid level,
+# in samples of the previous (coarser) level.
+#
+PYRAMID_MARGIN = 4
+
+#
+# Result of `Analysis.lag()`:
+#
+# - samples : int
+#       Lag at the correlation peak, in samples
+# - sub_samples : float
+#       Lag refined by parabolic interpolation around the peak
+# - seconds : float
+#       `sub_samples` in seconds
+# - peak : float
+#       Correlation value at the peak (signed)
+# - normalized_peak : float
+#       Absolute peak divided by the square root of the
+#       energies of both signals (1.0 for identical signals),
+#       or by those of the parts that overlap at the peak
+#       with `normalized`. With a weighting, divided by the
+#       norm of the weighted cross spectrum instead (see
+#       `correlators.cross_spectrum_norm()`)
+#
+Lag = collections.namedtuple(
+    'Lag', ['samples', 'sub_samples', 'seconds', 'peak', 'normalized_peak']
+)
 
 
 class Analysis(object):
 
-    def __init__(self, audio_one, audio_two):
+    def __init__(self, audio_one, audio_two, block_size=None,
+                 max_lag_seconds=None, pyramid_rates=None, weighting=None,
+                 channel_mode=None, backend='sndfile', cache_directory=None,
+                 cache_max_bytes=cache.DEFAULT_CACHE_MAX_BYTES,
+                 precision='float64', workers=parallel.DEFAULT_WORKERS,
+                 normalized=False):
+        """Analysis
+
+        Inputs
+        ------
+        - audio_one : str
+        - audio_two : str
+        - block_size : int or None
+              If given, the audio data is not loaded into memory
+              and `.correlation()` streams both files in blocks of
+              this many frames (see `correlators.py`), all of the
+              channels at once for multi-channel files
+        - max_lag_seconds : float or None
+              If given, only lags within plus/minus this many
+              seconds are computed (instead of all of them)
+        - pyramid_rates : list of int or None
+              If given, the lag is first estimated on copies of the
+              data resampled to the lowest of these rates, and then
+              refined within a narrow window at each higher rate,
+              finishing at the native sample rate (see
+              `_pyramid_correlation()`)
+        - weighting : str or None
+              Generalized cross-correlation weighting, one of
+              `correlators.WEIGHTINGS` (e.g. 'phat'). Needs the
+              data in memory.
+        - channel_mode : str or None
+              For multi-channel files, either 'matched' (channel i
+              of one against channel i of two) or 'cross' (every
+              channel of one against every channel of two). By
+              default, 'matched' if both files have the same number
+              of channels and 'cross' otherwise. Needs the data in
+              memory.
+        - backend : str
+              How audio files are read, one of `audio_io.BACKENDS`
+              ('memmap' maps uncompressed WAV files instead of
+              decoding them)
+        - cache_directory : str or None
+              If given, real FFTs of the inputs and resampled
+              copies (pyramid) are kept there (see `cache.py`) and
+              reused by later runs on the same files. Only used
+              when the data is in memory.
+        - cache_max_bytes : int
+              Size cap of the cache
+        - precision : str
+              One of `correlators.PRECISIONS`, the precision of the
+              FFTs when the whole correlation is computed in memory
+              (see `correlators.PRECISIONS` for the error of
+              'float32'). Correlations computed block by block
+              (`block_size`, or `max_lag_seconds` alone) and pyramid
+              ones are always in double precision.
+        - workers : int
+              Threads for the FFTs of `.correlation()`, see
+              `parallel.py` (-1 for every core)
+        - normalized : bool
+              If True, every lag of the correlation is divided by
+              the energies of the parts of both signals that
+              overlap at that lag, so it's between -1 and 1
+              whatever the gain and length of the files (see
+              `correlators.normalize_correlation()`). Works with
+              every path but the weighted ones.
+        """
+        correlators.check_precision(precision)
+        if normalized and weighting not in (None, 'none'):
+            raise ValueError(
+                "Normalized correlation can't be combined with " +
+                "a weighting ({})".format(weighting)
+            )
+        self.normalized = normalized
+        self.precision = precision
+        self.workers = parallel.get_workers(workers)
         self.audio_input_file_one = audio_one
         self.audio_input_file_two = audio_two
+        self.block_size = block_size
+        self.backend = backend
+        if cache_directory is None:
+            self.cache = None
+        else:
+            self.cache = cache.Cache(cache_directory, cache_max_bytes)
+        self.max_lag_seconds = max_lag_seconds
+        self.pyramid_rates = pyramid_rates
+        self.weighting = weighting
+        self.channel_mode = channel_mode
         self._read_audio_data('one')
         self._read_audio_data('two')
 
     def correlation(self):
-        self.correlation = scipy.signal.fftconvolve(
-            self.audio_input_data_one,
-            self.audio_input_data_two,
-            mode='full'
+        with parallel.fft_workers(self.workers):
+            self._correlation()
+        if self.normalized:
+            self._normalize_correlation()
+
+    def _correlation(self):
+        if self.pyramid_rates:
+            self._pyramid_correlation()
+            return
+        first_index, number_of_lags = self._get_lag_window()
+        self.correlation_zero_index = (
+            self._get_zero_index(self.audio_input_number_of_samples_two) -
+            first_index
         )
+        if self.cache is not None and self.block_size is None:
+            self.correlation = self._cached_correlation(
+                first_index, number_of_lags
+            )
+        elif self._is_multichannel():
+            self.correlation = self._multichannel_correlation(
+                first_index, number_of_lags
+            )
+        elif self._is_weighted():
+            self.correlation = self._weighted_correlation(
+                first_index, number_of_lags
+            )
+        elif (self.block_size is None and self.max_lag_seconds is None and
+              self._is_same_file()):
+            self.correlation = correlators.fft_autocorrelation(
+                self.audio_input_data_one,
+                self.precision
+            )
+        elif self.block_size is None and self.max_lag_seconds is None:
+            self.correlation = correlators.fft_correlation(
+                self.audio_input_data_one,
+                self.audio_input_data_two,
+                self.precision
+            )
+        else:
+            self.correlation = self._windowed_correlation(
+                first_index, number_of_lags
+            )
+
+    def correlation_lags(self):
+        """Correlation lags
+
+        Lag (in samples) of every index of `self.correlation`, so
+        that `self.correlation[i]` is `sum_n one[n + lags[i]] *
+        two[n]` whichever path computed it (only a window of lags
+        is computed with `max_lag_seconds` or `pyramid_rates`).
+        Needs `.correlation()` to have been called.
+        """
+        return(
+            numpy.arange(len(self.correlation)) -
+            int(self.correlation_zero_index)
+        )
+
+    def _normalize_correlation(self):
+        """Normalize correlation
+
+        Normalizes every column of `self.correlation` (one per
+        channel pair for multi-channel files) by the energies of
+        the overlapping parts, from the data in memory or, when
+        streaming, from the readers, block by block.
+        """
+        first_lag = -int(self.correlation_zero_index)
+        if self.correlation.ndim == 1:
+            self.correlation = correlators.normalize_correlation(
+                self.correlation, first_lag,
+                self._get_channel_reader('one'),
+                self._get_channel_reader('two'),
+                self._get_energy_block_size()
+            )
+            return
+        self.correlation = numpy.column_stack([
+            correlators.normalize_correlation(
+                self.correlation[:, pair], first_lag,
+                self._get_channel_reader('one', channel_one),
+                self._get_channel_reader('two', channel_two),
+                self._get_energy_block_size()
+            )
+            for pair, (channel_one, channel_two)
+            in enumerate(self.channel_pairs)
+        ])
+
+    def _get_channel_reader(self, which_data, channel=None):
+        data = getattr(self, self._get_name('data', which_data), None)
+        if data is None:
+            reader = getattr(self, self._get_name('reader', which_data))
+            if channel is None:
+                return(reader)
+            return(audio_io.ChannelReader(reader, channel))
+        if channel is not None:
+            data = numpy.reshape(data, (len(data), -1))[:, channel]
+        return(audio_io.ArrayReader(
+            data, getattr(self, self._get_name('sample_rate', which_data))
+        ))
+
+    def _get_energy_block_size(self):
+        if self.block_size is not None:
+            return(int(self.block_size))
+        return(max(
+            int(self.audio_input_number_of_samples_one),
+            int(self.audio_input_number_of_samples_two),
+            1
+        ))
 
     def graph(self):
-        spaces = self._get_linear_spaces()
-        figure, (graph_one, graph_two) = matplotlib.pyplot.subplots(2, 1)
+        """Graph
+
+        Both signals and the correlation, each drawn as a min/max
+        envelope with one value pair per pixel column (see
+        `plotting.py`), so the time and memory it takes depend on
+        the width of the graph and not on the length of the files.
+        The signals are read block by block, so it works when
+        streaming as well.
+        """
+        pyplot = plotting.get_pyplot()
+        figure, (graph_one, graph_two) = pyplot.subplots(2, 1)
+        columns = plotting.get_columns(figure)
         graph_one.set_title('Signals')
         graph_one.set_xlabel('Seconds')
         graph_one.set_ylabel('Signal')
-        graph_one.plot(
-            spaces['one'], self.audio_input_data_one, 'blue',
-            spaces['two'], self.audio_input_data_two, 'red'
-        )
+        for which_data, color in (('one', 'blue'), ('two', 'red')):
+            positions, minimum, maximum = plotting.reader_envelope(
+                getattr(self, self._get_name('reader', which_data)), columns
+            )
+            sample_rate = getattr(
+                self, self._get_name('sample_rate', which_data)
+            )
+            plotting.plot_envelope(
+                graph_one, positions / float(int(sample_rate)),
+                minimum, maximum, color
+            )
         graph_two.set_title('Correlation')
         graph_two.set_xlabel('Lag (seconds)')
         graph_two.set_ylabel('Power')
-        graph_two.plot(
-            spaces['three'], self.correlation, 'black'
+        positions, minimum, maximum = plotting.envelope(
+            self.correlation, columns
+        )
+        plotting.plot_envelope(
+            graph_two,
+            (positions - self.correlation_zero_index) /
+            float(int(self.audio_input_sample_rate_one)),
+            minimum, maximum, 'black'
         )
         figure.tight_layout()
         png_path = self._get_png_file_output()
         os.makedirs(os.path.dirname(png_path), exist_ok=True)
         figure.savefig(png_path)
+        pyplot.close(figure)
 
     def print_data(self, which_data):
         """Print data
@@ -151,79 +496,542 @@ class Analysis(object):
         print('*' * 70)
 
     def print_results(self):
+        if self.correlation.ndim == 2:
+            self._print_channel_results()
+            return
         # Sample rate is the same for both audio files
         sample_rate = int(self.audio_input_sample_rate_one)
         mc = numpy.max(abs(self.correlation))
         amc = numpy.argmax(abs(self.correlation))
         amc = self._adjust_to_seconds(amc, sample_rate)
+        lag = self.lag()
         print('*' * 70)
         print('* Results')
         print('*' * 70)
-        print('Max absolute correlation: {}'.format(mc))
+        if self.normalized:
+            print('Max absolute normalized correlation: {}'.format(mc))
+        else:
+            print('Max absolute correlation: {}'.format(mc))
+            print('Normalized max absolute correlation: {}'.format(
+                lag.normalized_peak
+            ))
         print('Arg max absolute correlation (lag): {} seconds'.format(amc))
+        print('Interpolated lag: {} seconds'.format(lag.seconds))
         print('*' * 70)
 
+    def lag(self, pair=0):
+        """Lag
+
+        Inputs
+        ------
+        - pair : int
+              For multi-channel files, index of the channel
+              pair (in `self.channel_pairs`)
+
+        Outputs
+        -------
+        - lag : Lag
+              See `Lag` at the top of this file
+
+        Needs `.correlation()` to have been called. The lag is
+        such that `one[n + lag]` matches `two[n]`, so it is
+        negative when `two` is `one` delayed.
+        """
+        sample_rate = int(self.audio_input_sample_rate_one)
+        if self.correlation.ndim == 2:
+            correlation = self.correlation[:, pair]
+            channel_one, channel_two = self.channel_pairs[pair]
+        else:
+            correlation = self.correlation
+            channel_one, channel_two = None, None
+        index = int(numpy.argmax(abs(correlation)))
+        peak = float(correlation[index])
+        offset = correlators.parabolic_peak_offset(correlation, index)
+        samples = index - int(self.correlation_zero_index)
+        if self.normalized:
+            normalized_peak = abs(peak)
+        elif self._is_weighted():
+            normalized_peak = abs(peak) / max(
+                float(self.peak_norms[pair]), numpy.finfo(float).tiny
+            )
+        else:
+            normalized_peak = self._normalize_peak(
+                peak, channel_one, channel_two
+            )
+        return(Lag(
+            samples=samples,
+            sub_samples=samples + offset,
+            seconds=(samples + offset) / float(sample_rate),
+            peak=peak,
+            normalized_peak=normalized_peak
+        ))
+
+    def _normalize_peak(self, peak, channel_one, channel_two):
+        energy = (
+            self._get_energy('one', channel_one) *
+            self._get_energy('two', channel_two)
+        )
+        if energy > 0:
+            return(abs(peak) / float(numpy.sqrt(energy)))
+        return(0.0)
+
+    def channel_lags(self):
+        """Channel lags
+
+        Outputs
+        -------
+        - lags : list of ((int, int), Lag)
+              Channel pair and its lag, for every pair
+              in `self.channel_pairs`
+        """
+        return([
+            (pair, self.lag(index))
+            for index, pair in enumerate(self.channel_pairs)
+        ])
+
+    def _print_channel_results(self):
+        print('*' * 70)
+        print('* Results (per channel pair)')
+        print('*' * 70)
+        for (channel_one, channel_two), lag in self.channel_lags():
+            print(
+                'Channels {} vs {}: '.format(channel_one, channel_two) +
+                'lag {} seconds, '.format(lag.seconds) +
+                'normalized max absolute correlation {}'.format(
+                    lag.normalized_peak
+                )
+            )
+        print('*' * 70)
+
+    def _get_energy(self, which_data, channel=None):
+        """Get energy
+
+        Sum of squares of the signal (or one of its channels),
+        read block by block when the data is not in memory.
+        """
+        data = getattr(self, self._get_name('data', which_data), None)
+        if data is not None:
+            if channel is not None:
+                data = numpy.reshape(data, (len(data), -1))[:, channel]
+            return(float(numpy.sum(numpy.square(data))))
+        return(correlators.energy(
+            self._get_channel_reader(which_data, channel),
+            int(self.block_size)
+        ))
+
     def _adjust_to_seconds(self, arg_max_corr, sample_rate):
         #
-        # TODO: Verify this formula
-        # --------------------------
-        # The objective is to adjust from samples to seconds
-        # to know the lag between the two audio files.
-        # I believe that if the two audio files are the same,
-        # the correlation should be maxed at lag == 0. This
-        # was tested with white noise.
+        # The correlation holds `sum_n one[n + lag] * two[n]`,
+        # the full one starting at `lag == -(len(two) - 1)`, so
+        # lag zero is at index `len(two) - 1` (moved accordingly
+        # when only a window of lags is computed, see
+        # `_get_lag_window()`). Identical files are maxed at
+        # lag zero.
         #
         arg_max_corr = (
-            (arg_max_corr - len(self.correlation)/2) /
+            (arg_max_corr - self.correlation_zero_index) /
             float(sample_rate)
         )
         return(arg_max_corr)
 
-    def _read_audio_data(self, which_data):
+    def _windowed_correlation(self, first_index, number_of_lags):
+        """Windowed correlation
+
+        Reproduces `fftconvolve(one, two[::-1], mode='full')` for
+        the `number_of_lags` indexes starting at `first_index`,
+        block by block (see `correlators.py`).
+
+        When streaming, the files are read through their readers.
+        Otherwise, the data in memory is wrapped in array readers
+        and the blocks are sized to the window. Multi-channel files
+        are read all channels at a time, and every channel pair
+        (see `_get_channel_pairs()`) is accumulated from the same
+        blocks.
+        """
+        if self._is_multichannel():
+            self.channel_pairs = self._get_channel_pairs()
+            pairs = self.channel_pairs
+        else:
+            pairs = None
+        if self.block_size is None:
+            readers = self._get_array_readers()
+            block_size = None
+        else:
+            readers = (
+                self.audio_input_reader_one,
+                self.audio_input_reader_two
+            )
+            block_size = int(self.block_size)
+        return(self._correlate_window(
+            readers, first_index, number_of_lags, block_size, pairs
+        ))
+
+    def _cached_correlation(self, first_index, number_of_lags):
+        """Cached correlation
+
+        Correlation from the real FFTs of both inputs, taken from
+        the cache when a previous run already computed them for
+        the same file content and FFT size. Handles weightings and
+        multi-channel files like the other paths do.
+        """
+        if self._is_multichannel():
+            self.channel_pairs = self._get_channel_pairs()
+            return(self._spectra_correlation(
+                self._get_cached_spectra, self.channel_pairs,
+                first_index, number_of_lags
+            ))
+        return(self._spectra_correlation(
+            self._get_cached_spectra, [(0, 0)], first_index, number_of_lags
+        )[:, 0])
+
+    def _spectra_correlation(self, get_spectra, pairs, first_index,
+                             number_of_lags):
+        """Spectra correlation
+
+        Lag window of the correlation of `pairs` from the real
+        FFTs given by `get_spectra(which_data, fft_size)`. For
+        weightings, also keeps the norm of every pair (see
+        `correlators.cross_spectrum_norm()`) in `self.peak_norms`
+        for `lag()`, since the energies of the signals don't
+        normalize a weighted peak.
+        """
+        samples_one = int(self.audio_input_number_of_samples_one)
+        samples_two = int(self.audio_input_number_of_samples_two)
+        fft_size = correlators.correlation_fft_size(samples_one, samples_two)
+        spectra_one = get_spectra('one', fft_size)
+        if self._is_same_file():
+            spectra_two = spectra_one
+        else:
+            spectra_two = get_spectra('two', fft_size)
+        if self._is_weighted():
+            self.peak_norms = correlators.spectra_norms(
+                spectra_one, spectra_two, fft_size, pairs, self.weighting
+            )
+        correlation = correlators.spectra_correlation(
+            spectra_one,
+            spectra_two,
+            samples_one,
+            samples_two,
+            fft_size,
+            pairs,
+            self.weighting or 'none'
+        )
+        return(correlation[first_index:first_index + number_of_lags])
+
+    def _get_data_spectra(self, which_data, fft_size):
+        data = getattr(self, self._get_name('data', which_data))
+        return(self._rfft(numpy.reshape(data, (len(data), -1)), fft_size))
+
+    def _get_cached_spectra(self, which_data, fft_size):
+        data = getattr(self, self._get_name('data', which_data))
         audio_file = getattr(self, "audio_input_file_{}".format(which_data))
-        try:
-            sound_file = scikits.audiolab.Sndfile(audio_file, 'r')
-        except Exception as e:
+        spectra = self.cache.get_or_compute(
+            cache.make_key(
+                cache.file_hash(audio_file), 'rfft', fft_size, self.precision
+            ),
+            lambda: self._rfft(data, fft_size)
+        )
+        return(numpy.reshape(spectra, (len(spectra), -1)))
+
+    def _rfft(self, data, fft_size):
+        import scipy.fft
+        return(scipy.fft.rfft(
+            numpy.asarray(data, dtype=self.precision), fft_size, axis=0
+        ))
+
+    def _weighted_correlation(self, first_index, number_of_lags):
+        """Weighted correlation
+
+        Generalized cross-correlation over the whole signals (the
+        weightings are defined on their full spectra), of which
+        only the lag window is kept.
+        """
+        if self.block_size is not None:
             raise ValueError(
-                "Could not open {}.\n".format(audio_file) +
-                "Full Python exception: {}.\n".format(e)
+                "Weighted correlation needs the data in memory " +
+                "(it can't be combined with `block_size`)"
             )
-        names = self._get_names(which_data)
-        setattr(self, names['format'], sound_file.format)
-        setattr(self, names['encoding'], sound_file.encoding)
-        setattr(self, names['sample_rate'], sound_file.samplerate)
-        setattr(self, names['samples'], sound_file.nframes)
-        setattr(self, names['channels'], sound_file.channels)
-        setattr(self, names['data'], sound_file.read_frames(
-            getattr(self, names['samples'])
+        return(self._spectra_correlation(
+            self._get_data_spectra, [(0, 0)], first_index, number_of_lags
+        )[:, 0])
+
+    def _multichannel_correlation(self, first_index, number_of_lags):
+        """Multichannel correlation
+
+        Correlates the channel pairs (see `_get_channel_pairs()`)
+        with the FFTs batched over the channel axis, and keeps
+        only the lag window. Every column of the result is one
+        pair, listed in `self.channel_pairs`. When streaming, the
+        pairs are accumulated block by block instead (see
+        `_windowed_correlation()`).
+        """
+        if self.block_size is not None:
+            if self._is_weighted():
+                raise ValueError(
+                    "Weighted correlation needs the data in memory " +
+                    "(it can't be combined with `block_size`)"
+                )
+            return(self._windowed_correlation(first_index, number_of_lags))
+        self.channel_pairs = self._get_channel_pairs()
+        return(self._spectra_correlation(
+            self._get_data_spectra, self.channel_pairs,
+            first_index, number_of_lags
         ))
 
-    def _get_linear_spaces(self):
-        spaces = {}
-        spaces['one'] = numpy.linspace(
-            0,
-            len(self.audio_input_data_one) /
-            int(self.audio_input_sample_rate_one),
-            num=len(self.audio_input_data_one)
+    def _get_channel_pairs(self):
+        channels_one = int(self.audio_input_number_of_channels_one)
+        channels_two = int(self.audio_input_number_of_channels_two)
+        channel_mode = self.channel_mode
+        if channel_mode is None:
+            if channels_one == channels_two:
+                channel_mode = 'matched'
+            else:
+                channel_mode = 'cross'
+        if channel_mode == 'matched':
+            if channels_one != channels_two:
+                raise ValueError(
+                    "Matched channels need the same number of channels " +
+                    "({} and {})".format(channels_one, channels_two)
+                )
+            return([(channel, channel) for channel in range(channels_one)])
+        if channel_mode == 'cross':
+            return([
+                (channel_one, channel_two)
+                for channel_one in range(channels_one)
+                for channel_two in range(channels_two)
+            ])
+        raise ValueError(
+            "Unknown channel mode ({}), ".format(channel_mode) +
+            "should be 'matched' or 'cross'"
         )
-        spaces['two'] = numpy.linspace(
-            0,
-            len(self.audio_input_data_two) /
-            int(self.audio_input_sample_rate_two),
-            num=len(self.audio_input_data_two)
+
+    def _is_multichannel(self):
+        return(
+            int(self.audio_input_number_of_channels_one) != 1 or
+            int(self.audio_input_number_of_channels_two) != 1
         )
-        spaces['three'] = numpy.linspace(
-            -len(self.correlation) /
-            (2 * int(self.audio_input_sample_rate_one)),
-            len(self.correlation) /
-            (2 * int(self.audio_input_sample_rate_one)),
-            num=len(self.correlation)
+
+    def _is_weighted(self):
+        return(self.weighting not in (None, 'none'))
+
+    def _pyramid_correlation(self):
+        """Pyramid correlation
+
+        Coarse-to-fine estimation of the lag. At the lowest rate
+        the whole lag window is searched (all lags, or the ones
+        within `max_lag_seconds`). At every following rate (the
+        native one last), only `PYRAMID_MARGIN` samples of the
+        previous rate around the previous estimate are searched.
+        The resampled copies (see `_resample()`) are kept in
+        memory only while their level is computed; nothing is
+        written to disk.
+
+        Multi-channel files are correlated for every channel pair
+        (see `_get_channel_pairs()`), each pair with its own
+        estimate; every level searches the lags around all of
+        them, so the pairs share one lag window.
+
+        The last level leaves the correlation around the final
+        estimate in `self.correlation`, at the native rate.
+        """
+        if self.block_size is not None or self._is_weighted():
+            raise ValueError(
+                "Pyramid correlation needs the data in memory " +
+                "(it can't be combined with `block_size`) and " +
+                "is not weighted (it can't be combined with `weighting`)"
+            )
+        native_rate = int(self.audio_input_sample_rate_one)
+        rates = self._get_pyramid_rates(native_rate)
+        if self._is_multichannel():
+            self.channel_pairs = self._get_channel_pairs()
+            pairs = self.channel_pairs
+        else:
+            pairs = None
+        estimates = None
+        for level, rate in enumerate(rates):
+            readers = self._get_array_readers(rate)
+            full_length = (
+                readers[0].number_of_samples +
+                readers[1].number_of_samples - 1
+            )
+            zero_index = self._get_zero_index(readers[1].number_of_samples)
+            if estimates is None:
+                first_index, number_of_lags = self._get_lag_window(
+                    full_length, zero_index, rate
+                )
+            else:
+                centers = [
+                    int(round(zero_index + estimate * rate))
+                    for estimate in estimates
+                ]
+                margin = int(numpy.ceil(
+                    PYRAMID_MARGIN * rate / float(rates[level - 1])
+                ))
+                first_index, _ = self._clip_lag_window(
+                    full_length, min(centers), margin
+                )
+                last_index, last_count = self._clip_lag_window(
+                    full_length, max(centers), margin
+                )
+                number_of_lags = last_index + last_count - first_index
+            correlation = self._correlate_window(
+                readers, first_index, number_of_lags, None, pairs
+            )
+            zero_index -= first_index
+            estimates = (
+                numpy.argmax(
+                    abs(numpy.reshape(correlation, (len(correlation), -1))),
+                    axis=0
+                ) - zero_index
+            ) / float(rate)
+        self.correlation = correlation
+        self.correlation_zero_index = zero_index
+
+    def _get_pyramid_rates(self, native_rate):
+        rates = sorted(int(rate) for rate in self.pyramid_rates)
+        if rates[-1] > native_rate:
+            raise ValueError(
+                "Pyramid rate ({}) ".format(rates[-1]) +
+                "is higher than the sample rate ({})".format(native_rate)
+            )
+        if rates[-1] != native_rate:
+            rates.append(native_rate)
+        return(rates)
+
+    def _correlate_window(self, readers, first_index, number_of_lags,
+                          block_size, pairs=None):
+        """Correlate window
+
+        Reproduces `fftconvolve(one, two[::-1], mode='full')` for
+        the `number_of_lags` indexes starting at `first_index` (for
+        every channel pair in `pairs`, if given). If `block_size`
+        is None, the blocks are sized to the window.
+        """
+        if block_size is None:
+            block_size = correlators.window_block_size(number_of_lags)
+        return(correlators.stream_correlation(
+            readers[0],
+            readers[1],
+            first_lag=first_index - (readers[1].number_of_samples - 1),
+            number_of_lags=number_of_lags,
+            block_size=block_size,
+            pairs=pairs
+        ))
+
+    def _get_lag_window(self, full_length=None, zero_index=None,
+                        sample_rate=None):
+        """Get lag window
+
+        Returns the first index and the number of indexes of the
+        full correlation that have to be computed. The window is
+        centered at lag zero.
+        """
+        if full_length is None:
+            full_length = self._get_full_correlation_length()
+        if zero_index is None:
+            zero_index = self._get_zero_index(
+                self.audio_input_number_of_samples_two
+            )
+        if sample_rate is None:
+            sample_rate = int(self.audio_input_sample_rate_one)
+        if self.max_lag_seconds is None:
+            return(0, full_length)
+        max_lag = int(round(float(self.max_lag_seconds) * sample_rate))
+        return(self._clip_lag_window(full_length, zero_index, max_lag))
+
+    def _clip_lag_window(self, full_length, center, max_lag):
+        first_index = min(max(center - max_lag, 0), full_length - 1)
+        last_index = max(min(center + max_lag, full_length - 1), first_index)
+        return(first_index, last_index - first_index + 1)
+
+    def _get_zero_index(self, samples_two):
+        return(int(samples_two) - 1)
+
+    def _get_full_correlation_length(self):
+        return(
+            int(self.audio_input_number_of_samples_one) +
+            int(self.audio_input_number_of_samples_two) - 1
         )
-        return(spaces)
+
+    def _get_array_readers(self, sample_rate=None):
+        """Get array readers
+
+        Wraps the data in memory. If `sample_rate` is given (and
+        is not the native one) the data is resampled first.
+        """
+        readers = []
+        for which_data in ('one', 'two'):
+            data = getattr(self, self._get_name('data', which_data))
+            native_rate = int(
+                getattr(self, self._get_name('sample_rate', which_data))
+            )
+            if sample_rate is None or int(sample_rate) == native_rate:
+                readers.append(audio_io.ArrayReader(data, native_rate))
+            else:
+                readers.append(audio_io.ArrayReader(
+                    self._resample(which_data, data, native_rate, sample_rate),
+                    sample_rate
+                ))
+        return(tuple(readers))
+
+    def _resample(self, which_data, data, native_rate, sample_rate):
+        """Resample
+
+        Polyphase resampling (see `downsampling.resample()`), whose
+        cost is linear in the length of the data at every level,
+        unlike an FFT over the whole file.
+        """
+        def compute():
+            return(downsampling.resample(
+                data, native_rate, sample_rate, engine='polyphase'
+            ))
+        if self.cache is None:
+            return(compute())
+        audio_file = getattr(self, "audio_input_file_{}".format(which_data))
+        return(self.cache.get_or_compute(
+            cache.make_key(
+                cache.file_hash(audio_file), 'resample',
+                native_rate, int(sample_rate), 'polyphase'
+            ),
+            compute
+        ))
+
+    def _read_audio_data(self, which_data):
+        audio_file = getattr(self, "audio_input_file_{}".format(which_data))
+        reader = audio_io.open_reader(audio_file, self.backend)
+        names = self._get_names(which_data)
+        setattr(self, names['reader'], reader)
+        setattr(self, names['format'], reader.format)
+        setattr(self, names['encoding'], reader.encoding)
+        setattr(self, names['sample_rate'], reader.sample_rate)
+        setattr(self, names['samples'], reader.number_of_samples)
+        setattr(self, names['channels'], reader.number_of_channels)
+        if self.block_size is None:
+            self._load_audio_data(which_data)
+
+    def _load_audio_data(self, which_data):
+        names = self._get_names(which_data)
+        if hasattr(self, names['data']):
+            return
+        if which_data == 'two' and self._is_same_file():
+            # Same file twice (an autocorrelation): share the data
+            setattr(self, names['data'], self.audio_input_data_one)
+            return
+        reader = getattr(self, names['reader'])
+        setattr(self, names['data'], reader.read_all())
+
+    def _is_same_file(self):
+        try:
+            return(os.path.samefile(
+                self.audio_input_file_one, self.audio_input_file_two
+            ))
+        except OSError:
+            return(False)
 
     def _get_names(self, which_data):
         names = {}
         names['data'] = self._get_name('data', which_data)
+        names['reader'] = self._get_name('reader', which_data)
         names['format'] = self._get_name('format', which_data)
         names['encoding'] = self._get_name('encoding', which_data)
         names['sample_rate'] = self._get_name('sample_rate', which_data)
@@ -289,17 +1097,95 @@ def main(argv):
             "arguments (see code instructions)"
         )
 
-    audio_file_input_one = argv[0]
-    audio_file_input_two = argv[1]
+    arguments = _parse_arguments(argv)
 
-    analysis = Analysis(audio_file_input_one, audio_file_input_two)
+    analysis = Analysis(
+        arguments.audio_file_input_one,
+        arguments.audio_file_input_two,
+        block_size=arguments.block_size,
+        max_lag_seconds=arguments.max_lag_seconds,
+        pyramid_rates=arguments.pyramid_rates,
+        weighting=arguments.weighting,
+        channel_mode=arguments.channel_mode,
+        backend=arguments.backend,
+        cache_directory=arguments.cache_directory,
+        cache_max_bytes=arguments.cache_max_megabytes * 1024 ** 2,
+        precision=arguments.precision,
+        workers=arguments.workers,
+        normalized=arguments.normalized
+    )
 
     analysis.print_data('one')
     analysis.print_data('two')
     analysis.correlation()
-    analysis.graph()
+    if arguments.graph:
+        analysis.graph()
     analysis.print_results()
 
 
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Cross-correlation to identify time delay"
+    )
+    parser.add_argument('audio_file_input_one')
+    parser.add_argument('audio_file_input_two')
+    parser.add_argument(
+        '--block-size', type=int, default=None,
+        help="Stream both files in blocks of this many frames " +
+             "instead of loading them into memory"
+    )
+    parser.add_argument(
+        '--max-lag-seconds', type=float, default=None,
+        help="Only compute lags within plus/minus this many seconds"
+    )
+    parser.add_argument(
+        '--graph', action='store_true',
+        help="Graph the signals and the correlation into `./results/`"
+    )
+    parser.add_argument(
+        '--pyramid-rates', type=int, nargs='+', default=None,
+        help="Estimate the lag at these (lower) sample rates first " +
+             "and refine it up to the native rate"
+    )
+    parser.add_argument(
+        '--weighting', choices=correlators.WEIGHTINGS, default=None,
+        help="Generalized cross-correlation weighting (sharper peaks " +
+             "on reverberant recordings)"
+    )
+    parser.add_argument(
+        '--channel-mode', choices=('matched', 'cross'), default=None,
+        help="For multi-channel files, correlate matching channels " +
+             "or every pair of channels"
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How audio files are read (`memmap` for uncompressed WAV)"
+    )
+    parser.add_argument(
+        '--precision', choices=correlators.PRECISIONS, default='float64',
+        help="Precision of the in-memory FFTs (`float32` is faster and " +
+             "takes half the memory, see `correlators.PRECISIONS`)"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=parallel.DEFAULT_WORKERS,
+        help="Threads for the FFTs (-1 for every core, see `parallel.py`)"
+    )
+    parser.add_argument(
+        '--normalized', action='store_true',
+        help="Divide every lag by the energy of the overlapping parts " +
+             "(between -1 and 1, comparable across files)"
+    )
+    parser.add_argument(
+        '--cache-directory', default=None,
+        help="Keep real FFTs and resampled copies there for later runs"
+    )
+    parser.add_argument(
+        '--cache-max-megabytes', type=int,
+        default=cache.DEFAULT_CACHE_MAX_BYTES // 1024 ** 2,
+        help="Size cap of the cache (least recently used entries go first)"
+    )
+    return(parser.parse_args(argv))
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
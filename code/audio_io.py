@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+
+"""
+Block-wise access to audio data
+
+Functionality
+-------------
+- Read arbitrary frame ranges from an audio file without
+  loading the whole file into memory
+- Expose in-memory arrays through the same interface so
+  block-wise engines can work on either
+- Memory-mapped access to PCM and float WAV files: opening is
+  instant whatever the size of the file, and only the frames
+  read are paged in (and converted to float)
+- Read and write audio stored in HDF5 files as a chunked
+  (optionally compressed) dataset, block by block
+
+Readers
+-------
+All readers expose the same attributes and methods:
+
+- format, encoding, sample_rate
+      `format` is the libsndfile format for `SndfileReader`
+      and a description ('WAV', 'HDF5') for the others; use
+      `sndfile_format()` to write with scikits.audiolab
+- number_of_samples, number_of_channels
+- read(start, count)
+      Returns `count` frames starting at frame `start` as a
+      float64 array. Frames outside of the file (negative
+      `start` or past the end) are returned as zeros, which
+      is what the correlation engines need for padding.
+- read_all()
+- close()
+
+Backends
+--------
+- sndfile: `scikits.audiolab.Sndfile`, any format libsndfile reads
+- memmap: `MemmapWavReader`, uncompressed WAV only (8, 16, 24 and
+  32 bit PCM, 32 and 64 bit float)
+
+`ChannelReader` reads one channel of any multi-channel reader
+as if it was a mono one.
+
+Use `open_reader()` to get a reader for a given backend. Files
+with an `.h5` or `.hdf5` extension are always read with
+`HDF5Reader` (the backend only applies to audio files).
+
+HDF5 layout
+-----------
+One dataset, `audio`, of frames x channels (float32, or float64
+for encodings float32 can't hold exactly, see `hdf5_dtype()`),
+chunked along the frames so that reading any time slice only
+decodes the chunks it touches. Its attributes are `sample_rate`,
+`channels` and `encoding` (the encoding of the original audio,
+used when translating back to WAV). See `HDF5Reader` and
+`HDF5Writer`.
+
+Dependencies
+------------
+- scikits.audiolab depends on libsndfile:
+  http://www.mega-nerd.com/libsndfile/#Download
+- h5py, only for HDF5 files
+
+Both are imported the first time a file needs them, not when
+this module is imported. The memmap and HDF5 readers don't need
+scikits.audiolab at all.
+"""
+
+import struct
+import numpy
+
+BACKENDS = ('sndfile', 'memmap')
+
+#
+# WAV `fmt ` chunk format tags
+#
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+#
+# Encodings whose samples float32 holds exactly (its 24 bit
+# mantissa fits up to 24 bit PCM). Anything else (32 bit PCM,
+# float64, or unknown encodings) is stored as float64.
+#
+HDF5_FLOAT32_ENCODINGS = (
+    'pcms8', 'pcmu8', 'pcm16', 'pcm24', 'float32', 'ulaw', 'alaw'
+)
+
+#
+# HDF5 dataset name and chunk length (in frames). The chunk
+# length matches the default block size of the block-wise
+# engines, so every block read touches one or two chunks.
+#
+HDF5_DATASET = 'audio'
+HDF5_CHUNK_FRAMES = 65536
+
+
+def open_reader(audio_file, backend='sndfile'):
+    """Open reader
+
+    Inputs
+    ------
+    - audio_file : str
+          Audio file, or HDF5 file (see `is_hdf5_file()`)
+    - backend : str
+          One of `BACKENDS`, for audio files
+    """
+    if is_hdf5_file(audio_file):
+        return(HDF5Reader(audio_file))
+    if backend == 'sndfile':
+        return(SndfileReader(audio_file))
+    if backend == 'memmap':
+        return(MemmapWavReader(audio_file))
+    raise ValueError(
+        "Unknown backend ({}), ".format(backend) +
+        "should be one of: {}".format(", ".join(BACKENDS))
+    )
+
+
+def is_hdf5_file(audio_file):
+    return(audio_file.lower().endswith(('.h5', '.hdf5')))
+
+
+class SndfileReader(object):
+
+    def __init__(self, audio_file):
+        import scikits.audiolab
+        self.audio_file = audio_file
+        try:
+            self.sound_file = scikits.audiolab.Sndfile(audio_file, 'r')
+        except Exception as e:
+            raise ValueError(
+                "Could not open {}.\n".format(audio_file) +
+                "Full Python exception: {}.\n".format(e)
+            )
+        self.format = self.sound_file.format
+        self.encoding = self.sound_file.encoding
+        self.sample_rate = self.sound_file.samplerate
+        self.number_of_samples = self.sound_file.nframes
+        self.number_of_channels = self.sound_file.channels
+        self._position = 0
+
+    def read(self, start, count):
+        block = _zeros(count, self.number_of_channels)
+        first, last = _clip_range(start, count, self.number_of_samples)
+        if last > first:
+            if first != self._position:
+                self.sound_file.seek(first)
+            block[first - start:last - start] = self.sound_file.read_frames(
+                last - first
+            )
+            self._position = last
+        return(block)
+
+    def read_all(self):
+        return(self.read(0, self.number_of_samples))
+
+    def close(self):
+        self.sound_file.close()
+
+
+class MemmapWavReader(object):
+
+    def __init__(self, audio_file):
+        """Memmap WAV reader
+
+        Parses the RIFF header and maps the `data` chunk with
+        `numpy.memmap` (frames x channels, in the file's own
+        sample type). Nothing is decoded until `read()` is called,
+        and then only the frames requested are converted to float
+        (scaled to [-1, 1) for PCM, like libsndfile does).
+        """
+        self.audio_file = audio_file
+        try:
+            header = _parse_wav_header(audio_file)
+        except Exception as e:
+            raise ValueError(
+                "Could not open {}.\n".format(audio_file) +
+                "Full Python exception: {}.\n".format(e)
+            )
+        self.encoding = header['encoding']
+        self.format = 'WAV'
+        self.sample_rate = header['sample_rate']
+        self.number_of_channels = header['channels']
+        self.number_of_samples = header['frames']
+        self._scale = header['scale']
+        self._offset = header['offset']
+        if header['encoding'] == 'pcm24':
+            shape = (self.number_of_samples, self.number_of_channels, 3)
+        else:
+            shape = (self.number_of_samples, self.number_of_channels)
+        if self.number_of_samples > 0:
+            self.data = numpy.memmap(
+                audio_file, dtype=header['dtype'], mode='r',
+                offset=header['data_offset'], shape=shape
+            )
+        else:
+            self.data = numpy.zeros(shape, dtype=header['dtype'])
+
+    def read(self, start, count):
+        block = _zeros(count, self.number_of_channels)
+        first, last = _clip_range(start, count, self.number_of_samples)
+        if last > first:
+            frames = self._to_float(self.data[first:last])
+            if self.number_of_channels == 1:
+                frames = frames[:, 0]
+            block[first - start:last - start] = frames
+        return(block)
+
+    def read_all(self):
+        return(self.read(0, self.number_of_samples))
+
+    def close(self):
+        # The map is released when the reader is garbage collected
+        self.data = None
+
+    def _to_float(self, frames):
+        if self.encoding == 'pcm24':
+            frames = frames.astype(numpy.int32)
+            frames = (
+                frames[..., 0] |
+                (frames[..., 1] << 8) |
+                (frames[..., 2] << 16)
+            )
+            frames = (frames ^ 0x800000) - 0x800000
+        return((frames.astype(numpy.float64) - self._offset) * self._scale)
+
+
+class HDF5Reader(object):
+
+    def __init__(self, audio_file):
+        """HDF5 reader
+
+        Reads only the hyperslab (range of frames) requested
+        by each `read()` from the `audio` dataset.
+        """
+        h5py = _import_h5py()
+        self.audio_file = audio_file
+        try:
+            self.hdf5_file = h5py.File(audio_file, 'r')
+            self.dataset = self.hdf5_file[HDF5_DATASET]
+        except Exception as e:
+            raise ValueError(
+                "Could not open {}.\n".format(audio_file) +
+                "Full Python exception: {}.\n".format(e)
+            )
+        self.encoding = _to_str(self.dataset.attrs['encoding'])
+        self.format = 'HDF5'
+        self.sample_rate = int(self.dataset.attrs['sample_rate'])
+        self.number_of_samples = self.dataset.shape[0]
+        self.number_of_channels = self.dataset.shape[1]
+
+    def read(self, start, count):
+        block = _zeros(count, self.number_of_channels)
+        first, last = _clip_range(start, count, self.number_of_samples)
+        if last > first:
+            frames = self.dataset[first:last].astype(numpy.float64)
+            if self.number_of_channels == 1:
+                frames = frames[:, 0]
+            block[first - start:last - start] = frames
+        return(block)
+
+    def read_all(self):
+        return(self.read(0, self.number_of_samples))
+
+    def close(self):
+        self.hdf5_file.close()
+
+
+class HDF5Writer(object):
+
+    def __init__(self, audio_file, sample_rate, number_of_channels, encoding,
+                 compression=None, compression_level=None,
+                 dtype=None):
+        """HDF5 writer
+
+        Inputs
+        ------
+        - audio_file : str
+        - sample_rate : int
+        - number_of_channels : int
+        - encoding : str
+              Encoding of the original audio (kept as attribute)
+        - compression : str or None
+              'gzip' or 'lzf' (any filter h5py supports)
+        - compression_level : int or None
+              For 'gzip', from 0 to 9
+        - dtype : numpy.dtype or None
+              Sample type stored (by default, the smallest one
+              that holds `encoding` exactly, see `hdf5_dtype()`)
+
+        Frames are appended with `write()`; the dataset grows
+        as needed, one chunk at a time.
+        """
+        h5py = _import_h5py()
+        if dtype is None:
+            dtype = hdf5_dtype(encoding)
+        self.audio_file = audio_file
+        try:
+            self.hdf5_file = h5py.File(audio_file, 'w')
+        except Exception as e:
+            raise ValueError(
+                "Could not prepare {}.\n".format(audio_file) +
+                "Full Python exception: {}.\n".format(e)
+            )
+        self.dataset = self.hdf5_file.create_dataset(
+            HDF5_DATASET,
+            shape=(0, int(number_of_channels)),
+            maxshape=(None, int(number_of_channels)),
+            chunks=(HDF5_CHUNK_FRAMES, int(number_of_channels)),
+            dtype=dtype,
+            compression=compression,
+            compression_opts=compression_level,
+            shuffle=compression is not None
+        )
+        self.dataset.attrs['sample_rate'] = int(sample_rate)
+        self.dataset.attrs['channels'] = int(number_of_channels)
+        self.dataset.attrs['encoding'] = str(encoding)
+        self.format = 'HDF5'
+        self.encoding = str(encoding)
+        self.samplerate = int(sample_rate)
+        self.channels = int(number_of_channels)
+        self.nframes = 0
+
+    def write(self, block):
+        block = numpy.reshape(block, (len(block), self.channels))
+        self.dataset.resize(self.nframes + len(block), axis=0)
+        self.dataset[self.nframes:] = block
+        self.nframes += len(block)
+
+    def close(self):
+        self.hdf5_file.close()
+
+
+class ArrayReader(object):
+
+    def __init__(self, data, sample_rate):
+        self.data = numpy.asarray(data)
+        self.format = 'In-memory array'
+        self.encoding = str(self.data.dtype)
+        self.sample_rate = sample_rate
+        self.number_of_samples = self.data.shape[0]
+        if self.data.ndim == 1:
+            self.number_of_channels = 1
+        else:
+            self.number_of_channels = self.data.shape[1]
+
+    def read(self, start, count):
+        block = _zeros(count, self.number_of_channels)
+        first, last = _clip_range(start, count, self.number_of_samples)
+        if last > first:
+            block[first - start:last - start] = self.data[first:last]
+        return(block)
+
+    def read_all(self):
+        return(self.read(0, self.number_of_samples))
+
+    def close(self):
+        pass
+
+
+class ChannelReader(object):
+
+    def __init__(self, reader, channel):
+        """Channel reader
+
+        Inputs
+        ------
+        - reader : audio_io reader
+              Multi-channel reader, closed by its owner (not
+              by `close()`)
+        - channel : int
+
+        Every read still reads all of the channels of `reader`,
+        so correlating many channels in one pass should read the
+        blocks once and pick the channels itself.
+        """
+        self.reader = reader
+        self.channel = channel
+        self.format = reader.format
+        self.encoding = reader.encoding
+        self.sample_rate = reader.sample_rate
+        self.number_of_samples = reader.number_of_samples
+        self.number_of_channels = 1
+
+    def read(self, start, count):
+        block = self.reader.read(start, count)
+        return(numpy.reshape(block, (count, -1))[:, self.channel])
+
+    def read_all(self):
+        return(self.read(0, self.number_of_samples))
+
+    def close(self):
+        pass
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ValueError("HDF5 files need h5py (`pip install h5py`)")
+    return(h5py)
+
+
+def hdf5_dtype(encoding):
+    """HDF5 dtype
+
+    float32 for the encodings it holds exactly (see
+    `HDF5_FLOAT32_ENCODINGS`), float64 for the rest.
+    """
+    if str(encoding) in HDF5_FLOAT32_ENCODINGS:
+        return(numpy.dtype(numpy.float32))
+    return(numpy.dtype(numpy.float64))
+
+
+def sndfile_format(reader):
+    """Sndfile format
+
+    `scikits.audiolab.Format` to write audio read by `reader`
+    with `scikits.audiolab.Sndfile`: the file's own format for
+    `SndfileReader`, and WAV with the reader's encoding for the
+    others. Only writers need it, so the readers that don't use
+    libsndfile don't import scikits.audiolab to open a file.
+    """
+    if isinstance(reader, SndfileReader):
+        return(reader.format)
+    import scikits.audiolab
+    return(scikits.audiolab.Format('wav', reader.encoding))
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return(value.decode('utf-8'))
+    return(str(value))
+
+
+def _parse_wav_header(audio_file):
+    """Parse WAV header
+
+    Walks the RIFF chunks up to `data` and returns what's needed
+    to map it. Only uncompressed PCM and IEEE float are supported.
+    """
+    header = {}
+    with open(audio_file, 'rb') as wav_file:
+        riff, _, wave = struct.unpack('<4sI4s', wav_file.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError("Not a RIFF/WAVE file")
+        while True:
+            chunk_header = wav_file.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("No `data` chunk found")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = wav_file.read(chunk_size)
+                (format_tag, channels, sample_rate, _, block_align,
+                 bits) = struct.unpack('<HHIIHH', fmt[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    format_tag = struct.unpack('<H', fmt[24:26])[0]
+                header['channels'] = channels
+                header['sample_rate'] = sample_rate
+                header['block_align'] = block_align
+                header.update(_get_sample_type(format_tag, bits))
+                if chunk_size % 2:
+                    wav_file.seek(1, 1)
+            elif chunk_id == b'data':
+                if 'channels' not in header:
+                    raise ValueError("`data` chunk before `fmt ` chunk")
+                header['data_offset'] = wav_file.tell()
+                wav_file.seek(0, 2)
+                available = wav_file.tell() - header['data_offset']
+                size = min(chunk_size, available)
+                header['frames'] = size // header['block_align']
+                return(header)
+            else:
+                wav_file.seek(chunk_size + chunk_size % 2, 1)
+
+
+def _get_sample_type(format_tag, bits):
+    if format_tag == WAVE_FORMAT_PCM:
+        if bits == 8:
+            return({'encoding': 'pcmu8', 'dtype': 'u1',
+                    'scale': 1.0 / 128, 'offset': 128})
+        if bits == 16:
+            return({'encoding': 'pcm16', 'dtype': '<i2',
+                    'scale': 1.0 / 2 ** 15, 'offset': 0})
+        if bits == 24:
+            return({'encoding': 'pcm24', 'dtype': 'u1',
+                    'scale': 1.0 / 2 ** 23, 'offset': 0})
+        if bits == 32:
+            return({'encoding': 'pcm32', 'dtype': '<i4',
+                    'scale': 1.0 / 2 ** 31, 'offset': 0})
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        if bits == 32:
+            return({'encoding': 'float32', 'dtype': '<f4',
+                    'scale': 1.0, 'offset': 0})
+        if bits == 64:
+            return({'encoding': 'float64', 'dtype': '<f8',
+                    'scale': 1.0, 'offset': 0})
+    raise ValueError(
+        "Unsupported WAV sample type " +
+        "(format tag {}, {} bits)".format(format_tag, bits)
+    )
+
+
+def _zeros(count, number_of_channels):
+    if number_of_channels == 1:
+        return(numpy.zeros(count))
+    return(numpy.zeros((count, number_of_channels)))
+
+
+def _clip_range(start, count, number_of_samples):
+    first = min(max(start, 0), number_of_samples)
+    last = max(min(start + count, number_of_samples), first)
+    return(first, last)
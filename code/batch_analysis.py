@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pairwise analysis of many audio files
+
+Functionality
+-------------
+- Cross-correlation between every pair of files in a
+  directory (or listed in a manifest) to identify the
+  time delay between each pair
+
+Inputs
+------
+- audio_files : str
+      Either a directory (every `.wav`, `.h5` and `.hdf5`
+      file in it is used), a glob pattern (quoted, so the
+      shell doesn't expand it)
+      or a manifest: a text file with one path per line
+      (empty lines and lines starting with `#` are ignored)
+
+Outputs
+-------
+- lag_matrix : CSV
+      One row per pair of files with the lag (in samples and
+      seconds), the peak and the normalized peak. It will be
+      stored with the name of the directory or manifest and
+      appending "_lags.csv" at the end
+
+Results are stored in the `./results/` directory
+
+Dependencies
+------------
+- scikits.audiolab (see `analysis.py`)
+
+Execution
+---------
+$ python ./code/batch_analysis.py ./audio/
+$ python ./code/batch_analysis.py ./audio/manifest.txt --max-lag-seconds 5
+$ python ./code/batch_analysis.py './audio/*_mic.wav'
+
+Notes
+-----
+- All files must be mono and have the same sample rate
+- Every file is read and transformed (real FFT) only once, at
+  a length common to all pairs, and its spectrum is reused for
+  every pair it appears in. Only one inverse FFT is computed
+  per pair, so for N files there are N forward FFTs instead
+  of N * (N - 1)
+- The lag between `one` and `two` is such that `one[n + lag]`
+  matches `two[n]` (see `Analysis.lag()`), so the matrix is
+  antisymmetric
+"""
+
+import os
+import sys
+import glob
+import argparse
+import numpy
+
+import audio_io
+import cache
+import correlators
+import parallel
+from analysis import Lag
+
+
+class BatchAnalysis(object):
+
+    def __init__(self, audio_files, max_lag_seconds=None, weighting=None,
+                 backend='sndfile', cache_directory=None,
+                 cache_max_bytes=cache.DEFAULT_CACHE_MAX_BYTES,
+                 workers=parallel.DEFAULT_WORKERS):
+        """Batch analysis
+
+        Inputs
+        ------
+        - audio_files : list of str
+        - max_lag_seconds : float or None
+              See `Analysis`
+        - weighting : str or None
+              See `Analysis`
+        - backend : str
+              See `Analysis`
+        - cache_directory : str or None
+              If given, every file's spectrum (and energy) is kept
+              there (see `cache.py`), so files that were already in
+              a previous batch with the same FFT size are neither
+              read nor transformed again
+        - cache_max_bytes : int
+              Size cap of the cache
+        - workers : int
+              Threads for the FFTs, see `parallel.py`
+        """
+        if len(audio_files) < 2:
+            raise ValueError("Needs at least two audio files")
+        self.audio_files = audio_files
+        self.max_lag_seconds = max_lag_seconds
+        self.backend = backend
+        self.workers = parallel.get_workers(workers)
+        if cache_directory is None:
+            self.cache = None
+        else:
+            self.cache = cache.Cache(cache_directory, cache_max_bytes)
+        self.weighting = weighting or 'none'
+        correlators.check_weighting(self.weighting)
+        self._read_audio_metadata()
+
+    def correlation(self):
+        """Correlation
+
+        Fills `self.lags`, a dictionary from each pair of indexes
+        `(i, j)` (with `i < j`) into `self.audio_files` to a `Lag`.
+        """
+        with parallel.fft_workers(self.workers):
+            self._compute_spectra()
+            self.lags = {}
+            for i in range(len(self.audio_files)):
+                for j in range(i + 1, len(self.audio_files)):
+                    self.lags[(i, j)] = self._pair_lag(i, j)
+
+    def get_matrix(self, field='seconds'):
+        """Get matrix
+
+        Inputs
+        ------
+        - field : str
+              Any of the fields in `Lag`
+
+        Outputs
+        -------
+        - matrix : numpy.ndarray
+              N x N, with lags negated below the diagonal
+        """
+        size = len(self.audio_files)
+        matrix = numpy.zeros((size, size))
+        for (i, j), lag in self.lags.items():
+            value = getattr(lag, field)
+            matrix[i, j] = value
+            if field in ('samples', 'sub_samples', 'seconds'):
+                matrix[j, i] = -value
+            else:
+                matrix[j, i] = value
+        if field == 'normalized_peak':
+            numpy.fill_diagonal(matrix, 1.0)
+        return(matrix)
+
+    def print_results(self):
+        names = [self._get_file_name(f) for f in self.audio_files]
+        print('*' * 70)
+        print('* Results (lag in seconds, row vs column)')
+        print('*' * 70)
+        width = max(len(name) for name in names)
+        for name, row in zip(names, self.get_matrix('seconds')):
+            print('{} {}'.format(
+                name.ljust(width),
+                ' '.join('{:+.6f}'.format(value) for value in row)
+            ))
+        print('*' * 70)
+
+    def save_results(self, csv_path):
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        with open(csv_path, 'w') as csv_file:
+            csv_file.write(
+                "file_one,file_two,samples,sub_samples,seconds," +
+                "peak,normalized_peak\n"
+            )
+            for (i, j), lag in sorted(self.lags.items()):
+                csv_file.write("{},{},{},{},{},{},{}\n".format(
+                    self.audio_files[i], self.audio_files[j],
+                    lag.samples, lag.sub_samples, lag.seconds,
+                    lag.peak, lag.normalized_peak
+                ))
+
+    def _read_audio_metadata(self):
+        self.audio_input_number_of_samples = []
+        sample_rates = set()
+        for audio_file in self.audio_files:
+            reader = audio_io.open_reader(audio_file, self.backend)
+            if int(reader.number_of_channels) != 1:
+                raise ValueError(
+                    "Batch analysis needs mono files " +
+                    "({} has {} channels)".format(
+                        audio_file, reader.number_of_channels
+                    )
+                )
+            sample_rates.add(int(reader.sample_rate))
+            self.audio_input_number_of_samples.append(
+                int(reader.number_of_samples)
+            )
+            reader.close()
+        if len(sample_rates) != 1:
+            raise ValueError(
+                "All files need the same sample rate " +
+                "(found: {})".format(sorted(sample_rates))
+            )
+        self.audio_input_sample_rate = sample_rates.pop()
+
+    def _compute_spectra(self):
+        """Compute spectra
+
+        One real FFT per file, all at the same size, which is
+        enough for the longest pair not to wrap around.
+        """
+        longest = max(self.audio_input_number_of_samples)
+        self.fft_size = correlators.correlation_fft_size(longest, longest)
+        self.spectra = []
+        self.energies = []
+        for audio_file in self.audio_files:
+            if self.cache is None:
+                spectrum, energy = self._compute_spectrum(audio_file)
+            else:
+                spectrum, energy = self._get_cached_spectrum(audio_file)
+            self.spectra.append(spectrum)
+            self.energies.append(energy)
+
+    def _compute_spectrum(self, audio_file):
+        import scipy.fft
+        reader = audio_io.open_reader(audio_file, self.backend)
+        data = reader.read_all()
+        reader.close()
+        return(
+            scipy.fft.rfft(data, self.fft_size),
+            float(numpy.sum(numpy.square(data)))
+        )
+
+    def _get_cached_spectrum(self, audio_file):
+        content_hash = cache.file_hash(audio_file)
+        spectrum_key = cache.make_key(
+            content_hash, 'rfft', self.fft_size, 'float64'
+        )
+        energy_key = cache.make_key(content_hash, 'energy')
+        spectrum = self.cache.get(spectrum_key)
+        energy = self.cache.get(energy_key)
+        if spectrum is None or energy is None:
+            spectrum, energy = self._compute_spectrum(audio_file)
+            self.cache.put(spectrum_key, spectrum)
+            self.cache.put(energy_key, numpy.array([energy]))
+            return(spectrum, energy)
+        return(spectrum, float(energy[0]))
+
+    def _pair_lag(self, i, j):
+        import scipy.fft
+        first_lag, number_of_lags = self._get_lag_window(i, j)
+        cross_spectrum = correlators.weighted_cross_spectrum(
+            self.spectra[i], self.spectra[j], self.weighting
+        )
+        correlation = correlators.circular_lag_window(
+            scipy.fft.irfft(cross_spectrum, self.fft_size),
+            first_lag,
+            number_of_lags
+        )
+        index = int(numpy.argmax(abs(correlation)))
+        offset = correlators.parabolic_peak_offset(correlation, index)
+        samples = first_lag + index
+        peak = float(correlation[index])
+        if self.weighting != 'none':
+            # The energies don't normalize a weighted peak
+            norm = float(correlators.cross_spectrum_norm(
+                cross_spectrum, self.fft_size
+            ))
+        else:
+            norm = float(numpy.sqrt(self.energies[i] * self.energies[j]))
+        if norm > 0:
+            normalized_peak = abs(peak) / norm
+        else:
+            normalized_peak = 0.0
+        return(Lag(
+            samples=samples,
+            sub_samples=samples + offset,
+            seconds=(samples + offset) / float(self.audio_input_sample_rate),
+            peak=peak,
+            normalized_peak=normalized_peak
+        ))
+
+    def _get_lag_window(self, i, j):
+        first_lag = -(self.audio_input_number_of_samples[j] - 1)
+        last_lag = self.audio_input_number_of_samples[i] - 1
+        if self.max_lag_seconds is not None:
+            max_lag = int(round(
+                float(self.max_lag_seconds) * self.audio_input_sample_rate
+            ))
+            first_lag = min(max(first_lag, -max_lag), last_lag)
+            last_lag = max(min(last_lag, max_lag), first_lag)
+        return(first_lag, last_lag - first_lag + 1)
+
+    def _get_file_name(self, audio_file):
+        return(audio_file.split("/")[-1].split(".")[0])
+
+
+def get_audio_files(path):
+    """Get audio files
+
+    Every `.wav` (or HDF5) file in `path` if it's a directory,
+    every file matching it if it's a glob pattern (e.g.
+    `./audio/*/*.wav`), or every path listed in it if it's
+    a manifest.
+    """
+    if os.path.isdir(path):
+        return(sorted(
+            audio_file
+            for extension in ('*.wav', '*.h5', '*.hdf5')
+            for audio_file in glob.glob(os.path.join(path, extension))
+        ))
+    if not os.path.isfile(path) and any(c in path for c in '*?['):
+        return(sorted(glob.glob(path)))
+    with open(path) as manifest:
+        return([
+            line.strip() for line in manifest
+            if line.strip() and not line.strip().startswith('#')
+        ])
+
+
+def main(argv):
+
+    if len(argv) < 1:
+        raise ValueError(
+            "Needs `audio_files` argument (see code instructions)"
+        )
+
+    arguments = _parse_arguments(argv)
+
+    batch_analysis = BatchAnalysis(
+        get_audio_files(arguments.audio_files),
+        max_lag_seconds=arguments.max_lag_seconds,
+        weighting=arguments.weighting,
+        backend=arguments.backend,
+        cache_directory=arguments.cache_directory,
+        cache_max_bytes=arguments.cache_max_megabytes * 1024 ** 2,
+        workers=arguments.workers
+    )
+
+    batch_analysis.correlation()
+    batch_analysis.print_results()
+    batch_analysis.save_results(
+        "./results/" +
+        os.path.basename(os.path.normpath(arguments.audio_files))
+        .split(".")[0] +
+        "_lags.csv"
+    )
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Pairwise cross-correlation of many audio files"
+    )
+    parser.add_argument('audio_files')
+    parser.add_argument(
+        '--max-lag-seconds', type=float, default=None,
+        help="Only search lags within plus/minus this many seconds"
+    )
+    parser.add_argument(
+        '--weighting', choices=correlators.WEIGHTINGS, default=None,
+        help="Generalized cross-correlation weighting"
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How audio files are read (`memmap` for uncompressed WAV)"
+    )
+    parser.add_argument(
+        '--cache-directory', default=None,
+        help="Keep every file's spectrum there for later batches"
+    )
+    parser.add_argument(
+        '--cache-max-megabytes', type=int,
+        default=cache.DEFAULT_CACHE_MAX_BYTES // 1024 ** 2,
+        help="Size cap of the cache (least recently used entries go first)"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=parallel.DEFAULT_WORKERS,
+        help="Threads for the FFTs (-1 for every core, see `parallel.py`)"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
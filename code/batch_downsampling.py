@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+"""
+Downsampling of many audio files
+
+Functionality
+-------------
+- Downsample every file in a directory, matching a glob
+  pattern or listed in a manifest, to a given rate
+- Spread the files over a pool of processes (one per core
+  by default), all of them started once for the whole batch.
+  When there are fewer files than cores, the cores left are
+  used as FFT threads within each process (see `parallel.py`)
+- Skip files whose output is already up to date
+- Print a summary table at the end
+
+Inputs
+------
+- audio_files : str
+      A directory, a glob pattern or a manifest (see
+      `batch_analysis.py`)
+- new_sample_rate : int
+      Should be a power of two
+
+Outputs
+-------
+- new_audio_files : WAV
+      One per input file, named as `downsampling.py` names
+      them, in the `./results/` directory
+
+Execution
+---------
+$ python ./code/batch_downsampling.py ./audio/ 8192
+$ python ./code/batch_downsampling.py './audio/*/*.wav' 8192 \
+         --engine polyphase --stream --workers 8
+$ python ./code/batch_downsampling.py ./audio/manifest.txt 8192 --force
+
+Notes
+-----
+- An output is up to date if it exists, is newer than its
+  input and was made with the same settings (rate, engine and
+  filter), which are stored next to it in a JSON file with the
+  same name. Use `--force` to downsample every file anyway
+- Outputs are written to a temporary file first and only moved
+  to their name once complete, so a worker killed halfway
+  doesn't leave a truncated output that looks up to date
+- No graphs are made and nothing is printed per file, other
+  than the summary table
+- Files that fail don't stop the batch, they show up as
+  `failed` (with the reason) in the summary table, and the
+  exit status is non-zero. That includes files whose worker
+  process died (e.g. killed for running out of memory)
+- Input file names must be unique within a batch, since outputs
+  are named after the file name alone (see `downsampling.py`)
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+
+import audio_io
+import cache
+import downsampling
+import parallel
+from batch_analysis import get_audio_files
+
+
+class BatchDownsample(object):
+
+    def __init__(self, audio_files, new_sample_rate, workers=None,
+                 force=False, **downsample_options):
+        """Batch downsample
+
+        Inputs
+        ------
+        - audio_files : list of str
+        - new_sample_rate : str
+        - workers : int or None
+              Thread budget (every core if None), split between
+              processes and FFT threads within each process (see
+              `parallel.split_budget()`)
+        - force : bool
+              Downsample files even if their output is up to date
+        - downsample_options
+              Passed on to `Downsample` (`engine`, `block_size`,
+              `filter_window`, `filter_half_length`, `stream`,
+              `backend`, `cache_directory`, `cache_max_bytes`)
+        """
+        self._check_unique_names(audio_files)
+        self.audio_files = audio_files
+        self.new_sample_rate = new_sample_rate
+        if workers is None:
+            self.workers = parallel.cpu_count()
+        else:
+            self.workers = parallel.get_workers(workers)
+        self.force = force
+        self.downsample_options = downsample_options
+
+    def downsample(self):
+        """Downsample
+
+        Fills `self.results`, one `(audio_file, status, seconds,
+        message)` per file (in the order of `self.audio_files`),
+        where `status` is 'done', 'skipped' or 'failed'.
+        """
+        os.makedirs("./results/", exist_ok=True)
+        results = {}
+        pending = []
+        for audio_file in self.audio_files:
+            if not self.force and self._is_up_to_date(audio_file):
+                results[audio_file] = (audio_file, 'skipped', 0.0, '')
+            else:
+                pending.append(audio_file)
+        if pending:
+            processes, threads = parallel.split_budget(
+                self.workers, len(pending)
+            )
+            downsample_options = dict(self.downsample_options, workers=threads)
+            parallel.import_heavy_modules()
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=processes,
+                    initializer=parallel.import_heavy_modules) as executor:
+                futures = {
+                    executor.submit(
+                        _downsample_file, audio_file, self.new_sample_rate,
+                        downsample_options
+                    ): audio_file
+                    for audio_file in pending
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    audio_file = futures[future]
+                    try:
+                        results[audio_file] = future.result()
+                    except Exception as e:
+                        # The worker died (`BrokenProcessPool`) or
+                        # couldn't return its result
+                        message = ' '.join(
+                            (str(e) or type(e).__name__).split()
+                        )
+                        results[audio_file] = (
+                            audio_file, 'failed', 0.0, message
+                        )
+        self.results = [results[f] for f in self.audio_files]
+
+    def print_results(self):
+        width = max(len(audio_file) for audio_file, _, _, _ in self.results)
+        print('*' * 70)
+        print('* Results (downsampled to {})'.format(self.new_sample_rate))
+        print('*' * 70)
+        for audio_file, status, seconds, message in self.results:
+            print('{} {} {:9.3f}s {}'.format(
+                audio_file.ljust(width), status.ljust(7), seconds, message
+            ))
+        print('*' * 70)
+        for status in ('done', 'skipped', 'failed'):
+            print('{}: {}'.format(status.capitalize(), self._count(status)))
+        print('Seconds (summed over workers): {:.3f}'.format(
+            sum(seconds for _, _, seconds, _ in self.results)
+        ))
+        print('*' * 70)
+
+    def number_of_failures(self):
+        return(self._count('failed'))
+
+    def _count(self, status):
+        return(sum(1 for result in self.results if result[1] == status))
+
+    def _is_up_to_date(self, audio_file):
+        output_file = downsampling.get_audio_output_file(
+            audio_file, self.new_sample_rate
+        )
+        if not (os.path.exists(output_file) and
+                os.path.getmtime(output_file) >= os.path.getmtime(audio_file)):
+            return(False)
+        try:
+            with open(_get_settings_file(output_file)) as settings_file:
+                settings = json.load(settings_file)
+        except (IOError, ValueError):
+            return(False)
+        return(settings == _get_settings(
+            self.new_sample_rate, self.downsample_options
+        ))
+
+    def _check_unique_names(self, audio_files):
+        seen = {}
+        for audio_file in audio_files:
+            output_file = downsampling.get_audio_output_file(audio_file, '')
+            if output_file in seen:
+                raise ValueError(
+                    "Both {} and {} ".format(seen[output_file], audio_file) +
+                    "would be written to the same output file"
+                )
+            seen[output_file] = audio_file
+
+
+def _downsample_file(audio_file, new_sample_rate, downsample_options):
+    """Downsample file
+
+    Runs in the worker processes. Never raises, so one bad
+    file doesn't take the rest of the batch down with it.
+
+    The output is written to a temporary file and moved to its
+    name once complete, and its settings file is removed before
+    and written after, so neither a truncated output nor one
+    made with other settings is ever taken as up to date.
+    """
+    start = time.time()
+    output_file = downsampling.get_audio_output_file(
+        audio_file, new_sample_rate
+    )
+    root, extension = os.path.splitext(output_file)
+    temporary_file = root + '.tmp' + extension
+    settings_file = _get_settings_file(output_file)
+    try:
+        downsample = downsampling.Downsample(
+            audio_file, new_sample_rate, **downsample_options
+        )
+        downsample.audio_output_file = temporary_file
+        downsample.downsample()
+        if os.path.exists(settings_file):
+            os.remove(settings_file)
+        os.replace(temporary_file, output_file)
+        _write_settings(
+            settings_file, _get_settings(new_sample_rate, downsample_options)
+        )
+    except Exception as e:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        message = ' '.join(str(e).split())
+        return((audio_file, 'failed', time.time() - start, message))
+    return((audio_file, 'done', time.time() - start, ''))
+
+
+def _get_settings(new_sample_rate, downsample_options):
+    """Get settings
+
+    The options that change the output of `Downsample` (the
+    filter only matters to the polyphase engine), as they read
+    back from JSON.
+    """
+    engine = downsample_options.get('engine', 'fft')
+    settings = {'new_sample_rate': str(new_sample_rate), 'engine': engine}
+    if engine == 'polyphase':
+        settings['filter_window'] = downsample_options.get(
+            'filter_window', downsampling.DEFAULT_FILTER_WINDOW
+        )
+        settings['filter_half_length'] = downsample_options.get(
+            'filter_half_length', downsampling.DEFAULT_FILTER_HALF_LENGTH
+        )
+    return(json.loads(json.dumps(settings)))
+
+
+def _get_settings_file(output_file):
+    return(os.path.splitext(output_file)[0] + '.json')
+
+
+def _write_settings(settings_file, settings):
+    temporary_file = settings_file + '.tmp'
+    with open(temporary_file, 'w') as output:
+        json.dump(settings, output, sort_keys=True)
+    os.replace(temporary_file, settings_file)
+
+
+def main(argv):
+
+    if len(argv) < 2:
+        raise ValueError(
+            "Needs `audio_files` and `new_sample_rate` " +
+            "arguments (see code instructions)"
+        )
+
+    arguments = _parse_arguments(argv)
+
+    batch_downsample = BatchDownsample(
+        get_audio_files(arguments.audio_files),
+        arguments.new_sample_rate,
+        workers=arguments.workers,
+        force=arguments.force,
+        engine=arguments.engine,
+        block_size=arguments.block_size,
+        filter_window=arguments.filter_window,
+        filter_half_length=arguments.filter_half_length,
+        stream=arguments.stream,
+        backend=arguments.backend,
+        cache_directory=arguments.cache_directory,
+        cache_max_bytes=arguments.cache_max_megabytes * 1024 ** 2
+    )
+
+    batch_downsample.downsample()
+    batch_downsample.print_results()
+    if batch_downsample.number_of_failures() > 0:
+        return(1)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Downsample many audio files to a given rate"
+    )
+    parser.add_argument('audio_files')
+    parser.add_argument('new_sample_rate')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help="Thread budget, split between processes and FFT threads " +
+             "(every core by default)"
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help="Downsample files even if their output is up to date"
+    )
+    parser.add_argument(
+        '--engine', choices=downsampling.ENGINES, default='fft',
+        help="Resampling engine"
+    )
+    parser.add_argument(
+        '--block-size', type=int, default=downsampling.DEFAULT_BLOCK_SIZE,
+        help="Frames per block (polyphase engine only)"
+    )
+    parser.add_argument(
+        '--filter-window', type=downsampling.parse_window,
+        default=downsampling.DEFAULT_FILTER_WINDOW,
+        help="Anti-alias filter window, e.g. `hamming` or `kaiser,5.0` " +
+             "(polyphase engine only)"
+    )
+    parser.add_argument(
+        '--filter-half-length', type=int,
+        default=downsampling.DEFAULT_FILTER_HALF_LENGTH,
+        help="Anti-alias filter half length, in multiples of the " +
+             "largest resampling factor (polyphase engine only)"
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="Read, resample and write block by block without loading " +
+             "the files into memory (polyphase engine only)"
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How the inputs are read (`memmap` for uncompressed WAV)"
+    )
+    parser.add_argument(
+        '--cache-directory', default=None,
+        help="Keep the downsampled signals there for later runs"
+    )
+    parser.add_argument(
+        '--cache-max-megabytes', type=int,
+        default=cache.DEFAULT_CACHE_MAX_BYTES // 1024 ** 2,
+        help="Size cap of the cache (least recently used entries go first)"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks
+
+Functionality
+-------------
+- Generate synthetic recordings (see `synthetic.py`): white
+  noise, chirps and noise with a known delay at several
+  signal to noise ratios, lengths, channel counts and sample
+  rates
+- Time, for every one of them:
+    - write: writing both WAV files
+    - read: opening and reading them (`Analysis(...)`)
+    - read_memmap: reading them with the memmap backend
+    - correlation: `Analysis.correlation()`
+    - print_results: `Analysis.print_results()`
+    - downsample: `Downsample._perform_downsample()`
+- Report throughput (input frames per second) and how far the
+  peak resident memory has grown over the case's baseline after
+  every step
+- Save everything as JSON, and compare against a previous
+  JSON to spot regressions across versions
+
+Outputs
+-------
+- benchmark : JSON
+      Stored in `./results/` as `benchmark_<timestamp>.json`
+      (or wherever `--output` says)
+
+Execution
+---------
+$ python ./code/benchmark.py
+$ python ./code/benchmark.py --lengths 60 600 --channels 1 4 \
+         --sample-rates 8192 44100 --snr-db 20 0
+$ python ./code/benchmark.py --compare ./results/benchmark_old.json
+
+Options for `Analysis` (`--max-lag-seconds`, `--block-size`,
+`--weighting`, `--precision`, `--workers`) and `Downsample`
+(`--engine`, `--workers`) are passed on, so different
+configurations can be benchmarked on the same cases.
+
+Notes
+-----
+- Every case runs in a fresh process, so the peak memory of
+  one case doesn't hide the next one's. `ru_maxrss` is the peak
+  of the whole process (interpreter and imports included) and
+  never goes down, so it's kept as `process_peak_rss_kb`, and
+  what's reported is its growth over `baseline_rss_kb`, taken
+  once the modules are imported and before generating the
+  signals (`peak_rss_above_baseline_kb`): the memory the case
+  itself needed, up to that step
+- Every step is run `--repeat` times and the best time is kept.
+  Modules the scripts import lazily are imported before timing
+  anything (import time is what `check_startup_time.py` is for)
+- Signals are generated from `--seed`, so runs are
+  reproducible; files go to a temporary directory that is
+  removed at the end
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import contextlib
+import multiprocessing
+
+import numpy
+
+import parallel
+import synthetic
+
+#
+# Signals benchmarked: the kinds in `synthetic.SIGNALS`, and
+# `delayed` (noise delayed by `DELAY_SECONDS` with noise added
+# at each of the `--snr-db` ratios)
+#
+KINDS = ('noise', 'chirp', 'delayed')
+
+DELAY_SECONDS = 0.25
+
+STEPS = (
+    'write',
+    'read',
+    'read_memmap',
+    'correlation',
+    'print_results',
+    'downsample',
+)
+
+
+def get_cases(kinds, lengths, channels, sample_rates, snrs_db):
+    """Get cases
+
+    Every combination of the options, as dictionaries. SNRs only
+    apply to `delayed` signals (the others are noiseless).
+    """
+    cases = []
+    for kind, length, number_of_channels, sample_rate in itertools.product(
+            kinds, lengths, channels, sample_rates):
+        for snr_db in (snrs_db if kind == 'delayed' else [None]):
+            cases.append({
+                'kind': kind,
+                'seconds': length,
+                'channels': number_of_channels,
+                'sample_rate': sample_rate,
+                'snr_db': snr_db,
+            })
+    return(cases)
+
+
+def run_case(case, options):
+    """Run case
+
+    Outputs
+    -------
+    - result : dict
+          `case`, and for every step of `STEPS` its time
+          (`seconds`), throughput (`frames_per_second`) and
+          peak memory (`peak_rss_above_baseline_kb` and
+          `process_peak_rss_kb`)
+    """
+    import analysis
+    import audio_io
+    import downsampling
+    parallel.import_heavy_modules()
+    result = dict(case)
+    result['baseline_rss_kb'] = _peak_rss_kb()
+    result['steps'] = {}
+    number_of_samples = int(case['seconds'] * case['sample_rate'])
+    directory = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        one, two = _make_pair(case, number_of_samples, options['seed'])
+        files = [
+            os.path.join(directory, 'one.wav'),
+            os.path.join(directory, 'two.wav')
+        ]
+        frames = 2 * number_of_samples
+
+        def write():
+            synthetic.write_wav(files[0], one, case['sample_rate'])
+            synthetic.write_wav(files[1], two, case['sample_rate'])
+
+        def read(backend='sndfile'):
+            return(analysis.Analysis(
+                files[0], files[1],
+                block_size=options['block_size'],
+                max_lag_seconds=options['max_lag_seconds'],
+                weighting=options['weighting'],
+                backend=backend,
+                precision=options['precision'],
+                workers=options['workers']
+            ))
+
+        def read_memmap():
+            for audio_file in files:
+                reader = audio_io.open_reader(audio_file, 'memmap')
+                reader.read_all()
+                reader.close()
+
+        _time_step(result, 'write', write, frames, options['repeat'])
+        _time_step(result, 'read', read, frames, options['repeat'])
+        _time_step(
+            result, 'read_memmap', read_memmap, frames, options['repeat']
+        )
+        # Every correlation runs on a fresh `Analysis` (not timed),
+        # since `correlation()` replaces the method with its result
+        _time_step(
+            result, 'correlation',
+            lambda instance: instance.correlation(),
+            frames, options['repeat'], setup=read
+        )
+        correlated = read()
+        correlated.correlation()
+        _time_step(
+            result, 'print_results',
+            lambda: _quietly(correlated.print_results),
+            frames, options['repeat']
+        )
+        if int(options['new_sample_rate']) <= case['sample_rate']:
+            downsample = downsampling.Downsample(
+                files[0], str(options['new_sample_rate']),
+                engine=options['engine'],
+                workers=options['workers']
+            )
+            _time_step(
+                result, 'downsample', downsample._perform_downsample,
+                number_of_samples, options['repeat']
+            )
+        if case['kind'] == 'delayed':
+            lag = correlated.lag()
+            result['expected_lag_seconds'] = DELAY_SECONDS
+            result['estimated_lag_seconds'] = lag.seconds
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return(result)
+
+
+def run(cases, options):
+    """Run
+
+    Every case in its own (fresh) process, one after the other.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for case in cases:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_case, (case, options)))
+        _print_result(results[-1])
+    return({
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'results': results,
+    })
+
+
+def compare(old, new):
+    """Compare
+
+    Prints, for every case and step in both benchmarks, the new
+    time over the old one (above 1 is slower).
+    """
+    old_results = {_case_key(result): result for result in old['results']}
+    print('*' * 70)
+    print('* New time / old time ({} vs {})'.format(
+        new['timestamp'], old['timestamp']
+    ))
+    print('*' * 70)
+    for result in new['results']:
+        key = _case_key(result)
+        if key not in old_results:
+            continue
+        ratios = []
+        for step in STEPS:
+            old_step = old_results[key]['steps'].get(step)
+            new_step = result['steps'].get(step)
+            if old_step and new_step and old_step['seconds'] > 0:
+                ratios.append('{} {:.2f}'.format(
+                    step, new_step['seconds'] / old_step['seconds']
+                ))
+        print('{}: {}'.format(_case_name(result), ', '.join(ratios)))
+    print('*' * 70)
+
+
+def _make_pair(case, number_of_samples, seed):
+    if case['kind'] == 'delayed':
+        data = synthetic.white_noise(
+            number_of_samples, case['channels'], seed
+        )
+        return(synthetic.delayed_pair(
+            data, DELAY_SECONDS * case['sample_rate'], case['snr_db'], seed
+        ))
+    data = synthetic.make_signal(
+        case['kind'], number_of_samples, case['sample_rate'],
+        case['channels'], seed
+    )
+    return(data, data)
+
+
+def _time_step(result, step, function, frames, repeat, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            function()
+        else:
+            argument = setup()
+            start = time.perf_counter()
+            function(argument)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    peak = _peak_rss_kb()
+    result['steps'][step] = {
+        'seconds': best,
+        'frames_per_second': frames / best if best > 0 else None,
+        'peak_rss_above_baseline_kb': peak - result['baseline_rss_kb'],
+        'process_peak_rss_kb': peak,
+    }
+
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on macOS, kilobytes everywhere else
+        peak //= 1024
+    return(peak)
+
+
+def _quietly(function):
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+
+
+def _case_key(result):
+    return((
+        result['kind'], result['seconds'], result['channels'],
+        result['sample_rate'], result['snr_db']
+    ))
+
+
+def _case_name(result):
+    name = '{} {}s {}ch {}Hz'.format(
+        result['kind'], result['seconds'], result['channels'],
+        result['sample_rate']
+    )
+    if result['snr_db'] is not None:
+        name += ' {}dB'.format(result['snr_db'])
+    return(name)
+
+
+def _print_result(result):
+    print('*' * 70)
+    print('* {}'.format(_case_name(result)))
+    print('*' * 70)
+    print('Baseline: {} KB (process peak RSS before the case)'.format(
+        result['baseline_rss_kb']
+    ))
+    for step in STEPS:
+        if step not in result['steps']:
+            continue
+        values = result['steps'][step]
+        print('{} {:9.4f}s {:14.0f} frames/s {:9d} KB over baseline'.format(
+            step.ljust(13),
+            values['seconds'],
+            values['frames_per_second'] or 0,
+            values['peak_rss_above_baseline_kb']
+        ))
+    if 'estimated_lag_seconds' in result:
+        print('Lag: {} seconds (expected {})'.format(
+            result['estimated_lag_seconds'], result['expected_lag_seconds']
+        ))
+
+
+def main(argv):
+
+    arguments = _parse_arguments(argv)
+
+    cases = get_cases(
+        arguments.kinds, arguments.lengths, arguments.channels,
+        arguments.sample_rates, arguments.snr_db
+    )
+    options = {
+        'seed': arguments.seed,
+        'repeat': arguments.repeat,
+        'block_size': arguments.block_size,
+        'max_lag_seconds': arguments.max_lag_seconds,
+        'weighting': arguments.weighting,
+        'precision': arguments.precision,
+        'workers': arguments.workers,
+        'engine': arguments.engine,
+        'new_sample_rate': arguments.new_sample_rate,
+    }
+    benchmark = run(cases, options)
+
+    output = arguments.output or (
+        "./results/benchmark_" +
+        benchmark['timestamp'].replace(':', '').replace('-', '') +
+        ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as json_file:
+        json.dump(benchmark, json_file, indent=2)
+    print("Saved: {}".format(output))
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as json_file:
+            compare(json.load(json_file), benchmark)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scripts on synthetic signals"
+    )
+    parser.add_argument(
+        '--kinds', nargs='+', choices=KINDS, default=list(KINDS),
+        help="Signals to generate"
+    )
+    parser.add_argument(
+        '--lengths', type=float, nargs='+', default=[10.0, 60.0],
+        help="Signal lengths, in seconds"
+    )
+    parser.add_argument(
+        '--channels', type=int, nargs='+', default=[1, 2],
+        help="Channel counts"
+    )
+    parser.add_argument(
+        '--sample-rates', type=int, nargs='+', default=[8192, 44100],
+        help="Sample rates"
+    )
+    parser.add_argument(
+        '--snr-db', type=float, nargs='+', default=[20.0, 0.0],
+        help="Signal to noise ratios of the delayed signals, in dB"
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="Runs of every step (the best one counts)"
+    )
+    parser.add_argument('--block-size', type=int, default=None)
+    parser.add_argument('--max-lag-seconds', type=float, default=None)
+    parser.add_argument('--weighting', default=None)
+    parser.add_argument('--precision', default='float64')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', default='fft')
+    parser.add_argument(
+        '--new-sample-rate', type=int, default=2048,
+        help="Rate the first file of every case is downsampled to"
+    )
+    parser.add_argument(
+        '--output', default=None,
+        help="JSON file to save the results to"
+    )
+    parser.add_argument(
+        '--compare', default=None,
+        help="JSON file of a previous run to compare against"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
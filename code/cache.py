@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of intermediate results
+
+Functionality
+-------------
+- Store arrays that are expensive to recompute (downsampled
+  signals, real FFTs) under a key derived from the content of
+  the input file and every setting that affects the result
+- Keep the cache under a size cap, evicting the least recently
+  used entries first
+
+Keys
+----
+Keys are built with `make_key()` from any number of parts,
+usually `file_hash(audio_file)`, the kind of result, and the
+settings (sample rates, resampling engine and filter, FFT
+size, ...). Two runs only share an entry if all of those are
+the same, so renaming or moving a file keeps its entries, and
+changing its content invalidates them.
+
+Layout
+------
+Every entry is a `.npy` file named after its key, in the cache
+directory (`./results/cache/` by default). Reading an entry
+updates its modification time, which is what eviction uses.
+Entries are written to a temporary file of their own (unique
+to every write, since processes of a pool may fill the same key
+at once) and then moved to their name, so an entry is either
+complete or missing.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy
+
+DEFAULT_CACHE_DIRECTORY = './results/cache/'
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+#
+# Bytes read at a time when hashing files
+#
+HASH_BLOCK_BYTES = 1024 ** 2
+
+_file_hashes = {}
+
+
+class Cache(object):
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        """Cache
+
+        Inputs
+        ------
+        - directory : str
+        - max_bytes : int
+              Entries are evicted (least recently used first)
+              when the cache grows over this size
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            array = numpy.load(path)
+        except (IOError, OSError, ValueError):
+            return(None)
+        os.utime(path, None)
+        return(array)
+
+    def put(self, key, array):
+        path = self._get_path(key)
+        handle, temporary_path = tempfile.mkstemp(
+            dir=self.directory, prefix=key + '.', suffix='.tmp.npy'
+        )
+        try:
+            with os.fdopen(handle, 'wb') as temporary_file:
+                numpy.save(temporary_file, array)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self._evict()
+
+    def get_or_compute(self, key, compute):
+        """Get or compute
+
+        Returns the entry for `key`, or calls `compute()`,
+        stores what it returns and returns it.
+        """
+        array = self.get(key)
+        if array is None:
+            array = compute()
+            self.put(key, array)
+        return(array)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy') or name.endswith('.tmp.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _get_path(self, key):
+        return(os.path.join(self.directory, key + '.npy'))
+
+
+def make_key(*parts):
+    return(hashlib.sha256(
+        '|'.join(repr(part) for part in parts).encode('utf-8')
+    ).hexdigest())
+
+
+def file_hash(audio_file):
+    """File hash
+
+    SHA-256 of the content of the file. Remembered for the rest
+    of the process as long as the file's size and modification
+    time don't change, so each file is hashed once per run.
+    """
+    status = os.stat(audio_file)
+    memo_key = (os.path.abspath(audio_file), status.st_size, status.st_mtime)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(audio_file, 'rb') as content:
+            for block in iter(lambda: content.read(HASH_BLOCK_BYTES), b''):
+                digest.update(block)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return(_file_hashes[memo_key])
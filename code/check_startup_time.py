@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+Startup time check
+
+Functionality
+-------------
+- Measure how long it takes to import every script, each in
+  a fresh interpreter (what a batch wrapper calling the
+  scripts thousands of times pays on every call)
+- Fail if any of them is over the target, or if importing it
+  loads any of the heavy modules, which should only be loaded
+  by the code paths that use them
+
+Outputs
+-------
+- A table with the import time of every script (the best of
+  `--repeat` runs) and any heavy module it loaded
+- The exit status is non-zero if any script fails the check
+
+Execution
+---------
+$ python ./code/check_startup_time.py
+$ python ./code/check_startup_time.py --max-seconds 0.25 --repeat 10
+
+Notes
+-----
+- The target (`STARTUP_TIME_TARGET_SECONDS`) was measured at
+  around 0.13 seconds per script, almost all of it importing
+  numpy, against 1.7 to 2 seconds when scipy.signal,
+  scikits.audiolab and matplotlib (pyplot) were imported
+  unconditionally. It leaves room for slower machines; the
+  heavy modules check doesn't depend on the machine at all
+- Interpreter startup itself isn't measured, only the import
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+SCRIPTS = (
+    'analysis',
+    'batch_analysis',
+    'batch_downsampling',
+    'downsampling',
+    'drift',
+    'hdf5_wav_translator',
+    'search',
+    'tracking',
+)
+
+#
+# Modules that no script should import just to start
+#
+HEAVY_MODULES = (
+    'scipy',
+    'matplotlib',
+    'scikits.audiolab',
+    'h5py',
+)
+
+STARTUP_TIME_TARGET_SECONDS = 0.4
+
+_MEASURE = """
+import sys
+import json
+import time
+start = time.perf_counter()
+import {script}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'heavy_modules': [m for m in {heavy_modules!r} if m in sys.modules]
+}}))
+"""
+
+
+def measure(script, repeat):
+    """Measure
+
+    Outputs
+    -------
+    - seconds : float
+          Best import time of `repeat` fresh interpreters
+    - heavy_modules : list of str
+          Heavy modules loaded by importing `script`
+    """
+    code_directory = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [code_directory] +
+        [p for p in [environment.get('PYTHONPATH')] if p]
+    )
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _MEASURE.format(
+                script=script, heavy_modules=HEAVY_MODULES
+            )],
+            env=environment
+        )
+        results.append(json.loads(output.decode('utf-8')))
+    return(
+        min(result['seconds'] for result in results),
+        results[0]['heavy_modules']
+    )
+
+
+def main(argv):
+
+    arguments = _parse_arguments(argv)
+
+    failures = 0
+    print('*' * 70)
+    print('* Startup time (target: {:.3f} seconds)'.format(
+        arguments.max_seconds
+    ))
+    print('*' * 70)
+    width = max(len(script) for script in SCRIPTS)
+    for script in SCRIPTS:
+        seconds, heavy_modules = measure(script, arguments.repeat)
+        failed = seconds > arguments.max_seconds or bool(heavy_modules)
+        failures += int(failed)
+        print('{} {:.3f}s {} {}'.format(
+            script.ljust(width),
+            seconds,
+            'FAIL' if failed else 'ok  ',
+            ', '.join(heavy_modules)
+        ))
+    print('*' * 70)
+    if failures > 0:
+        return(1)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the import time of every script"
+    )
+    parser.add_argument(
+        '--max-seconds', type=float, default=STARTUP_TIME_TARGET_SECONDS,
+        help="Import time target, in seconds"
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help="Fresh interpreters per script (the best one counts)"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
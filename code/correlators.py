@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+
+"""
+Correlation engines
+
+Functionality
+-------------
+- Block-wise (streaming) cross-correlation with memory
+  bounded by the block size and the number of lags
+- Direct (non-FFT) correlation when only a few lags
+  are requested
+- Sub-sample peak location by parabolic interpolation
+- Generalized cross-correlation (GCC) with frequency
+  weightings: PHAT, SCOT, Roth and ML/HT
+- Multi-channel correlation of many channel pairs at once,
+  with the FFTs batched over the channel axis
+- Full correlation in memory through real FFTs of a fast
+  length, in double or single precision (see `PRECISIONS`)
+- Autocorrelation (a signal against itself) from a single
+  forward FFT and its power spectrum
+- The lag of every index of a correlation (its lag axis)
+
+Conventions
+-----------
+All engines compute, for every lag `k` requested:
+
+    correlation[k] = sum_n one[n + k] * two[n]
+
+which is `scipy.signal.fftconvolve(one, two[::-1], 'full')`
+with lag `k` at index `k + len(two) - 1`.
+
+Readers are the ones from `audio_io.py`.
+"""
+
+import numpy
+
+#
+# Below this many lags per block, `numpy.correlate` is
+# cheaper than going through the FFT.
+#
+DIRECT_CORRELATION_MAX_LAGS = 64
+
+#
+# Minimum block size used when blocks are sized to the
+# window of lags (see `window_block_size()`).
+#
+MIN_WINDOW_BLOCK_SIZE = 4096
+
+#
+# Available weightings for `generalized_correlation()`.
+#
+WEIGHTINGS = ('none', 'phat', 'scot', 'roth', 'ht')
+
+#
+# Width (in frequency bins) of the moving average used to
+# estimate the power spectra for SCOT, Roth and ML/HT. With
+# no smoothing, SCOT would be identical to PHAT and the
+# ML/HT coherence would be exactly one everywhere.
+#
+GCC_SMOOTHING_BINS = 9
+
+#
+# Floor of the spectra the GCC weightings divide by, relative to
+# the largest bin of each channel (see `_regularize()`). On
+# band-limited signals the empty bins only hold rounding residue;
+# with a much lower floor (it was 1e-12), PHAT, SCOT and ML/HT
+# amplify that residue until it takes over the peak (a chirp
+# delayed by 37 samples peaked at lag -1). With 1e-3, bins more
+# than 60 dB below the strongest one are weighted as if they
+# were at that level.
+#
+GCC_REGULARIZATION = 1e-3
+
+#
+# Precisions of the in-memory FFT engines (`fft_correlation()`,
+# `multichannel_correlation()`): the dtype the signals are
+# transformed in. With 'float32', the FFTs move half the bytes
+# and take about 0.6 times as long, and the correlation has a
+# relative error (to its peak) around 1e-7 instead of 1e-16,
+# so the peak is only misplaced if another lag is within that
+# much of it; measured on noise up to a few million samples.
+#
+PRECISIONS = ('float64', 'float32')
+
+#
+# Lags where the two signals overlap by less than this fraction
+# of the shorter one are set to zero by `normalize_correlation()`.
+# Normalizing by the energy of the overlap makes the lags at the
+# very edges (a few samples of overlap) close to one whatever the
+# signals are; with at least a tenth of a signal of N samples
+# overlapping, unrelated signals stay around 1 / sqrt(N / 10).
+#
+NORMALIZED_MIN_OVERLAP = 0.1
+
+
+def stream_correlation(reader_one, reader_two, first_lag, number_of_lags,
+                       block_size, pairs=None):
+    """Stream correlation
+
+    Inputs
+    ------
+    - reader_one : audio_io reader
+    - reader_two : audio_io reader
+    - first_lag : int
+          Lag of the first correlation value returned
+    - number_of_lags : int
+          Number of consecutive lags to compute
+    - block_size : int
+          Frames of `reader_two` read per step. At most
+          this many lags are computed per step as well.
+    - pairs : list of (int, int) or None
+          Channel of `one` and channel of `two` for every
+          correlation to compute, for multi-channel readers
+          (None for mono ones)
+
+    Outputs
+    -------
+    - correlation : numpy.ndarray
+          One value per lag, starting at `first_lag` (lags x
+          pairs with `pairs`)
+
+    Overlap-save in the lag domain: every block of `two` is
+    correlated against the segment of `one` it overlaps for the
+    lags requested, using `fftconvolve` in `valid` mode (or
+    `numpy.correlate` when there are only a few lags), and the
+    partial results are accumulated. Peak memory is one block
+    of `two`, one segment of `one` (block plus lags) and the
+    output itself. With `pairs`, every block and segment is read
+    once, with all of its channels, and shared by the pairs.
+    """
+    if pairs is None:
+        correlation = numpy.zeros(number_of_lags)
+    else:
+        correlation = numpy.zeros((number_of_lags, len(pairs)))
+    length_one = reader_one.number_of_samples
+    length_two = reader_two.number_of_samples
+    for lag_offset in range(0, number_of_lags, block_size):
+        lag_count = min(block_size, number_of_lags - lag_offset)
+        lag = first_lag + lag_offset
+        for start in range(0, length_two, block_size):
+            count = min(block_size, length_two - start)
+            segment_start = start + lag
+            segment_count = count + lag_count - 1
+            if (segment_start >= length_one or
+                    segment_start + segment_count <= 0):
+                continue
+            block = reader_two.read(start, count)
+            segment = reader_one.read(segment_start, segment_count)
+            if pairs is None:
+                correlation[lag_offset:lag_offset + lag_count] += (
+                    correlate_valid(segment, block)
+                )
+                continue
+            block = numpy.reshape(block, (count, -1))
+            segment = numpy.reshape(segment, (segment_count, -1))
+            for pair, (channel_one, channel_two) in enumerate(pairs):
+                correlation[lag_offset:lag_offset + lag_count, pair] += (
+                    correlate_valid(
+                        segment[:, channel_one], block[:, channel_two]
+                    )
+                )
+    return(correlation)
+
+
+def energy(reader, block_size):
+    """Energy
+
+    Sum of squares of all the frames in `reader`,
+    read `block_size` frames at a time.
+    """
+    total = 0.0
+    for start in range(0, reader.number_of_samples, block_size):
+        block = reader.read(
+            start, min(block_size, reader.number_of_samples - start)
+        )
+        total += float(numpy.sum(numpy.square(block)))
+    return(total)
+
+
+def cumulative_energy(reader, indexes, block_size):
+    """Cumulative energy
+
+    Sum of squares of the first `i` frames of `reader`, for every
+    `i` in `indexes` (from zero to the number of frames, in any
+    order). The reader is read once, `block_size` frames at a
+    time, so memory is one block and the output.
+    """
+    indexes = numpy.asarray(indexes, dtype=numpy.int64)
+    order = numpy.argsort(indexes, kind='stable')
+    sorted_indexes = indexes[order]
+    energies = numpy.zeros(len(indexes))
+    total = 0.0
+    for start in range(0, reader.number_of_samples, block_size):
+        count = min(block_size, reader.number_of_samples - start)
+        sums = numpy.zeros(count + 1)
+        numpy.cumsum(numpy.square(reader.read(start, count)), out=sums[1:])
+        sums += total
+        first, last = numpy.searchsorted(
+            sorted_indexes, [start, start + count]
+        )
+        energies[order[first:last]] = sums[sorted_indexes[first:last] - start]
+        total = sums[-1]
+    energies[order[numpy.searchsorted(
+        sorted_indexes, reader.number_of_samples
+    ):]] = total
+    return(energies)
+
+
+def normalize_correlation(correlation, first_lag, reader_one, reader_two,
+                          block_size, min_overlap=NORMALIZED_MIN_OVERLAP):
+    """Normalize correlation
+
+    Inputs
+    ------
+    - correlation : numpy.ndarray
+          Consecutive lags, starting at `first_lag`
+    - first_lag : int
+    - reader_one : audio_io reader
+    - reader_two : audio_io reader
+    - block_size : int
+          See `cumulative_energy()`
+    - min_overlap : float
+          See `NORMALIZED_MIN_OVERLAP`
+
+    Outputs
+    -------
+    - normalized : numpy.ndarray
+          Every lag `k` divided by the square root of the energies
+          of the frames of `one` and `two` that overlap at `k`
+          (`one[n + k]` and `two[n]`), between -1 and 1
+
+    The energy of every overlap is the difference of two
+    cumulative energies (see `cumulative_energy()`), so the cost
+    is linear in the number of lags, and only the frames of the
+    readers are read, block by block, once.
+    """
+    length_one = int(reader_one.number_of_samples)
+    length_two = int(reader_two.number_of_samples)
+    lags = numpy.arange(first_lag, first_lag + len(correlation))
+    starts_one = numpy.clip(lags, 0, length_one)
+    ends_one = numpy.clip(lags + length_two, 0, length_one)
+    energies_one = cumulative_energy(
+        reader_one, numpy.concatenate((starts_one, ends_one)), block_size
+    )
+    energies_one = energies_one[len(lags):] - energies_one[:len(lags)]
+    energies_two = cumulative_energy(
+        reader_two,
+        numpy.concatenate((starts_one - lags, ends_one - lags)),
+        block_size
+    )
+    energies_two = energies_two[len(lags):] - energies_two[:len(lags)]
+    energy = (
+        numpy.maximum(energies_one, 0.0) * numpy.maximum(energies_two, 0.0)
+    )
+    valid = (
+        (ends_one - starts_one >= min_overlap * min(length_one, length_two)) &
+        (energy > 0)
+    )
+    normalized = numpy.zeros(len(correlation))
+    normalized[valid] = correlation[valid] / numpy.sqrt(energy[valid])
+    return(normalized)
+
+
+def parabolic_peak_offset(correlation, index):
+    """Parabolic peak offset
+
+    Fits a parabola through the absolute correlation at `index`
+    and its two neighbours, and returns the offset (between -0.5
+    and 0.5) from `index` to the vertex. Returns zero at the
+    edges or when the three points are collinear.
+    """
+    if index <= 0 or index >= len(correlation) - 1:
+        return(0.0)
+    before, at, after = abs(correlation[index - 1:index + 2])
+    curvature = before - 2 * at + after
+    if curvature == 0:
+        return(0.0)
+    return(float(numpy.clip(0.5 * (before - after) / curvature, -0.5, 0.5)))
+
+
+def fft_correlation(one, two, precision='float64'):
+    """FFT correlation
+
+    Inputs
+    ------
+    - one : numpy.ndarray
+    - two : numpy.ndarray
+    - precision : str
+          One of `PRECISIONS`
+
+    Outputs
+    -------
+    - correlation : numpy.ndarray
+          Same layout as `fftconvolve(one, two[::-1], 'full')`,
+          in `precision`
+
+    Both signals are copied into one preallocated buffer (two
+    rows of the smallest fast length with no wrap-around, see
+    `correlation_fft_size()`) and transformed with one real FFT,
+    which scipy.fft can split between threads (see
+    `parallel.py`). The conjugate product is computed in place
+    in the first row, and the inverse real FFT is allowed to
+    overwrite it. Besides the output, only the buffer and its
+    spectra are held.
+    """
+    import scipy.fft
+    dtype = _get_dtype(precision)
+    length_one = len(one)
+    length_two = len(two)
+    fft_size = correlation_fft_size(length_one, length_two)
+    buffer = numpy.zeros((2, fft_size), dtype=dtype)
+    buffer[0, :length_one] = one
+    buffer[1, :length_two] = two
+    spectra = scipy.fft.rfft(buffer, axis=1, overwrite_x=True)
+    del buffer
+    numpy.conjugate(spectra[1], out=spectra[1])
+    spectra[0] *= spectra[1]
+    circular = scipy.fft.irfft(spectra[0], fft_size, overwrite_x=True)
+    del spectra
+    correlation = numpy.empty(length_one + length_two - 1, dtype=dtype)
+    correlation[:length_two - 1] = circular[fft_size - (length_two - 1):]
+    correlation[length_two - 1:] = circular[:length_one]
+    return(correlation)
+
+
+def fft_autocorrelation(data, precision='float64'):
+    """FFT autocorrelation
+
+    Same as `fft_correlation(data, data, precision)` for half the
+    forward transforms: one real FFT, its power spectrum (real,
+    half the size of a cross spectrum) and one inverse real FFT.
+    The negative lags are the positive ones mirrored, so the
+    output is exactly symmetric around lag zero (at index
+    `len(data) - 1`).
+    """
+    import scipy.fft
+    dtype = _get_dtype(precision)
+    length = len(data)
+    fft_size = correlation_fft_size(length, length)
+    spectrum = scipy.fft.rfft(numpy.asarray(data, dtype=dtype), fft_size)
+    power = numpy.square(spectrum.real)
+    power += numpy.square(spectrum.imag)
+    del spectrum
+    circular = scipy.fft.irfft(power, fft_size, overwrite_x=True)
+    del power
+    correlation = numpy.empty(2 * length - 1, dtype=dtype)
+    correlation[length - 1:] = circular[:length]
+    correlation[:length - 1] = circular[length - 1:0:-1]
+    return(correlation)
+
+
+def correlation_lags(length_one, length_two, first_index=0,
+                     number_of_lags=None):
+    """Correlation lags
+
+    Lag (in samples, see the conventions above) of every index
+    of a correlation with the layout of `fft_correlation()`
+    (`number_of_lags` of them starting at `first_index`, all
+    of them by default), like `scipy.signal.correlation_lags`
+    in `full` mode.
+    """
+    if number_of_lags is None:
+        number_of_lags = length_one + length_two - 1 - first_index
+    first_lag = first_index - (length_two - 1)
+    return(numpy.arange(first_lag, first_lag + number_of_lags))
+
+
+def generalized_correlation(one, two, weighting='phat',
+                            smoothing_bins=GCC_SMOOTHING_BINS,
+                            precision='float64'):
+    """Generalized correlation
+
+    Inputs
+    ------
+    - one : numpy.ndarray
+    - two : numpy.ndarray
+    - weighting : str
+          One of `WEIGHTINGS`:
+          - 'none': plain cross-correlation
+          - 'phat': 1 / |G12|
+          - 'scot': 1 / sqrt(G11 * G22)
+          - 'roth': 1 / G11
+          - 'ht': |g|^2 / (|G12| * (1 - |g|^2)), the maximum
+                  likelihood (Hannan-Thomson) weighting, where
+                  |g|^2 is the coherence
+    - smoothing_bins : int
+          See `GCC_SMOOTHING_BINS`
+    - precision : str
+          One of `PRECISIONS`
+
+    Outputs
+    -------
+    - correlation : numpy.ndarray
+          Same layout as `fftconvolve(one, two[::-1], 'full')`
+
+    All weightings share one real FFT per signal and one inverse
+    real FFT. The power spectra (and, for ML/HT, the cross
+    spectrum) are smoothed over `smoothing_bins` bins, which
+    assumes the lag is small compared with the signals.
+    """
+    return(multichannel_correlation(
+        numpy.reshape(one, (-1, 1)),
+        numpy.reshape(two, (-1, 1)),
+        [(0, 0)],
+        weighting,
+        smoothing_bins,
+        precision
+    )[:, 0])
+
+
+def multichannel_correlation(one, two, pairs, weighting='none',
+                             smoothing_bins=GCC_SMOOTHING_BINS,
+                             precision='float64'):
+    """Multichannel correlation
+
+    Inputs
+    ------
+    - one : numpy.ndarray
+          Frames x channels
+    - two : numpy.ndarray
+          Frames x channels
+    - pairs : list of (int, int)
+          Channel of `one` and channel of `two` for every
+          correlation to compute
+    - weighting : str
+          See `generalized_correlation()`
+    - smoothing_bins : int
+          See `GCC_SMOOTHING_BINS`
+    - precision : str
+          One of `PRECISIONS`
+
+    Outputs
+    -------
+    - correlation : numpy.ndarray
+          Lags x pairs, every column with the same layout as
+          `fftconvolve(one[:, i], two[:, j][::-1], 'full')`
+
+    Each channel is transformed once (one real FFT over the whole
+    frames x channels array), the cross spectra of all the pairs
+    are computed at once and transformed back with one inverse
+    real FFT over the lags x pairs array.
+    """
+    import scipy.fft
+    check_weighting(weighting)
+    dtype = _get_dtype(precision)
+    length_one = one.shape[0]
+    length_two = two.shape[0]
+    fft_size = correlation_fft_size(length_one, length_two)
+    return(spectra_correlation(
+        scipy.fft.rfft(numpy.asarray(one, dtype=dtype), fft_size, axis=0),
+        scipy.fft.rfft(numpy.asarray(two, dtype=dtype), fft_size, axis=0),
+        length_one,
+        length_two,
+        fft_size,
+        pairs,
+        weighting,
+        smoothing_bins
+    ))
+
+
+def correlation_fft_size(length_one, length_two):
+    """Correlation FFT size
+
+    Smallest fast FFT size for which the circular correlation
+    of the two lengths doesn't wrap around.
+    """
+    import scipy.fft
+    return(scipy.fft.next_fast_len(length_one + length_two - 1))
+
+
+def spectra_correlation(spectra_one, spectra_two, length_one, length_two,
+                        fft_size, pairs, weighting='none',
+                        smoothing_bins=GCC_SMOOTHING_BINS):
+    """Spectra correlation
+
+    Same as `multichannel_correlation()`, from the real FFTs
+    (frequencies x channels, of size `fft_size`) instead of the
+    signals, so spectra can be computed once and reused (see
+    `cache.py` and `batch_analysis.py`). The correlation is in
+    the precision of the spectra.
+    """
+    import scipy.fft
+    check_weighting(weighting)
+    channels_one = [pair[0] for pair in pairs]
+    channels_two = [pair[1] for pair in pairs]
+    cross_spectra = weighted_cross_spectrum(
+        spectra_one[:, channels_one],
+        spectra_two[:, channels_two],
+        weighting,
+        smoothing_bins
+    )
+    circular = scipy.fft.irfft(
+        cross_spectra, fft_size, axis=0, overwrite_x=True
+    )
+    return(circular_lag_window(
+        circular, -(length_two - 1), length_one + length_two - 1
+    ))
+
+
+def weighted_cross_spectrum(spectrum_one, spectrum_two, weighting='none',
+                            smoothing_bins=GCC_SMOOTHING_BINS):
+    """Weighted cross spectrum
+
+    Cross spectrum of two real FFTs (of the same size) with the
+    weighting applied (see `generalized_correlation()`). Its
+    inverse real FFT is the circular correlation: lag `k` at
+    index `k` and lag `-k` at index `fft_size - k`. Spectra
+    can also be arrays of frequencies x channels, in which
+    case every column is weighted on its own.
+    """
+    check_weighting(weighting)
+    cross_spectrum = spectrum_one * numpy.conj(spectrum_two)
+    if weighting != 'none':
+        cross_spectrum *= _gcc_weights(
+            weighting, spectrum_one, spectrum_two, cross_spectrum,
+            smoothing_bins
+        )
+    return(cross_spectrum)
+
+
+def cross_spectrum_norm(cross_spectrum, fft_size):
+    """Cross spectrum norm
+
+    Largest absolute value the inverse real FFT (of size
+    `fft_size`) of a cross spectrum can take, reached when all of
+    its bins are in phase, as for a copy at a whole delay. It's
+    the normalization of a weighted correlation: dividing by it
+    gives 1 for a perfect match whatever the weighting (with
+    'phat', every bin has magnitude one), where the energies of
+    the signals would not. One value per column for frequencies
+    x pairs.
+    """
+    weights = numpy.full(len(cross_spectrum), 2.0)
+    weights[0] = 1.0
+    if fft_size % 2 == 0:
+        weights[-1] = 1.0
+    return(numpy.dot(weights, abs(cross_spectrum)) / fft_size)
+
+
+def spectra_norms(spectra_one, spectra_two, fft_size, pairs,
+                  weighting='none', smoothing_bins=GCC_SMOOTHING_BINS):
+    """Spectra norms
+
+    `cross_spectrum_norm()` of every pair of the correlation
+    `spectra_correlation()` computes from the same spectra.
+    """
+    channels_one = [pair[0] for pair in pairs]
+    channels_two = [pair[1] for pair in pairs]
+    return(cross_spectrum_norm(
+        weighted_cross_spectrum(
+            spectra_one[:, channels_one],
+            spectra_two[:, channels_two],
+            weighting,
+            smoothing_bins
+        ),
+        fft_size
+    ))
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(
+            "Unknown precision ({}), ".format(precision) +
+            "should be one of: {}".format(", ".join(PRECISIONS))
+        )
+
+
+def check_weighting(weighting):
+    if weighting not in WEIGHTINGS:
+        raise ValueError(
+            "Unknown weighting ({}), ".format(weighting) +
+            "should be one of: {}".format(", ".join(WEIGHTINGS))
+        )
+
+
+def circular_lag_window(circular, first_lag, number_of_lags):
+    """Circular lag window
+
+    Picks `number_of_lags` consecutive lags starting at
+    `first_lag` (which may be negative) from a circular
+    correlation (lags along the first axis), as a regular
+    (non-wrapped) array.
+    """
+    indexes = numpy.arange(first_lag, first_lag + number_of_lags)
+    return(circular[indexes % len(circular)])
+
+
+def _gcc_weights(weighting, spectrum_one, spectrum_two, cross_spectrum,
+                 smoothing_bins):
+    if weighting == 'phat':
+        return(1.0 / _regularize(abs(cross_spectrum)))
+    power_one = _smooth(abs(spectrum_one) ** 2, smoothing_bins)
+    if weighting == 'roth':
+        return(1.0 / _regularize(power_one))
+    power_two = _smooth(abs(spectrum_two) ** 2, smoothing_bins)
+    if weighting == 'scot':
+        return(1.0 / _regularize(numpy.sqrt(power_one * power_two)))
+    smooth_cross = _smooth(cross_spectrum, smoothing_bins)
+    coherence = (
+        abs(smooth_cross) ** 2 / _regularize(power_one * power_two)
+    )
+    coherence = numpy.clip(coherence, 0.0, 1.0 - 1e-6)
+    return(
+        coherence /
+        (_regularize(abs(cross_spectrum)) * (1.0 - coherence))
+    )
+
+
+def _smooth(spectrum, bins):
+    bins = min(bins, len(spectrum))
+    if bins <= 1:
+        return(spectrum)
+    kernel = numpy.ones(bins) / float(bins)
+    return(numpy.apply_along_axis(
+        numpy.convolve, 0, spectrum, kernel, mode='same'
+    ))
+
+
+def _regularize(magnitude):
+    """Regularize
+
+    Avoids dividing by (almost) zero in empty frequency bins,
+    flooring them at `GCC_REGULARIZATION` of the largest bin of
+    each channel.
+    """
+    return(numpy.maximum(
+        magnitude,
+        GCC_REGULARIZATION * numpy.max(magnitude, axis=0, keepdims=True) +
+        numpy.finfo(magnitude.dtype).tiny
+    ))
+
+
+def _get_dtype(precision):
+    check_precision(precision)
+    return(numpy.dtype(precision))
+
+
+def window_block_size(number_of_lags):
+    """Window block size
+
+    Block size for `stream_correlation()` when the data is already
+    in memory: a few times the window keeps every FFT small while
+    amortizing the overlap between consecutive segments.
+    """
+    return(max(4 * number_of_lags, MIN_WINDOW_BLOCK_SIZE))
+
+
+def correlate_valid(segment, block):
+    """Correlate valid
+
+    `correlation[k] = sum_n segment[n + k] * block[n]` for every
+    `k` from zero to `len(segment) - len(block)`.
+    """
+    if len(segment) - len(block) + 1 <= DIRECT_CORRELATION_MAX_LAGS:
+        return(numpy.correlate(segment, block, mode='valid'))
+    import scipy.signal
+    return(scipy.signal.fftconvolve(segment, block[::-1], mode='valid'))
+
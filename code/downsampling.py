@@ -15,7 +15,9 @@ Functionality
 Inputs
 ------
 - audio_file_path : str
-      Accepted file formats are WAV
+      Accepted file formats are WAV, and HDF5 (`.h5` or
+      `.hdf5`, as written by `hdf5_wav_translator.py`),
+      which is read directly, block by block when streaming
 - new_sample_rate : int
       Should be a power of two
 
@@ -25,10 +27,10 @@ Outputs
       Will have the same name as the original one with
       an appended `_downsampled` in its name
 - graph : PNG
-      Any graph produced will be saved with the name
-      of the file name and an appended integer indicating
-      the number of the graph to reproduce the process
-      visually
+      Only with `--graph`. Any graph produced will be saved
+      with the name of the file name and an appended integer
+      indicating the number of the graph to reproduce the
+      process visually
 
 Dependencies
 ------------
@@ -53,9 +55,35 @@ If the current directory structure is used:
 
 $ python ./code/downsampling.py ./audio/audio_file.wav 2048
 
+For long files, or files whose number of frames has large
+prime factors, use the polyphase engine, which filters the
+signal block by block (its time is linear in the length):
+
+$ python ./code/downsampling.py ./audio/audio_file.wav 8192 \
+         --engine polyphase --filter-window kaiser,5.0
+
+With `--stream` (polyphase engine only), the file is read,
+resampled and written block by block, so memory stays the
+same however long the recording is (with `--graph`, only
+the input is graphed):
+
+$ python ./code/downsampling.py ./audio/audio_file.wav 8192 \
+         --engine polyphase --stream
+
+Downsampling the same content again with the same settings
+can be skipped with an on-disk cache:
+
+$ python ./code/downsampling.py ./audio/audio_file.wav 8192 \
+         --cache-directory ./results/cache/
+
 Notes
 -----
-- Third and following arguments are ignored
+- Graphs draw the min/max of every pixel column instead of
+  every sample (see `plotting.py`), so they take about the
+  same time however long the file is
+- With `--backend memmap`, uncompressed WAV files are memory
+  mapped instead of decoded: opening them is instant and only
+  the frames actually used are read from disk
 - Results are stored in the `./results/` directory
 - If you get the:
   `IOError: [Errno 2] No such file or directory: './results/...`
@@ -81,18 +109,98 @@ Author
 """
 
 import sys
+import math
+import argparse
 import numpy
-import scipy.signal
-import scikits.audiolab
-import matplotlib
-import matplotlib.pyplot
 
-matplotlib.use('agg')
+import audio_io
+import cache
+import parallel
+import plotting
+
+#
+# Available resampling engines:
+#
+# - 'fft': `scipy.signal.resample`, one FFT over the whole file
+# - 'polyphase': `PolyphaseResampler`, FIR filtering block by block
+#
+ENGINES = ('fft', 'polyphase')
+
+#
+# Default anti-alias filter for the polyphase engine (the
+# same as `scipy.signal.resample_poly`): a Kaiser window and
+# a half length of 10 times the largest resampling factor.
+#
+DEFAULT_FILTER_WINDOW = ('kaiser', 5.0)
+DEFAULT_FILTER_HALF_LENGTH = 10
+
+#
+# Frames per block for the polyphase engine.
+#
+DEFAULT_BLOCK_SIZE = 65536
 
 
 class Downsample(object):
 
-    def __init__(self, audio_input_file, new_sample_rate):
+    def __init__(self, audio_input_file, new_sample_rate, engine='fft',
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 filter_window=DEFAULT_FILTER_WINDOW,
+                 filter_half_length=DEFAULT_FILTER_HALF_LENGTH,
+                 stream=False, backend='sndfile', cache_directory=None,
+                 cache_max_bytes=cache.DEFAULT_CACHE_MAX_BYTES,
+                 workers=parallel.DEFAULT_WORKERS):
+        """Downsample
+
+        Inputs
+        ------
+        - audio_input_file : str
+        - new_sample_rate : str
+        - engine : str
+              One of `ENGINES`
+        - block_size : int
+              Frames per block (polyphase engine only)
+        - filter_window : str or tuple
+              Anti-alias filter window, as accepted by
+              `scipy.signal.firwin` (polyphase engine only)
+        - filter_half_length : int
+              Anti-alias filter half length, in multiples of the
+              largest resampling factor (polyphase engine only)
+        - stream : bool
+              If True, the input is never loaded into memory:
+              `.downsample()` reads it block by block, resamples
+              every block and writes it to the output file right
+              away (polyphase engine only, the output can't
+              be graphed)
+        - backend : str
+              How the input is read, one of `audio_io.BACKENDS`
+        - cache_directory : str or None
+              If given, the downsampled signal is kept there (see
+              `cache.py`) and reused by later runs on the same
+              content with the same settings (not when streaming)
+        - cache_max_bytes : int
+              Size cap of the cache
+        - workers : int
+              Threads for the FFTs of the 'fft' engine, see
+              `parallel.py` (-1 for every core)
+        """
+        if engine not in ENGINES:
+            raise ValueError(
+                "Unknown engine ({}), ".format(engine) +
+                "should be one of: {}".format(", ".join(ENGINES))
+            )
+        if stream and engine != 'polyphase':
+            raise ValueError("Streaming needs the 'polyphase' engine")
+        self.engine = engine
+        self.stream = stream
+        self.backend = backend
+        self.workers = parallel.get_workers(workers)
+        if cache_directory is None:
+            self.cache = None
+        else:
+            self.cache = cache.Cache(cache_directory, cache_max_bytes)
+        self.block_size = block_size
+        self.filter_window = filter_window
+        self.filter_half_length = filter_half_length
         self.new_sample_rate = new_sample_rate
         self.audio_input_file = audio_input_file
         self.audio_output_file = self._get_audio_output_file()
@@ -122,31 +230,49 @@ class Downsample(object):
     def downsample(self):
         self._check_valid_new_sample_rate()
         self._open_and_setup_output_file()
-        self._perform_downsample()
-        self._write_and_close_output_file()
+        if self.stream:
+            self._stream_downsample()
+            self._close_output_file()
+        else:
+            self._perform_downsample()
+            self._write_and_close_output_file()
 
     def graph_signal(self, which_data):
+        """Graph signal
+
+        The signal is drawn as a min/max envelope with one value
+        pair per pixel column (see `plotting.py`), so the time and
+        memory it takes depend on the width of the graph and not
+        on the length of the file. The input is read block by
+        block, so it can be graphed when streaming as well (the
+        output can't, it's never in memory).
+        """
+        if which_data == 'output' and self.stream:
+            raise ValueError("The output can't be graphed when streaming")
         # matplotlib.rcsetup.all_backends  # Available backends
         # matplotlib.pyplot.switch_backend('agg')  # Switch backend
-        matplotlib.pyplot.figure()
-        matplotlib.pyplot.ylabel('Signal')
-        matplotlib.pyplot.xlabel('Seconds')
-        matplotlib.pyplot.title('Signal graph for: ' + which_data)
+        pyplot = plotting.get_pyplot()
+        figure = pyplot.figure()
+        columns = plotting.get_columns(figure)
+        pyplot.ylabel('Signal')
+        pyplot.xlabel('Seconds')
+        pyplot.title('Signal graph for: ' + which_data)
         if which_data == 'input':
-            time = numpy.linspace(
-                0,
-                len(self.audio_input_data) / int(self.audio_input_sample_rate),
-                num=len(self.audio_input_data)
+            positions, minimum, maximum = plotting.reader_envelope(
+                self.audio_input_reader, columns
             )
-            matplotlib.pyplot.plot(time, self.audio_input_data)
+            sample_rate = self.audio_input_sample_rate
         elif which_data == 'output':
-            time = numpy.linspace(
-                0,
-                len(self.audio_to_write) / int(self.new_sample_rate),
-                num=len(self.audio_to_write)
+            positions, minimum, maximum = plotting.envelope(
+                self.audio_to_write, columns
             )
-            matplotlib.pyplot.plot(time, self.audio_to_write)
-        matplotlib.pyplot.savefig(self._get_png_file_output(which_data))
+            sample_rate = self.new_sample_rate
+        plotting.plot_envelope(
+            figure.gca(), positions / float(int(sample_rate)),
+            minimum, maximum, 'blue'
+        )
+        pyplot.savefig(self._get_png_file_output(which_data))
+        pyplot.close(figure)
 
     def _perform_downsample(self):
         """Perform downsample
@@ -157,15 +283,57 @@ class Downsample(object):
         corresponding adjustment for `_open_and_setup_output_file()`.
         """
         # self.audio_to_write = self.audio_input_data
-        number_of_samples = int(round(
-            len(self.audio_input_data) *
-            float(self.new_sample_rate) /
-            float(self.audio_input_sample_rate)
-        ))
-        self.audio_to_write = scipy.signal.resample(
-            self.audio_input_data,
-            number_of_samples
+        if self.cache is None:
+            self.audio_to_write = self._resample()
+        else:
+            self.audio_to_write = self.cache.get_or_compute(
+                cache.make_key(
+                    cache.file_hash(self.audio_input_file), 'resample',
+                    int(self.audio_input_sample_rate),
+                    int(self.new_sample_rate),
+                    self.engine,
+                    self.filter_window,
+                    self.filter_half_length
+                ),
+                self._resample
+            )
+
+    def _resample(self):
+        with parallel.fft_workers(self.workers):
+            return(resample(
+                self.audio_input_data,
+                self.audio_input_sample_rate,
+                self.new_sample_rate,
+                engine=self.engine,
+                block_size=self.block_size,
+                filter_window=self.filter_window,
+                filter_half_length=self.filter_half_length
+            ))
+
+    def _stream_downsample(self):
+        """Stream downsample
+
+        Reads `block_size` frames at a time, resamples them and
+        writes the result before reading the next block, so memory
+        doesn't depend on the length of the file.
+        """
+        resampler = PolyphaseResampler(
+            self.audio_input_sample_rate,
+            self.new_sample_rate,
+            self.filter_window,
+            self.filter_half_length
         )
+        reader = self.audio_input_reader
+        for start in range(0, reader.number_of_samples, self.block_size):
+            block = reader.read(
+                start, min(self.block_size, reader.number_of_samples - start)
+            )
+            self._write_block(resampler.process(block))
+        self._write_block(resampler.flush())
+
+    def _write_block(self, block):
+        if len(block) > 0:
+            self.audio_output.write_frames(block)
 
     def _open_and_setup_output_file(self):
         """Open and setup output file
@@ -175,10 +343,11 @@ class Downsample(object):
         the original sample rate when saved. Needs to be done in conjuction
         with the corresponding adjustment for `perform_downsample()`.
         """
+        import scikits.audiolab
         try:
             self.audio_output = scikits.audiolab.Sndfile(
                 self.audio_output_file, 'w',
-                self.audio_input_format,
+                audio_io.sndfile_format(self.audio_input_reader),
                 int(self.audio_input_number_of_channels),
                 # int(self.audio_input_sample_rate)
                 int(self.new_sample_rate)
@@ -191,25 +360,22 @@ class Downsample(object):
 
     def _write_and_close_output_file(self):
         self.audio_output.write_frames(self.audio_to_write)
+        self._close_output_file()
+
+    def _close_output_file(self):
         self._set_updated_output_metadata()
         self.audio_output.close()
 
     def _read_audio_data(self):
-        try:
-            sound_file = scikits.audiolab.Sndfile(self.audio_input_file, 'r')
-        except Exception as e:
-            raise ValueError(
-                "Could not open {}.\n".format(self.audio_input_file) +
-                "Full Python exception: {}.\n".format(e)
-            )
-        self.audio_input_format = sound_file.format
-        self.audio_input_encoding = sound_file.encoding
-        self.audio_input_sample_rate = sound_file.samplerate
-        self.audio_input_number_of_samples = sound_file.nframes
-        self.audio_input_number_of_channels = sound_file.channels
-        self.audio_input_data = sound_file.read_frames(
-            self.audio_input_number_of_samples
-        )
+        reader = audio_io.open_reader(self.audio_input_file, self.backend)
+        self.audio_input_reader = reader
+        self.audio_input_format = reader.format
+        self.audio_input_encoding = reader.encoding
+        self.audio_input_sample_rate = reader.sample_rate
+        self.audio_input_number_of_samples = reader.number_of_samples
+        self.audio_input_number_of_channels = reader.number_of_channels
+        if not self.stream:
+            self.audio_input_data = reader.read_all()
 
     def _check_valid_new_sample_rate(self):
         if int(self.new_sample_rate) > int(self.audio_input_sample_rate):
@@ -291,13 +457,9 @@ class Downsample(object):
         # self.audio_output_number_of_samples = self.audio_output.nframes
 
     def _get_audio_output_file(self):
-        return(
-            "./results/" +
-            self._get_file_name() +
-            "_downsampled_to_" +
-            self.new_sample_rate +
-            ".wav"
-        )
+        return(get_audio_output_file(
+            self.audio_input_file, self.new_sample_rate
+        ))
 
     def _get_png_file_output(self, which_data):
         return(
@@ -319,6 +481,198 @@ class Downsample(object):
         return(self.audio_input_file.split("/")[-1].split(".")[0])
 
 
+class PolyphaseResampler(object):
+
+    def __init__(self, sample_rate, new_sample_rate,
+                 filter_window=DEFAULT_FILTER_WINDOW,
+                 filter_half_length=DEFAULT_FILTER_HALF_LENGTH):
+        """Polyphase resampler
+
+        Rational resampling (upsample by `up`, low-pass FIR filter,
+        downsample by `down`) fed block by block: `process()` takes
+        the next block of frames and returns every output frame
+        that can already be computed, `flush()` returns the rest
+        once the input is over.
+
+        The output is the same as `scipy.signal.resample_poly`
+        with the same window, whatever the block sizes are, and
+        only `filter length / up` input frames are kept between
+        blocks. The cost is linear in the number of frames and
+        doesn't depend on how it factorizes.
+        """
+        sample_rate = int(sample_rate)
+        new_sample_rate = int(new_sample_rate)
+        divisor = math.gcd(sample_rate, new_sample_rate)
+        self.up = new_sample_rate // divisor
+        self.down = sample_rate // divisor
+        max_rate = max(self.up, self.down)
+        if max_rate == 1:
+            # Same rate, nothing to filter
+            half_length = 0
+            taps = numpy.ones(1)
+        else:
+            half_length = int(filter_half_length) * max_rate
+            import scipy.signal
+            taps = scipy.signal.firwin(
+                2 * half_length + 1, 1.0 / max_rate, window=filter_window
+            ) * self.up
+        #
+        # Same centering as `resample_poly`: the filter is padded
+        # in front so output frame `j` is frame `j + delay` of the
+        # padded filter's output.
+        #
+        pre_pad = self.down - half_length % self.down
+        self.delay = (half_length + pre_pad) // self.down
+        self.taps = numpy.concatenate((numpy.zeros(pre_pad), taps))
+        self._number_of_inputs = 0
+        self._next_output = 0
+        self._buffer_start = self._first_input(0)
+        self._buffer = None
+        self._pending_zeros = -self._buffer_start
+
+    def process(self, block):
+        block = numpy.asarray(block, dtype=numpy.float64)
+        self._number_of_inputs += block.shape[0]
+        if self._buffer is None:
+            self._buffer = numpy.zeros(
+                (self._pending_zeros,) + block.shape[1:]
+            )
+        self._buffer = numpy.concatenate((self._buffer, block))
+        last_output = (
+            ((self._buffer_start + len(self._buffer)) * self.up - 1) //
+            self.down - self.delay
+        )
+        return(self._compute(last_output + 1))
+
+    def flush(self):
+        number_of_outputs = -(-self._number_of_inputs * self.up // self.down)
+        if self._buffer is None:
+            return(numpy.zeros(0))
+        last_input = (
+            (number_of_outputs - 1 + self.delay) * self.down // self.up
+        )
+        missing = last_input + 1 - (self._buffer_start + len(self._buffer))
+        if missing > 0:
+            self._buffer = numpy.concatenate((
+                self._buffer,
+                numpy.zeros((missing,) + self._buffer.shape[1:])
+            ))
+        return(self._compute(number_of_outputs))
+
+    def _compute(self, end):
+        """Compute
+
+        Output frames from `self._next_output` up to `end`
+        (excluded), filtering only the inputs they need.
+        """
+        start = self._next_output
+        if end <= start:
+            return(numpy.zeros((0,) + self._buffer.shape[1:]))
+        first_input = self._first_input(start)
+        last_input = (end - 1 + self.delay) * self.down // self.up
+        segment = self._buffer[
+            first_input - self._buffer_start:
+            last_input + 1 - self._buffer_start
+        ]
+        import scipy.signal
+        filtered = scipy.signal.upfirdn(
+            self.taps, segment, self.up, self.down, axis=0
+        )
+        offset = start + self.delay - first_input * self.up // self.down
+        output = filtered[offset:offset + end - start]
+        self._next_output = end
+        drop = self._first_input(end) - self._buffer_start
+        if drop > 0:
+            self._buffer = self._buffer[drop:]
+            self._buffer_start += drop
+        return(output)
+
+    def _first_input(self, output):
+        """First input
+
+        First input frame that output frame `output` depends on,
+        rounded down to a multiple of `down` so the filtered
+        segment lines up with the output frames.
+        """
+        first = -(-((output + self.delay) * self.down -
+                    len(self.taps) + 1) // self.up)
+        return((first // self.down) * self.down)
+
+
+def get_audio_output_file(audio_input_file, new_sample_rate):
+    """Get audio output file
+
+    Where `Downsample` writes `audio_input_file` downsampled to
+    `new_sample_rate`, without opening anything (see
+    `batch_downsampling.py`). Same warning about dots in file
+    names as `Downsample._get_file_name()`.
+    """
+    return(
+        "./results/" +
+        audio_input_file.split("/")[-1].split(".")[0] +
+        "_downsampled_to_" +
+        str(new_sample_rate) +
+        ".wav"
+    )
+
+
+def resample(data, sample_rate, new_sample_rate, engine='fft',
+             block_size=DEFAULT_BLOCK_SIZE,
+             filter_window=DEFAULT_FILTER_WINDOW,
+             filter_half_length=DEFAULT_FILTER_HALF_LENGTH):
+    """Resample
+
+    Inputs
+    ------
+    - data : numpy.ndarray
+          Frames along the first axis
+    - sample_rate : int
+    - new_sample_rate : int
+    - engine : str
+          One of `ENGINES`
+    - block_size, filter_window, filter_half_length
+          See `Downsample` (polyphase engine only)
+
+    Outputs
+    -------
+    - resampled_data : numpy.ndarray
+
+    Resampling in memory, without going through any file, so other
+    scripts (e.g. `analysis.py`) can use it directly.
+    """
+    if engine == 'polyphase':
+        resampler = PolyphaseResampler(
+            sample_rate, new_sample_rate, filter_window, filter_half_length
+        )
+        blocks = [
+            resampler.process(data[start:start + block_size])
+            for start in range(0, len(data), block_size)
+        ]
+        blocks.append(resampler.flush())
+        return(numpy.concatenate(blocks))
+    number_of_samples = int(round(
+        len(data) *
+        float(new_sample_rate) /
+        float(sample_rate)
+    ))
+    import scipy.signal
+    return(scipy.signal.resample(data, number_of_samples))
+
+
+def parse_window(window):
+    """Parse window
+
+    Filter window from the command line, as `scipy.signal.firwin`
+    takes it: `hamming` is a name, `kaiser,5.0` a name and its
+    parameters (used by `--filter-window` here and in
+    `batch_downsampling.py`).
+    """
+    parts = window.split(',')
+    if len(parts) == 1:
+        return(parts[0])
+    return(tuple([parts[0]] + [float(part) for part in parts[1:]]))
+
+
 def main(argv):
 
     if len(argv) < 2:
@@ -327,18 +681,87 @@ def main(argv):
             "arguments (see code instructions)"
         )
 
-    audio_input_file = argv[0]
-    new_sample_rate = argv[1]
-
-    downsample = Downsample(audio_input_file, new_sample_rate)
+    arguments = _parse_arguments(argv)
+
+    downsample = Downsample(
+        arguments.audio_input_file,
+        arguments.new_sample_rate,
+        engine=arguments.engine,
+        block_size=arguments.block_size,
+        filter_window=arguments.filter_window,
+        filter_half_length=arguments.filter_half_length,
+        stream=arguments.stream,
+        backend=arguments.backend,
+        cache_directory=arguments.cache_directory,
+        cache_max_bytes=arguments.cache_max_megabytes * 1024 ** 2,
+        workers=arguments.workers
+    )
 
     downsample.print_data('input')
-    downsample.graph_signal('input')
+    if arguments.graph:
+        downsample.graph_signal('input')
 
     downsample.downsample()
 
     downsample.print_data('output')
-    downsample.graph_signal('output')
+    if arguments.graph and not arguments.stream:
+        downsample.graph_signal('output')
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Downsample an audio file to a given rate"
+    )
+    parser.add_argument('audio_input_file')
+    parser.add_argument('new_sample_rate')
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='fft',
+        help="Resampling engine"
+    )
+    parser.add_argument(
+        '--graph', action='store_true',
+        help="Graph the input and output signals into `./results/` " +
+             "(only the input when streaming)"
+    )
+    parser.add_argument(
+        '--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+        help="Frames per block (polyphase engine only)"
+    )
+    parser.add_argument(
+        '--filter-window', type=parse_window,
+        default=DEFAULT_FILTER_WINDOW,
+        help="Anti-alias filter window, e.g. `hamming` or `kaiser,5.0` " +
+             "(polyphase engine only)"
+    )
+    parser.add_argument(
+        '--filter-half-length', type=int,
+        default=DEFAULT_FILTER_HALF_LENGTH,
+        help="Anti-alias filter half length, in multiples of the " +
+             "largest resampling factor (polyphase engine only)"
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="Read, resample and write block by block without loading " +
+             "the file into memory (polyphase engine only)"
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How the input is read (`memmap` for uncompressed WAV)"
+    )
+    parser.add_argument(
+        '--cache-directory', default=None,
+        help="Keep the downsampled signal there for later runs"
+    )
+    parser.add_argument(
+        '--cache-max-megabytes', type=int,
+        default=cache.DEFAULT_CACHE_MAX_BYTES // 1024 ** 2,
+        help="Size cap of the cache (least recently used entries go first)"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=parallel.DEFAULT_WORKERS,
+        help="Threads for the FFTs of the `fft` engine (-1 for every core)"
+    )
+    return(parser.parse_args(argv))
 
 
 if __name__ == '__main__':
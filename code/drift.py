@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+
+"""
+Clock drift between two recordings
+
+Functionality
+-------------
+- Estimate the clock drift between two recordings (two devices
+  at the same nominal sample rate whose clocks differ by some
+  parts per million), by fitting a line to the lags tracked
+  over sliding windows (see `tracking.py`)
+- Compensate it: resample `one` by the fitted ratio, block by
+  block, so that its lag to `two` is the same over the whole
+  recording and a single correlation of the full files has one
+  sharp peak instead of a smeared one
+
+Inputs
+------
+- audio_file_input_one : str
+- audio_file_input_two : str
+      Mono, with the same nominal sample rate
+
+Outputs
+-------
+- compensated : WAV
+      Only with `--compensate`: `one` resampled to the clock of
+      `two`, with the same format and nominal sample rate. It
+      will have the same name as `one` with an appended
+      `_drift_compensated` in its name
+
+Results are stored in the `./results/` directory
+
+Execution
+---------
+$ python ./code/drift.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav
+
+$ python ./code/drift.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --window-seconds 30 --hop-seconds 30 --compensate
+
+Notes
+-----
+- With the lag at frame `n` of `two` fitted as `offset + slope *
+  n` (`one[n + lag]` matching `two[n]`, see `Analysis.lag()`),
+  `one` runs `ratio = 1 + slope` times as fast as `two`. The
+  compensated file is `one` read at frames `ratio * m`, which
+  leaves a constant lag of `offset / ratio`
+- Windows whose normalized peak is below `--min-normalized-peak`
+  (silence, or the track was lost) are left out of the fit, and
+  so are the ones more than `DRIFT_OUTLIER_SAMPLES` away from a
+  first fit
+- The resampling is a windowed sinc interpolation at arbitrary
+  positions (`DriftResampler`), since ratios a few ppm away from
+  one don't have a usable rational form for `PolyphaseResampler`
+"""
+
+import os
+import sys
+import argparse
+import collections
+import numpy
+
+import audio_io
+import tracking
+
+#
+# Half length (in input frames) of the interpolation filter
+# of `DriftResampler`, and the beta of its Kaiser window.
+# 16 frames and a beta of 8 keep the error under -75 dB up
+# to 0.8 times the Nyquist frequency (-94 dB at 0.2 times),
+# measured on sines resampled by 40 ppm.
+#
+DRIFT_FILTER_HALF_LENGTH = 16
+DRIFT_FILTER_BETA = 8.0
+
+#
+# Fractional positions at which the filter of `DriftResampler`
+# is tabulated (it's linearly interpolated in between), instead
+# of evaluating the window for every output frame.
+#
+DRIFT_FILTER_PHASES = 1024
+
+#
+# Windows further than this from the first fit (in samples)
+# are left out of the second one.
+#
+DRIFT_OUTLIER_SAMPLES = 2.0
+
+DEFAULT_MIN_NORMALIZED_PEAK = 0.2
+
+#
+# Frames per block when compensating.
+#
+DEFAULT_BLOCK_SIZE = 65536
+
+#
+# Result of `estimate_drift()`:
+#
+# - offset_samples : float
+#       Fitted lag at the first frame of `two`, in samples
+# - ratio : float
+#       Rate of the clock of `one` over that of `two`
+# - ppm : float
+#       `ratio - 1` in parts per million
+# - residual_samples : float
+#       RMS distance of the windows used to the fitted line
+# - windows : int
+#       Number of windows used in the fit
+#
+Drift = collections.namedtuple(
+    'Drift', ['offset_samples', 'ratio', 'ppm', 'residual_samples', 'windows']
+)
+
+
+def estimate_drift(lags, window_size, sample_rate,
+                   min_normalized_peak=DEFAULT_MIN_NORMALIZED_PEAK):
+    """Estimate drift
+
+    Inputs
+    ------
+    - lags : iterable of tracking.TrackedLag
+    - window_size : int
+          Frames per window, to place every lag at the center
+          of its window
+    - sample_rate : int
+    - min_normalized_peak : float
+
+    Outputs
+    -------
+    - drift : Drift
+
+    Least squares fit of the sub-sample lags against the center
+    of their windows, weighted by the normalized peaks, done
+    twice to leave out the outliers of the first fit.
+    """
+    lags = [
+        lag for lag in lags if lag.normalized_peak >= min_normalized_peak
+    ]
+    if len(lags) < 2:
+        raise ValueError(
+            "Needs at least two windows with a normalized peak " +
+            "of {} or more to fit the drift ".format(min_normalized_peak) +
+            "(found {})".format(len(lags))
+        )
+    frames = numpy.array([
+        lag.time * int(sample_rate) + window_size / 2.0 for lag in lags
+    ])
+    sub_samples = numpy.array([lag.sub_samples for lag in lags])
+    weights = numpy.array([lag.normalized_peak for lag in lags])
+    slope, offset = numpy.polyfit(frames, sub_samples, 1, w=weights)
+    inliers = (
+        abs(sub_samples - (offset + slope * frames)) <= DRIFT_OUTLIER_SAMPLES
+    )
+    if numpy.sum(inliers) >= 2:
+        frames = frames[inliers]
+        sub_samples = sub_samples[inliers]
+        slope, offset = numpy.polyfit(
+            frames, sub_samples, 1, w=weights[inliers]
+        )
+    residuals = sub_samples - (offset + slope * frames)
+    return(Drift(
+        offset_samples=float(offset),
+        ratio=float(1.0 + slope),
+        ppm=float(slope * 1e6),
+        residual_samples=float(numpy.sqrt(numpy.mean(residuals ** 2))),
+        windows=len(frames)
+    ))
+
+
+class DriftResampler(object):
+
+    def __init__(self, ratio, half_length=DRIFT_FILTER_HALF_LENGTH,
+                 beta=DRIFT_FILTER_BETA):
+        """Drift resampler
+
+        Output frame `m` is the input interpolated at frame
+        `ratio * m`, with a Kaiser windowed sinc of `2 *
+        half_length` taps (low-passed to `1 / ratio` of the
+        Nyquist frequency when `ratio` is over one). Same
+        interface as `downsampling.PolyphaseResampler`:
+        `process()` takes the next block of frames and returns
+        every output frame that can already be computed,
+        `flush()` returns the rest once the input is over.
+        Only the last `2 * half_length` input frames are kept
+        between blocks.
+
+        The filter is tabulated at `DRIFT_FILTER_PHASES` fractional
+        positions between two input frames, so each output frame
+        costs a lookup and `2 * half_length` multiplications.
+        """
+        self.ratio = float(ratio)
+        self.half_length = int(half_length)
+        self._taps = numpy.arange(1 - self.half_length, self.half_length + 1)
+        cutoff = min(1.0, 1.0 / self.ratio)
+        distances = (
+            numpy.arange(DRIFT_FILTER_PHASES + 1)[:, None] /
+            float(DRIFT_FILTER_PHASES) - self._taps
+        )
+        self._filter = (
+            cutoff * numpy.sinc(cutoff * distances) *
+            numpy.i0(float(beta) * numpy.sqrt(numpy.clip(
+                1.0 - (distances / self.half_length) ** 2, 0.0, 1.0
+            ))) / numpy.i0(float(beta))
+        )
+        self._number_of_inputs = 0
+        self._next_output = 0
+        # Frames before the first one are zeros
+        self._buffer_start = -self.half_length
+        self._buffer = None
+
+    def process(self, block):
+        block = numpy.asarray(block, dtype=numpy.float64)
+        self._number_of_inputs += block.shape[0]
+        if self._buffer is None:
+            self._buffer = numpy.zeros((self.half_length,) + block.shape[1:])
+        self._buffer = numpy.concatenate((self._buffer, block))
+        buffer_end = self._buffer_start + len(self._buffer)
+        # Output `m` needs the inputs up to `floor(ratio * m) + half_length`
+        end = int(numpy.floor(
+            (buffer_end - self.half_length) / self.ratio
+        ))
+        while end * self.ratio >= buffer_end - self.half_length:
+            end -= 1
+        return(self._compute(end + 1))
+
+    def flush(self):
+        if self._buffer is None:
+            return(numpy.zeros(0))
+        number_of_outputs = int(numpy.ceil(
+            self._number_of_inputs / self.ratio
+        ))
+        self._buffer = numpy.concatenate((
+            self._buffer,
+            numpy.zeros((self.half_length + 1,) + self._buffer.shape[1:])
+        ))
+        return(self._compute(number_of_outputs))
+
+    def _compute(self, end):
+        start = self._next_output
+        if end <= start:
+            return(numpy.zeros((0,) + self._buffer.shape[1:]))
+        positions = numpy.arange(start, end) * self.ratio
+        bases = numpy.floor(positions).astype(numpy.int64)
+        phases = (positions - bases) * DRIFT_FILTER_PHASES
+        indexes = numpy.minimum(
+            phases.astype(numpy.int64), DRIFT_FILTER_PHASES - 1
+        )
+        fractions = (phases - indexes)[:, None]
+        weights = self._filter[indexes] * (1.0 - fractions)
+        weights += self._filter[indexes + 1] * fractions
+        frames = self._buffer[
+            bases[:, None] + self._taps - self._buffer_start
+        ]
+        if frames.ndim == 2:
+            output = numpy.sum(frames * weights, axis=1)
+        else:
+            output = numpy.einsum('mk,mkc->mc', weights, frames)
+        self._next_output = end
+        drop = int(bases[-1]) + 1 - self.half_length - self._buffer_start
+        if drop > 0:
+            self._buffer = self._buffer[drop:]
+            self._buffer_start += drop
+        return(output)
+
+
+def compensate(reader, audio_output_file, ratio,
+               block_size=DEFAULT_BLOCK_SIZE):
+    """Compensate
+
+    Reads `reader` block by block, resamples it by `ratio` (see
+    `DriftResampler`) and writes it to `audio_output_file` with
+    the same format and nominal sample rate as the input.
+    """
+    import scikits.audiolab
+    os.makedirs(os.path.dirname(audio_output_file), exist_ok=True)
+    try:
+        audio_output = scikits.audiolab.Sndfile(
+            audio_output_file, 'w',
+            audio_io.sndfile_format(reader),
+            int(reader.number_of_channels),
+            int(reader.sample_rate)
+        )
+    except Exception as e:
+        raise ValueError(
+            "Could not prepare {}.\n".format(audio_output_file) +
+            "Full Python exception: {}.\n".format(e)
+        )
+    resampler = DriftResampler(ratio)
+    for start in range(0, reader.number_of_samples, block_size):
+        block = reader.read(
+            start, min(block_size, reader.number_of_samples - start)
+        )
+        _write_block(audio_output, resampler.process(block))
+    _write_block(audio_output, resampler.flush())
+    audio_output.close()
+
+
+def get_audio_output_file(audio_input_file):
+    return(
+        "./results/" +
+        audio_input_file.split("/")[-1].split(".")[0] +
+        "_drift_compensated.wav"
+    )
+
+
+def _write_block(audio_output, block):
+    if len(block) > 0:
+        audio_output.write_frames(block)
+
+
+def main(argv):
+
+    if len(argv) < 2:
+        raise ValueError(
+            "Needs `audio_file_input_one` and `audio_file_input_two` " +
+            "arguments (see code instructions)"
+        )
+
+    arguments = _parse_arguments(argv)
+
+    reader_one, reader_two = tracking.open_readers(
+        arguments.audio_file_input_one,
+        arguments.audio_file_input_two,
+        arguments.backend
+    )
+    sample_rate = int(reader_two.sample_rate)
+
+    def to_samples(seconds):
+        return(int(round(seconds * sample_rate)))
+
+    window_size = to_samples(arguments.window_seconds)
+    drift = estimate_drift(
+        tracking.track_lags(
+            reader_one,
+            reader_two,
+            window_size,
+            to_samples(arguments.hop_seconds),
+            to_samples(arguments.max_lag_seconds),
+            to_samples(arguments.tracking_lag_seconds),
+            to_samples(arguments.initial_lag_seconds)
+        ),
+        window_size,
+        sample_rate,
+        arguments.min_normalized_peak
+    )
+
+    print('*' * 70)
+    print('* Drift')
+    print('*' * 70)
+    print('Lag at the start: {} seconds'.format(
+        drift.offset_samples / float(sample_rate)
+    ))
+    print('Drift: {} ppm (ratio {})'.format(drift.ppm, drift.ratio))
+    print('Residual: {} samples (RMS, {} windows)'.format(
+        drift.residual_samples, drift.windows
+    ))
+    if arguments.compensate:
+        audio_output_file = get_audio_output_file(
+            arguments.audio_file_input_one
+        )
+        compensate(reader_one, audio_output_file, drift.ratio)
+        print('Lag after compensation: {} seconds'.format(
+            drift.offset_samples / drift.ratio / float(sample_rate)
+        ))
+        print('Saved: {}'.format(audio_output_file))
+    print('*' * 70)
+    reader_one.close()
+    reader_two.close()
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Clock drift between two recordings"
+    )
+    parser.add_argument('audio_file_input_one')
+    parser.add_argument('audio_file_input_two')
+    parser.add_argument(
+        '--window-seconds', type=float,
+        default=tracking.DEFAULT_WINDOW_SECONDS,
+        help="Length of every window (a multiple of the hop)"
+    )
+    parser.add_argument(
+        '--hop-seconds', type=float, default=tracking.DEFAULT_HOP_SECONDS,
+        help="Time between the starts of consecutive windows"
+    )
+    parser.add_argument(
+        '--max-lag-seconds', type=float,
+        default=tracking.DEFAULT_MAX_LAG_SECONDS,
+        help="Search lags within plus/minus this many seconds " +
+             "(of `--initial-lag-seconds`) for the first window"
+    )
+    parser.add_argument(
+        '--tracking-lag-seconds', type=float,
+        default=tracking.DEFAULT_TRACKING_LAG_SECONDS,
+        help="Search lags within plus/minus this many seconds of " +
+             "the previous window's lag for every other window"
+    )
+    parser.add_argument(
+        '--initial-lag-seconds', type=float, default=0.0,
+        help="Center of the search for the first window"
+    )
+    parser.add_argument(
+        '--min-normalized-peak', type=float,
+        default=DEFAULT_MIN_NORMALIZED_PEAK,
+        help="Leave windows with a lower normalized peak out of the fit"
+    )
+    parser.add_argument(
+        '--compensate', action='store_true',
+        help="Write `one` resampled to the clock of `two` to `./results/`"
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How audio files are read (`memmap` for uncompressed WAV)"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -23,6 +23,12 @@ Outputs
       file was WAV, the output file will be HDF5, and
       viceversa.
 
+HDF5 files hold the audio as a chunked dataset with the
+sample rate, number of channels and encoding as attributes
+(see `audio_io.py`), so any time slice can be read without
+decoding the whole file. Files with an `.h5` or `.hdf5`
+extension are taken as HDF5, anything else as audio.
+
 Dependencies
 ------------
 - h5py wrapper for HDF5 files
@@ -46,9 +52,14 @@ If the current directory structure is used:
 
 $ python ./code/hdf5_wav_translator.py ./audio/audio_file.hdf5
 
+The HDF5 dataset can be compressed (only when translating
+from WAV to HDF5):
+
+$ python ./code/hdf5_wav_translator.py ./audio/audio_file.wav \
+         --compression gzip --compression-level 4
+
 Notes
 -----
-- Second and following arguments are ignored
 - Results are stored in the `./results/` directory
 - If you get the:
   `IOError: [Errno 2] No such file or directory: './results/...`
@@ -74,19 +85,36 @@ Author
 """
 
 import sys
-import numpy
-import scipy.signal
-import scikits.audiolab
-import matplotlib
-import matplotlib.pyplot
+import argparse
 
-matplotlib.use('agg')
+import audio_io
 
 
 class Translator(object):
 
-    def __init__(self, audio_input_file):
+    def __init__(self, audio_input_file, backend='sndfile',
+                 compression=None, compression_level=None,
+                 block_size=audio_io.HDF5_CHUNK_FRAMES):
+        """Translator
+
+        Inputs
+        ------
+        - audio_input_file : str
+        - backend : str
+              How WAV input is read, one of `audio_io.BACKENDS`
+        - compression : str or None
+              HDF5 compression filter ('gzip' or 'lzf')
+        - compression_level : int or None
+              HDF5 compression level ('gzip' only)
+        - block_size : int
+              Frames translated at a time
+        """
+        self.backend = backend
+        self.compression = compression
+        self.compression_level = compression_level
+        self.block_size = block_size
         self.audio_input_file = audio_input_file
+        self.to_hdf5 = not audio_io.is_hdf5_file(audio_input_file)
         self.audio_output_file = self._get_audio_output_file()
         self._set_output_metadata()
         self._read_audio_data()
@@ -111,27 +139,48 @@ class Translator(object):
         self._print_number_of_samples(which_data)
         print('*' * 70)
 
-    def downsample(self):
-        self._check_valid_new_sample_rate()
-        self._open_and_setup_output_file()
-        self._perform_downsample()
-        self._write_and_close_output_file()
+    def translate(self):
+        try:
+            self._open_and_setup_output_file()
+            self._translate_blocks()
+            self._close_output_file()
+        finally:
+            self.audio_input_reader.close()
 
-    def _open_and_setup_output_file(self):
-        """Open and setup output file
+    def _translate_blocks(self):
+        """Translate blocks
 
-        To test, uncomment the commented line and comment the line directly
-        below it. This will avoid using the new sample rate and will leave
-        the original sample rate when saved. Needs to be done in conjuction
-        with the corresponding adjustment for `perform_downsample()`.
+        Copies `block_size` frames at a time, so memory
+        doesn't depend on the length of the file.
         """
+        reader = self.audio_input_reader
+        for start in range(0, reader.number_of_samples, self.block_size):
+            block = reader.read(
+                start, min(self.block_size, reader.number_of_samples - start)
+            )
+            if self.to_hdf5:
+                self.audio_output.write(block)
+            else:
+                self.audio_output.write_frames(block)
+
+    def _open_and_setup_output_file(self):
+        if self.to_hdf5:
+            self.audio_output = audio_io.HDF5Writer(
+                self.audio_output_file,
+                int(self.audio_input_sample_rate),
+                int(self.audio_input_number_of_channels),
+                self.audio_input_encoding,
+                compression=self.compression,
+                compression_level=self.compression_level
+            )
+            return
+        import scikits.audiolab
         try:
             self.audio_output = scikits.audiolab.Sndfile(
                 self.audio_output_file, 'w',
-                self.audio_input_format,
+                audio_io.sndfile_format(self.audio_input_reader),
                 int(self.audio_input_number_of_channels),
-                # int(self.audio_input_sample_rate)
-                int(self.new_sample_rate)
+                int(self.audio_input_sample_rate)
             )
         except Exception as e:
             raise ValueError(
@@ -139,27 +188,18 @@ class Translator(object):
                 "Full Python exception: {}.\n".format(e)
             )
 
-    def _write_and_close_output_file(self):
-        self.audio_output.write_frames(self.audio_to_write)
+    def _close_output_file(self):
         self._set_updated_output_metadata()
         self.audio_output.close()
 
     def _read_audio_data(self):
-        try:
-            sound_file = scikits.audiolab.Sndfile(self.audio_input_file, 'r')
-        except Exception as e:
-            raise ValueError(
-                "Could not open {}.\n".format(self.audio_input_file) +
-                "Full Python exception: {}.\n".format(e)
-            )
-        self.audio_input_format = sound_file.format
-        self.audio_input_encoding = sound_file.encoding
-        self.audio_input_sample_rate = sound_file.samplerate
-        self.audio_input_number_of_samples = sound_file.nframes
-        self.audio_input_number_of_channels = sound_file.channels
-        self.audio_input_data = sound_file.read_frames(
-            self.audio_input_number_of_samples
-        )
+        reader = audio_io.open_reader(self.audio_input_file, self.backend)
+        self.audio_input_reader = reader
+        self.audio_input_format = reader.format
+        self.audio_input_encoding = reader.encoding
+        self.audio_input_sample_rate = reader.sample_rate
+        self.audio_input_number_of_samples = reader.number_of_samples
+        self.audio_input_number_of_channels = reader.number_of_channels
 
     def _print_sample_rate(self, which_data):
         print_this = self._what_to_print(
@@ -188,6 +228,8 @@ class Translator(object):
     def _print_number_of_samples(self, which_data):
         if which_data == 'input':
             print_this = self.audio_input_number_of_samples
+        elif self.to_hdf5:
+            print_this = self.audio_output_number_of_samples
         else:
             print_this = 'Not supported yet by Audiolab'
         print("Number of samples: {}".format(print_this))
@@ -225,18 +267,15 @@ class Translator(object):
         self.audio_output_encoding = self.audio_output.encoding
         self.audio_output_sample_rate = self.audio_output.samplerate
         self.audio_output_number_of_channels = self.audio_output.channels
-
-        # Not yet supported by Audiolab
-        # self.audio_output_number_of_samples = self.audio_output.nframes
+        if self.to_hdf5:
+            self.audio_output_number_of_samples = self.audio_output.nframes
 
     def _get_audio_output_file(self):
-        return(
-            "./results/" +
-            self._get_file_name() +
-            "_downsampled_to_" +
-            self.new_sample_rate +
-            ".wav"
-        )
+        if self.to_hdf5:
+            extension = ".hdf5"
+        else:
+            extension = ".wav"
+        return("./results/" + self._get_file_name() + extension)
 
     def _get_file_name(self):
         """Get file name
@@ -253,13 +292,38 @@ def main(argv):
     if len(argv) < 1:
         raise ValueError("Needs `audio_input_file` (see instructions)")
 
-    audio_input_file = argv[0]
-
-    downsample = Translator(audio_input_file)
-
-    downsample.print_data('input')
-    downsample.translate()
-    downsample.print_data('output')
+    arguments = _parse_arguments(argv)
+
+    translator = Translator(
+        arguments.audio_input_file,
+        backend=arguments.backend,
+        compression=arguments.compression,
+        compression_level=arguments.compression_level
+    )
+
+    translator.print_data('input')
+    translator.translate()
+    translator.print_data('output')
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Translate between HDF5 and WAV file formats"
+    )
+    parser.add_argument('audio_input_file')
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How WAV input is read (`memmap` for uncompressed WAV)"
+    )
+    parser.add_argument(
+        '--compression', choices=('gzip', 'lzf'), default=None,
+        help="Compress the HDF5 dataset"
+    )
+    parser.add_argument(
+        '--compression-level', type=int, default=None,
+        help="Compression level (0 to 9, `gzip` only)"
+    )
+    return(parser.parse_args(argv))
 
 
 if __name__ == '__main__':
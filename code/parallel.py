@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Thread and process budget
+
+Functionality
+-------------
+- Run every FFT within a block of code with a given number of
+  threads (scipy.fft's `workers`, which `fftconvolve` and
+  `scipy.signal.resample` use as well)
+- Use pyFFTW as the scipy.fft backend when it's installed and
+  more than one thread is asked for
+- Split a thread budget between processes (one file each) and
+  FFT threads within each process
+- Import the heavy modules up front, for process pools and
+  timings (see `import_heavy_modules()`)
+
+Notes
+-----
+- scipy.fft (pocketfft) only splits independent transforms
+  between its threads: the channels of a multi-channel FFT, or
+  the two signals of `correlators.fft_correlation()`, which
+  are transformed together for that reason. pyFFTW also splits
+  single large transforms
+- A budget of `-1` means every core this process can run on
+  (`-2` all but one, and so on), like scipy.fft's `workers`
+- With many files, processes are preferred over threads: each
+  file is independent, so processes scale better than threads
+  within one FFT. Threads only get what's left once there is a
+  process per file
+"""
+
+import os
+import importlib
+import contextlib
+
+DEFAULT_WORKERS = 1
+
+#
+# Modules the scripts only import on first use (see
+# `check_startup_time.py`), imported by `import_heavy_modules()`
+#
+HEAVY_MODULES = ('scipy.fft', 'scipy.signal', 'scikits.audiolab')
+
+
+def cpu_count():
+    try:
+        return(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return(os.cpu_count() or 1)
+
+
+def get_workers(workers):
+    """Get workers
+
+    Number of threads for a budget of `workers` (None is
+    `DEFAULT_WORKERS`, negative values count from the number
+    of cores).
+    """
+    if workers is None:
+        return(DEFAULT_WORKERS)
+    workers = int(workers)
+    if workers == 0:
+        raise ValueError("The number of workers can't be zero")
+    if workers < 0:
+        return(max(cpu_count() + 1 + workers, 1))
+    return(workers)
+
+
+def split_budget(workers, number_of_jobs):
+    """Split budget
+
+    Outputs
+    -------
+    - processes : int
+          One per job, up to the budget
+    - threads : int
+          FFT threads for every process, so that processes
+          times threads stays within the budget
+    """
+    workers = get_workers(workers)
+    processes = max(min(workers, number_of_jobs), 1)
+    return(processes, max(workers // processes, 1))
+
+
+def import_heavy_modules():
+    """Import heavy modules
+
+    Imports `HEAVY_MODULES` now rather than on first use, which
+    in a process pool would happen in every process in the
+    middle of its first file, and in a benchmark would be timed
+    as part of the first step that needs them. Imported in the
+    parent of a pool, forked processes get them for free; as
+    the pool's initializer, each process imports them once, when
+    it starts.
+
+    A module that can't be imported is skipped: whatever needs it
+    fails on its own later, where that error is reported.
+    """
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except (ImportError, OSError):
+            pass
+
+
+@contextlib.contextmanager
+def fft_workers(workers):
+    """FFT workers
+
+    Every scipy.fft transform within the `with` block runs with
+    `get_workers(workers)` threads (through pyFFTW, if it's
+    installed and there is more than one).
+    """
+    import scipy.fft
+    workers = get_workers(workers)
+    backend = _get_pyfftw_backend(workers) if workers > 1 else None
+    with scipy.fft.set_workers(workers):
+        if backend is None:
+            yield
+        else:
+            with scipy.fft.set_backend(backend):
+                yield
+
+
+def _get_pyfftw_backend(workers):
+    try:
+        import pyfftw
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.scipy_fft
+    except ImportError:
+        return(None)
+    pyfftw.config.NUM_THREADS = workers
+    # Keeps the plans of repeated sizes (blocks, pyramid levels)
+    pyfftw.interfaces.cache.enable()
+    return(pyfftw.interfaces.scipy_fft)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Plotting of long signals
+
+Functionality
+-------------
+- Min/max envelope of a signal (in memory or read block by
+  block from an `audio_io` reader) with one value pair per
+  pixel column of the graph
+- Drawing of those envelopes on matplotlib axes
+
+A graph can't show more than one vertical line per pixel
+column, so plotting every sample of an hour of audio spends
+time and memory on points that end up on top of each other.
+The envelope keeps, for every column, the lowest and highest
+sample that falls in it, which is exactly what would have
+been drawn, and its size depends only on the width of the
+graph.
+
+Figures are made by the callers (`analysis.py`,
+`downsampling.py`) with the pyplot module returned by
+`get_pyplot()`, so matplotlib is only imported when a graph
+is actually made.
+"""
+
+import numpy
+
+#
+# Frames read at a time by `reader_envelope()`
+#
+ENVELOPE_BLOCK_SIZE = 1024 ** 2
+
+
+def envelope(data, columns):
+    """Envelope
+
+    Inputs
+    ------
+    - data : numpy.ndarray
+          Frames along the first axis
+    - columns : int
+          Number of pixel columns
+
+    Outputs
+    -------
+    - positions : numpy.ndarray
+          Frame at the center of every column
+    - minimum : numpy.ndarray
+    - maximum : numpy.ndarray
+          Lowest and highest frame values of every column
+          (columns along the first axis, then channels)
+
+    An empty signal has an empty envelope (no columns).
+    """
+    if len(data) == 0:
+        return(_empty_envelope(numpy.shape(data)[1:]))
+    edges = _column_edges(len(data), columns)
+    return(
+        _column_positions(edges),
+        numpy.minimum.reduceat(data, edges[:-1], axis=0),
+        numpy.maximum.reduceat(data, edges[:-1], axis=0)
+    )
+
+
+def reader_envelope(reader, columns, block_size=ENVELOPE_BLOCK_SIZE):
+    """Reader envelope
+
+    Same as `envelope()`, reading `block_size` frames at a time
+    from an `audio_io` reader, so the signal is never in memory.
+    """
+    if reader.number_of_samples == 0:
+        if int(reader.number_of_channels) == 1:
+            return(_empty_envelope(()))
+        return(_empty_envelope((int(reader.number_of_channels),)))
+    edges = _column_edges(reader.number_of_samples, columns)
+    minimum = None
+    maximum = None
+    for start in range(0, reader.number_of_samples, block_size):
+        block = reader.read(
+            start, min(block_size, reader.number_of_samples - start)
+        )
+        end = start + len(block)
+        inner_edges = edges[(edges > start) & (edges < end)]
+        offsets = numpy.concatenate(([start], inner_edges)) - start
+        indexes = numpy.searchsorted(edges, start + offsets, 'right') - 1
+        if minimum is None:
+            shape = (len(edges) - 1,) + block.shape[1:]
+            minimum = numpy.full(shape, numpy.inf)
+            maximum = numpy.full(shape, -numpy.inf)
+        numpy.minimum.at(
+            minimum, indexes, numpy.minimum.reduceat(block, offsets, axis=0)
+        )
+        numpy.maximum.at(
+            maximum, indexes, numpy.maximum.reduceat(block, offsets, axis=0)
+        )
+    return(_column_positions(edges), minimum, maximum)
+
+
+def plot_envelope(axes, times, minimum, maximum, color):
+    """Plot envelope
+
+    Fills the area between `minimum` and `maximum` (one column
+    per channel, if there are many) at `times`.
+    """
+    if numpy.ndim(minimum) == 1:
+        minimum = numpy.reshape(minimum, (-1, 1))
+        maximum = numpy.reshape(maximum, (-1, 1))
+    for channel in range(minimum.shape[1]):
+        axes.fill_between(
+            times, minimum[:, channel], maximum[:, channel],
+            color=color, edgecolor=color, linewidth=0.5
+        )
+
+
+def get_pyplot():
+    """Get pyplot
+
+    Imports `matplotlib.pyplot` (the slowest import of all the
+    scripts) with the non-interactive `agg` backend, which has
+    to be selected before pyplot is imported.
+    """
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot
+    return(matplotlib.pyplot)
+
+
+def get_columns(figure):
+    """Get columns
+
+    Width of `figure` in pixels, as it will be saved.
+    """
+    return(int(figure.get_figwidth() * figure.dpi))
+
+
+def _column_edges(number_of_frames, columns):
+    columns = max(min(int(columns), number_of_frames), 1)
+    return(numpy.linspace(0, number_of_frames, columns + 1).astype(int))
+
+
+def _empty_envelope(channels_shape):
+    empty = numpy.zeros((0,) + tuple(channels_shape))
+    return(numpy.zeros(0), empty, empty.copy())
+
+
+def _column_positions(edges):
+    return((edges[:-1] + edges[1:] - 1) / 2.0)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""
+Search of a short clip inside a long recording
+
+Functionality
+-------------
+- Find where a short reference clip occurs in a long recording
+  (seconds in hours), returning the best `--top` matches with
+  their time and a normalized score
+- Stream the long recording through overlap-save blocks sized
+  to the clip, so memory depends on the clip and not on the
+  length of the recording
+- Transform the clip only once, and the recording once per
+  block
+
+Inputs
+------
+- audio_file_input_long : str
+- audio_file_input_clip : str
+      Any file `analysis.py` reads, mono and with the same
+      sample rate
+
+Outputs
+-------
+- matches : CSV
+      One row per match with its start (in samples and seconds
+      of the long recording), its score and the correlation peak.
+      It will be stored with the name of the clip, `_in_`, the
+      name of the long recording and "_matches.csv" at the end
+
+Results are stored in the `./results/` directory
+
+Execution
+---------
+$ python ./code/search.py \
+         ./audio/archive_12_hours.wav \
+         ./audio/reference_clip.wav
+
+$ python ./code/search.py \
+         ./audio/archive_12_hours.wav \
+         ./audio/reference_clip.wav \
+         --top 10 --min-score 0.5 --backend memmap
+
+Notes
+-----
+- The score of a position is the correlation of the clip with
+  the segment of the recording starting there, divided by the
+  norms of both (the cosine between them): 1 for an exact copy
+  at any gain, -1 for an inverted one, and close to zero for
+  unrelated audio, so thresholds work across files
+- Matches are ranked by the absolute score, and are at least
+  `--min-separation-seconds` apart (the length of the clip by
+  default), so one occurrence isn't reported many times
+- Only positions where the whole clip fits in the recording
+  are scored
+"""
+
+import os
+import sys
+import argparse
+import collections
+import numpy
+
+import audio_io
+import tracking
+
+#
+# Blocks of the long recording are the next fast FFT length
+# from this many times the length of the clip: every block
+# gives `block size - clip length + 1` positions, so larger
+# factors waste less of each FFT on the overlap, at the cost
+# of memory.
+#
+SEARCH_BLOCK_FACTOR = 4
+
+#
+# Segments with less energy than this fraction of the clip's
+# (100 dB below it) are scored as if they had that much, so
+# silence, where the energy is only rounding error, scores
+# close to zero.
+#
+SEARCH_MIN_RELATIVE_ENERGY = 1e-10
+
+DEFAULT_TOP = 5
+
+#
+# Match of the clip, returned by `search()`:
+#
+# - samples : int
+#       Frame of the long recording where the clip starts
+# - seconds : float
+#       `samples` in seconds
+# - score : float
+#       Normalized correlation (see the notes above)
+# - peak : float
+#       Correlation before normalizing
+#
+Match = collections.namedtuple(
+    'Match', ['samples', 'seconds', 'score', 'peak']
+)
+
+
+def search(reader, clip, top=DEFAULT_TOP, min_separation=None,
+           min_score=0.0, block_size=None):
+    """Search
+
+    Inputs
+    ------
+    - reader : audio_io reader
+          The long recording
+    - clip : numpy.ndarray
+          The clip, in memory
+    - top : int
+          Maximum number of matches
+    - min_separation : int or None
+          Minimum distance between matches, in frames (the
+          length of the clip if None, and at least 1)
+    - min_score : float
+          Matches with a lower absolute score are dropped
+    - block_size : int or None
+          FFT size of every block (see `SEARCH_BLOCK_FACTOR`
+          for the default), at least twice the length of the
+          clip
+
+    Outputs
+    -------
+    - matches : list of Match
+          Sorted by decreasing absolute score
+
+    Overlap-save: every block of the recording keeps the last
+    `len(clip) - 1` frames of the previous one, is transformed,
+    multiplied by the conjugate spectrum of the clip (computed
+    once) and transformed back. The circular correlation is
+    valid for the first `block_size - len(clip) + 1` positions.
+    The energy of the segment at every position comes from a
+    cumulative sum of squares over the block. Memory is a few
+    arrays of `block_size`, whatever the length of the recording.
+    """
+    import scipy.fft
+    clip = numpy.asarray(clip, dtype=numpy.float64)
+    clip_length = len(clip)
+    clip_energy = float(numpy.sum(numpy.square(clip)))
+    if clip_length == 0 or clip_energy == 0:
+        raise ValueError("The clip is empty or silent")
+    if block_size is None:
+        block_size = scipy.fft.next_fast_len(SEARCH_BLOCK_FACTOR * clip_length)
+    # Shorter blocks give so few positions each that the search
+    # would be slower than a direct correlation
+    if block_size < 2 * clip_length:
+        raise ValueError(
+            "The block size ({}) should be at least ".format(block_size) +
+            "twice the length of the clip ({})".format(clip_length)
+        )
+    if min_separation is None:
+        min_separation = clip_length
+    # Zero would suppress nothing, and report one position `top` times
+    min_separation = max(1, int(min_separation))
+    sample_rate = float(int(reader.sample_rate))
+    clip_spectrum = numpy.conj(scipy.fft.rfft(clip, block_size))
+    step = block_size - clip_length + 1
+    last_position = int(reader.number_of_samples) - clip_length
+    matches = []
+    tail = numpy.zeros(0)
+    read_position = 0
+    for position in range(0, last_position + 1, step):
+        count = block_size - len(tail)
+        segment = numpy.concatenate((tail, reader.read(read_position, count)))
+        read_position += count
+        tail = segment[step:]
+        correlation = scipy.fft.irfft(
+            scipy.fft.rfft(segment) * clip_spectrum, block_size
+        )[:min(step, last_position + 1 - position)]
+        energies = numpy.zeros(block_size + 1)
+        numpy.cumsum(numpy.square(segment), out=energies[1:])
+        energies = (
+            energies[clip_length:clip_length + len(correlation)] -
+            energies[:len(correlation)]
+        )
+        scores = correlation / numpy.sqrt(clip_energy * numpy.maximum(
+            energies, SEARCH_MIN_RELATIVE_ENERGY * clip_energy
+        ))
+        matches = _best_matches(
+            matches + _block_matches(
+                correlation, scores, position, sample_rate, top,
+                min_separation, min_score
+            ),
+            top, min_separation
+        )
+    return(matches)
+
+
+def _block_matches(correlation, scores, position, sample_rate, top,
+                   min_separation, min_score):
+    """Block matches
+
+    Up to `top` local maxima of the absolute score in a block,
+    at least `min_separation` apart.
+    """
+    magnitudes = abs(scores)
+    matches = []
+    for _ in range(top):
+        index = int(numpy.argmax(magnitudes))
+        # Suppressed positions are negative
+        if magnitudes[index] < min_score or magnitudes[index] < 0:
+            break
+        matches.append(Match(
+            samples=position + index,
+            seconds=(position + index) / sample_rate,
+            score=float(scores[index]),
+            peak=float(correlation[index])
+        ))
+        magnitudes[
+            max(index - min_separation + 1, 0):index + min_separation
+        ] = -1
+    return(matches)
+
+
+def _best_matches(matches, top, min_separation):
+    """Best matches
+
+    Greedy non-maximum suppression: the best matches by absolute
+    score, dropping any within `min_separation` of a better one.
+    """
+    best = []
+    for match in sorted(matches, key=lambda m: -abs(m.score)):
+        if all(abs(match.samples - b.samples) >= min_separation for b in best):
+            best.append(match)
+            if len(best) == top:
+                break
+    return(best)
+
+
+def save_matches(matches, csv_path):
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    with open(csv_path, 'w') as csv_file:
+        csv_file.write(",".join(Match._fields) + "\n")
+        for match in matches:
+            csv_file.write(",".join(str(value) for value in match) + "\n")
+
+
+def get_csv_file_output(audio_file_long, audio_file_clip):
+    file_name_long = audio_file_long.split("/")[-1].split(".")[0]
+    file_name_clip = audio_file_clip.split("/")[-1].split(".")[0]
+    return(
+        "./results/" + file_name_clip + "_in_" + file_name_long +
+        "_matches.csv"
+    )
+
+
+def main(argv):
+
+    if len(argv) < 2:
+        raise ValueError(
+            "Needs `audio_file_input_long` and `audio_file_input_clip` " +
+            "arguments (see code instructions)"
+        )
+
+    arguments = _parse_arguments(argv)
+
+    reader, clip_reader = tracking.open_readers(
+        arguments.audio_file_input_long,
+        arguments.audio_file_input_clip,
+        arguments.backend
+    )
+    sample_rate = int(reader.sample_rate)
+    clip = clip_reader.read_all()
+    clip_reader.close()
+    if arguments.min_separation_seconds is None:
+        min_separation = None
+    else:
+        min_separation = int(round(
+            arguments.min_separation_seconds * sample_rate
+        ))
+
+    matches = search(
+        reader,
+        clip,
+        top=arguments.top,
+        min_separation=min_separation,
+        min_score=arguments.min_score,
+        block_size=arguments.block_size
+    )
+    reader.close()
+
+    print('*' * 70)
+    print('* Matches (start in seconds, score)')
+    print('*' * 70)
+    for match in matches:
+        print('{:14.6f} {:+.6f}'.format(match.seconds, match.score))
+    if not matches:
+        print('No matches')
+    print('*' * 70)
+    csv_path = get_csv_file_output(
+        arguments.audio_file_input_long, arguments.audio_file_input_clip
+    )
+    save_matches(matches, csv_path)
+    print('Saved: {}'.format(csv_path))
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Find a short clip inside a long recording"
+    )
+    parser.add_argument('audio_file_input_long')
+    parser.add_argument('audio_file_input_clip')
+    parser.add_argument(
+        '--top', type=int, default=DEFAULT_TOP,
+        help="Maximum number of matches"
+    )
+    parser.add_argument(
+        '--min-score', type=float, default=0.0,
+        help="Drop matches with a lower absolute score (from 0 to 1)"
+    )
+    parser.add_argument(
+        '--min-separation-seconds', type=float, default=None,
+        help="Minimum time between matches (the clip's length by default)"
+    )
+    parser.add_argument(
+        '--block-size', type=int, default=None,
+        help="FFT size of the blocks of the long recording, at least " +
+             "twice the clip (about {} times by default)".format(
+                 SEARCH_BLOCK_FACTOR
+             )
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How audio files are read (`memmap` for uncompressed WAV)"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic signals
+
+Functionality
+-------------
+- White noise and linear chirps, with any number of channels
+- Delayed copies of a signal, by any (integer or fractional)
+  number of samples
+- Pairs of recordings with a known delay between them and
+  independent noise at a given signal to noise ratio
+- Writing them to WAV files for the scripts to read
+
+Used by `benchmark.py` and `accuracy.py`, so their results
+can be reproduced from a seed instead of depending on audio
+files that aren't in the repository.
+
+Conventions
+-----------
+`delayed_pair()` returns `(one, two)` such that `one[n + lag]`
+matches `two[n]` for the `lag` given, which is the lag that
+`Analysis.lag()` should find.
+"""
+
+import numpy
+
+#
+# Peak amplitude of generated signals, low enough for noise
+# to be added without clipping when writing 16 bit PCM.
+#
+PEAK_AMPLITUDE = 0.25
+
+SIGNALS = ('noise', 'chirp')
+
+
+def white_noise(number_of_samples, number_of_channels=1, seed=0):
+    generator = numpy.random.RandomState(seed)
+    data = generator.randn(number_of_samples, number_of_channels)
+    return(_normalize(data))
+
+
+def chirp(number_of_samples, sample_rate, number_of_channels=1,
+          low_frequency=20.0, high_frequency=None):
+    """Chirp
+
+    Linear sweep from `low_frequency` up to `high_frequency`
+    (a quarter of the sample rate by default) over the whole
+    signal. Channels are the same sweep, one sample apart.
+    """
+    if high_frequency is None:
+        high_frequency = sample_rate / 4.0
+    time = numpy.arange(number_of_samples + number_of_channels) / float(
+        sample_rate
+    )
+    duration = number_of_samples / float(sample_rate)
+    rate = (high_frequency - low_frequency) / duration
+    sweep = numpy.sin(
+        2 * numpy.pi * (low_frequency * time + 0.5 * rate * time ** 2)
+    )
+    data = numpy.column_stack([
+        sweep[channel:channel + number_of_samples]
+        for channel in range(number_of_channels)
+    ])
+    return(_normalize(data))
+
+
+def make_signal(kind, number_of_samples, sample_rate, number_of_channels=1,
+                seed=0):
+    """Make signal
+
+    One of `SIGNALS`, frames x channels.
+    """
+    if kind == 'noise':
+        return(white_noise(number_of_samples, number_of_channels, seed))
+    if kind == 'chirp':
+        return(chirp(number_of_samples, sample_rate, number_of_channels))
+    raise ValueError(
+        "Unknown signal ({}), ".format(kind) +
+        "should be one of: {}".format(", ".join(SIGNALS))
+    )
+
+
+def delay(data, delay_samples):
+    """Delay
+
+    Inputs
+    ------
+    - data : numpy.ndarray
+          Frames along the first axis
+    - delay_samples : float
+          Positive delays move the signal later; fractional
+          delays are band-limited (linear phase in frequency)
+
+    Outputs
+    -------
+    - delayed : numpy.ndarray
+          Same shape as `data`: `delayed[n] = data[n - delay]`,
+          with zeros where `data` is out of range
+    """
+    import scipy.fft
+    length = len(data)
+    padding = int(numpy.ceil(abs(delay_samples))) + 1
+    fft_size = scipy.fft.next_fast_len(length + padding)
+    spectrum = numpy.fft.rfft(data, fft_size, axis=0)
+    frequencies = numpy.fft.rfftfreq(fft_size)
+    shift = numpy.exp(-2j * numpy.pi * frequencies * delay_samples)
+    spectrum *= numpy.reshape(shift, (-1,) + (1,) * (data.ndim - 1))
+    delayed = numpy.fft.irfft(spectrum, fft_size, axis=0)[:length]
+    if delay_samples == int(delay_samples):
+        # Integer delays are exact: no leakage into the zeros
+        shift = int(delay_samples)
+        delayed[:max(shift, 0)] = 0.0
+        delayed[length + min(shift, 0):] = 0.0
+    return(delayed)
+
+
+def delayed_pair(data, lag, snr_db=None, seed=0):
+    """Delayed pair
+
+    Inputs
+    ------
+    - data : numpy.ndarray
+    - lag : float
+          Lag between the two recordings, in samples
+    - snr_db : float or None
+          If given, independent white noise is added to each
+          recording at this signal to noise ratio (in dB)
+    - seed : int
+
+    Outputs
+    -------
+    - one : numpy.ndarray
+          `data` delayed by `lag`
+    - two : numpy.ndarray
+          `data`
+    """
+    one = delay(data, lag)
+    two = numpy.array(data, dtype=numpy.float64)
+    if snr_db is not None:
+        generator = numpy.random.RandomState(seed + 1)
+        noise_power = numpy.mean(numpy.square(data)) / 10 ** (snr_db / 10.0)
+        one += numpy.sqrt(noise_power) * generator.randn(*one.shape)
+        two += numpy.sqrt(noise_power) * generator.randn(*two.shape)
+    return(one, two)
+
+
+def write_wav(audio_file, data, sample_rate, encoding='pcm16'):
+    """Write WAV
+
+    Writes frames x channels `data` (clipped to [-1, 1]) the
+    same way `downsampling.py` writes its output.
+    """
+    import scikits.audiolab
+    data = numpy.clip(numpy.reshape(data, (len(data), -1)), -1.0, 1.0)
+    sound_file = scikits.audiolab.Sndfile(
+        audio_file, 'w',
+        scikits.audiolab.Format('wav', encoding),
+        data.shape[1],
+        int(sample_rate)
+    )
+    sound_file.write_frames(data)
+    sound_file.close()
+
+
+def _normalize(data):
+    peak = numpy.max(abs(data))
+    if peak == 0:
+        return(data)
+    return(data * (PEAK_AMPLITUDE / peak))
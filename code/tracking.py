@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time-varying lag tracking
+
+Functionality
+-------------
+- Estimate the lag between two long recordings over sliding
+  windows (of `--window-seconds`, every `--hop-seconds`), as
+  a time series instead of one global lag
+- Stream both files: only one hop of `two` and the segment
+  of `one` it overlaps are read at a time
+- Search the whole `--max-lag-seconds` window only for the
+  first window, and then only `--tracking-lag-seconds` around
+  the lag of the previous window
+
+Inputs
+------
+- audio_file_input_one : str
+- audio_file_input_two : str
+      Any file `analysis.py` reads, mono and with the same
+      sample rate
+
+Outputs
+-------
+- lags : CSV
+      One row per window with its start (in seconds of `two`),
+      the lag (in samples and seconds), the peak and the
+      normalized peak. It will be stored with the name of the
+      two filenames supplied concatenated and appending
+      "_tracked_lags.csv" at the end
+
+Results are stored in the `./results/` directory
+
+Execution
+---------
+$ python ./code/tracking.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav
+
+$ python ./code/tracking.py \
+         ./audio/audio_file_one.wav \
+         ./audio/audio_file_two.wav \
+         --window-seconds 30 --hop-seconds 10 \
+         --max-lag-seconds 5 --tracking-lag-seconds 0.01
+
+Notes
+-----
+- The lag is such that `one[n + lag]` matches `two[n]` (see
+  `Analysis.lag()`), for the frames `n` of each window
+- Every hop of `two` is correlated only once: the correlation
+  of a window is the sum of the correlations of its hops, so
+  overlapping windows share them and the cost doesn't depend on
+  how much the windows overlap. For that, the window has to be
+  a whole number of hops
+- The tracking window has to be wide enough for the lag to
+  move between two consecutive windows (at 50 ppm of drift,
+  the lag moves 0.5 ms every 10 seconds); if the lag jumps
+  further, it's lost until the search is restarted
+"""
+
+import os
+import sys
+import time
+import argparse
+import collections
+import numpy
+
+import audio_io
+import correlators
+
+DEFAULT_WINDOW_SECONDS = 10.0
+DEFAULT_HOP_SECONDS = 5.0
+DEFAULT_MAX_LAG_SECONDS = 1.0
+DEFAULT_TRACKING_LAG_SECONDS = 0.05
+
+#
+# Lag of one window, yielded by `track_lags()`:
+#
+# - time : float
+#       Start of the window, in seconds of `two`
+# - samples, sub_samples, seconds, peak, normalized_peak
+#       See `Lag` in `analysis.py`; the normalized peak uses
+#       the energies of the window of `two` and of the
+#       segment of `one` it matches at that lag
+#
+TrackedLag = collections.namedtuple(
+    'TrackedLag',
+    ['time', 'samples', 'sub_samples', 'seconds', 'peak', 'normalized_peak']
+)
+
+#
+# Correlation of one hop of `two` for the lags starting at
+# `first_lag`, with its energy and the running energy of the
+# segment of `one` it was correlated against.
+#
+_Hop = collections.namedtuple(
+    '_Hop', ['first_lag', 'correlation', 'energy_two', 'energies_one']
+)
+
+
+def track_lags(reader_one, reader_two, window_size, hop_size, max_lag,
+               tracking_lag=None, initial_lag=0):
+    """Track lags
+
+    Inputs
+    ------
+    - reader_one : audio_io reader
+    - reader_two : audio_io reader
+    - window_size : int
+          Frames of `two` per window, a multiple of `hop_size`
+    - hop_size : int
+          Frames between the starts of consecutive windows
+    - max_lag : int
+          Lags within plus/minus this many samples of
+          `initial_lag` are searched for the first window
+    - tracking_lag : int or None
+          Lags within plus/minus this many samples of the
+          previous window's lag are searched for every other
+          window (`max_lag` if None)
+    - initial_lag : int
+
+    Outputs
+    -------
+    - lags : generator of TrackedLag
+          One per window, as soon as its last hop is read
+
+    Each hop is correlated (see `correlators.correlate_valid()`)
+    against the segment of `one` it overlaps for the lags being
+    searched when it's read, and kept until the last window it's
+    in. The lags of a window are those searched by all of its
+    hops, which always include the lag of the previous window.
+    The window and hop are checked when this is called, before
+    the first lag is asked for.
+    """
+    if window_size % hop_size != 0:
+        raise ValueError(
+            "The window ({} frames) ".format(window_size) +
+            "should be a multiple of the hop ({} frames)".format(hop_size)
+        )
+    length_two = int(reader_two.number_of_samples)
+    if window_size > length_two:
+        raise ValueError(
+            "The window ({} frames) is longer ".format(window_size) +
+            "than two ({} frames)".format(length_two)
+        )
+    if tracking_lag is None:
+        tracking_lag = max_lag
+    return(_track_lags(
+        reader_one, reader_two, window_size, hop_size, max_lag,
+        tracking_lag, initial_lag
+    ))
+
+
+def _track_lags(reader_one, reader_two, window_size, hop_size, max_lag,
+                tracking_lag, initial_lag):
+    length_two = int(reader_two.number_of_samples)
+    sample_rate = float(int(reader_two.sample_rate))
+    hops = collections.deque(maxlen=window_size // hop_size)
+    center = int(initial_lag)
+    search = int(max_lag)
+    for start in range(0, length_two - hop_size + 1, hop_size):
+        hops.append(_correlate_hop(
+            reader_one, reader_two, start, hop_size, center - search,
+            2 * search + 1
+        ))
+        if len(hops) < hops.maxlen:
+            continue
+        lag = _window_lag(hops, hop_size)
+        yield(lag._replace(
+            time=(start + hop_size - window_size) / sample_rate,
+            seconds=lag.sub_samples / sample_rate
+        ))
+        center = lag.samples
+        search = int(tracking_lag)
+
+
+def _correlate_hop(reader_one, reader_two, start, hop_size, first_lag,
+                   number_of_lags):
+    block = reader_two.read(start, hop_size)
+    segment = reader_one.read(start + first_lag, hop_size + number_of_lags - 1)
+    energies_one = numpy.zeros(len(segment) + 1)
+    numpy.cumsum(numpy.square(segment), out=energies_one[1:])
+    return(_Hop(
+        first_lag=first_lag,
+        correlation=correlators.correlate_valid(segment, block),
+        energy_two=float(numpy.sum(numpy.square(block))),
+        energies_one=energies_one
+    ))
+
+
+def _window_lag(hops, hop_size):
+    """Window lag
+
+    Sums the correlations of the hops over the lags they have
+    in common and locates the peak (`time` and `seconds` are
+    left for the caller).
+    """
+    first_lag = max(hop.first_lag for hop in hops)
+    last_lag = min(hop.first_lag + len(hop.correlation) for hop in hops)
+    correlation = numpy.zeros(last_lag - first_lag)
+    for hop in hops:
+        offset = first_lag - hop.first_lag
+        correlation += hop.correlation[offset:offset + len(correlation)]
+    index = int(numpy.argmax(abs(correlation)))
+    samples = first_lag + index
+    peak = float(correlation[index])
+    energy_one = 0.0
+    for hop in hops:
+        offset = samples - hop.first_lag
+        energy_one += (
+            hop.energies_one[offset + hop_size] - hop.energies_one[offset]
+        )
+    energy = energy_one * sum(hop.energy_two for hop in hops)
+    if energy > 0:
+        normalized_peak = abs(peak) / float(numpy.sqrt(energy))
+    else:
+        normalized_peak = 0.0
+    return(TrackedLag(
+        time=None,
+        samples=samples,
+        sub_samples=(
+            samples + correlators.parabolic_peak_offset(correlation, index)
+        ),
+        seconds=None,
+        peak=peak,
+        normalized_peak=normalized_peak
+    ))
+
+
+def save_lags(lags, csv_path):
+    """Save lags
+
+    Writes every `TrackedLag` in `lags` (any iterable, so the
+    generator of `track_lags()` is written as it goes) and
+    returns them as a list.
+    """
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    saved = []
+    with open(csv_path, 'w') as csv_file:
+        csv_file.write(",".join(TrackedLag._fields) + "\n")
+        for lag in lags:
+            csv_file.write(",".join(str(value) for value in lag) + "\n")
+            saved.append(lag)
+    return(saved)
+
+
+def get_csv_file_output(audio_file_one, audio_file_two):
+    file_name_one = audio_file_one.split("/")[-1].split(".")[0]
+    file_name_two = audio_file_two.split("/")[-1].split(".")[0]
+    return(
+        "./results/" + file_name_one + "_vs_" + file_name_two +
+        "_tracked_lags.csv"
+    )
+
+
+def open_readers(audio_file_one, audio_file_two, backend='sndfile'):
+    """Open readers
+
+    Readers for both files, checking that they are mono and
+    have the same sample rate.
+    """
+    readers = []
+    for audio_file in (audio_file_one, audio_file_two):
+        reader = audio_io.open_reader(audio_file, backend)
+        if int(reader.number_of_channels) != 1:
+            raise ValueError(
+                "Lag tracking needs mono files " +
+                "({} has {} channels)".format(
+                    audio_file, reader.number_of_channels
+                )
+            )
+        readers.append(reader)
+    sample_rates = [int(reader.sample_rate) for reader in readers]
+    if sample_rates[0] != sample_rates[1]:
+        raise ValueError(
+            "Both files need the same sample rate " +
+            "(found: {} and {})".format(*sample_rates)
+        )
+    return(tuple(readers))
+
+
+def main(argv):
+
+    if len(argv) < 2:
+        raise ValueError(
+            "Needs `audio_file_input_one` and `audio_file_input_two` " +
+            "arguments (see code instructions)"
+        )
+
+    arguments = _parse_arguments(argv)
+
+    reader_one, reader_two = open_readers(
+        arguments.audio_file_input_one,
+        arguments.audio_file_input_two,
+        arguments.backend
+    )
+    sample_rate = int(reader_two.sample_rate)
+
+    def to_samples(seconds):
+        return(int(round(seconds * sample_rate)))
+
+    start = time.perf_counter()
+    csv_path = get_csv_file_output(
+        arguments.audio_file_input_one, arguments.audio_file_input_two
+    )
+    lags = save_lags(
+        track_lags(
+            reader_one,
+            reader_two,
+            to_samples(arguments.window_seconds),
+            to_samples(arguments.hop_seconds),
+            to_samples(arguments.max_lag_seconds),
+            to_samples(arguments.tracking_lag_seconds),
+            to_samples(arguments.initial_lag_seconds)
+        ),
+        csv_path
+    )
+    seconds = time.perf_counter() - start
+    reader_one.close()
+    reader_two.close()
+
+    lag_seconds = [lag.seconds for lag in lags]
+    print('*' * 70)
+    print('* Results')
+    print('*' * 70)
+    print('Windows: {}'.format(len(lags)))
+    print('First lag: {} seconds'.format(lag_seconds[0]))
+    print('Last lag: {} seconds'.format(lag_seconds[-1]))
+    print('Lag range: {} to {} seconds'.format(
+        min(lag_seconds), max(lag_seconds)
+    ))
+    print('Lowest normalized peak: {}'.format(
+        min(lag.normalized_peak for lag in lags)
+    ))
+    print('Speed: {:.1f} times real time'.format(
+        reader_two.number_of_samples / float(sample_rate) / seconds
+    ))
+    print('Saved: {}'.format(csv_path))
+    print('*' * 70)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Lag between two recordings over sliding windows"
+    )
+    parser.add_argument('audio_file_input_one')
+    parser.add_argument('audio_file_input_two')
+    parser.add_argument(
+        '--window-seconds', type=float, default=DEFAULT_WINDOW_SECONDS,
+        help="Length of every window (a multiple of the hop)"
+    )
+    parser.add_argument(
+        '--hop-seconds', type=float, default=DEFAULT_HOP_SECONDS,
+        help="Time between the starts of consecutive windows"
+    )
+    parser.add_argument(
+        '--max-lag-seconds', type=float, default=DEFAULT_MAX_LAG_SECONDS,
+        help="Search lags within plus/minus this many seconds " +
+             "(of `--initial-lag-seconds`) for the first window"
+    )
+    parser.add_argument(
+        '--tracking-lag-seconds', type=float,
+        default=DEFAULT_TRACKING_LAG_SECONDS,
+        help="Search lags within plus/minus this many seconds of " +
+             "the previous window's lag for every other window"
+    )
+    parser.add_argument(
+        '--initial-lag-seconds', type=float, default=0.0,
+        help="Center of the search for the first window"
+    )
+    parser.add_argument(
+        '--backend', choices=audio_io.BACKENDS, default='sndfile',
+        help="How audio files are read (`memmap` for uncompressed WAV)"
+    )
+    return(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+"""
+The scripts in `code/` import each other as top-level modules
+(they are run as `python ./code/<script>.py`), so the tests
+import them the same way.
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import pytest
+
+import analysis
+import audio_io
+import synthetic
+
+h5py = pytest.importorskip('h5py')
+
+SAMPLE_RATE = 8192
+
+
+def _write(path, data):
+    writer = audio_io.HDF5Writer(
+        str(path), SAMPLE_RATE, numpy.reshape(data, (len(data), -1)).shape[1],
+        'float64'
+    )
+    writer.write(data)
+    writer.close()
+    return(str(path))
+
+
+def _pair(tmp_path, lag, number_of_channels=1):
+    data = synthetic.make_signal(
+        'noise', 2 * SAMPLE_RATE, SAMPLE_RATE, number_of_channels
+    )
+    if number_of_channels == 1:
+        data = data[:, 0]
+    one, two = synthetic.delayed_pair(data, lag)
+    return(
+        _write(tmp_path / 'one.hdf5', one),
+        _write(tmp_path / 'two.hdf5', two)
+    )
+
+
+@pytest.mark.parametrize('lag', [37, -120, 0])
+def test_lag_is_where_one_matches_two(tmp_path, lag):
+    # `one` is `two` delayed by `lag`, so `one[n + lag] == two[n]`
+    estimator = analysis.Analysis(*_pair(tmp_path, lag))
+    estimator.correlation()
+    result = estimator.lag()
+    assert result.samples == lag
+    assert result.seconds == pytest.approx(lag / float(SAMPLE_RATE), abs=1e-6)
+    lags = estimator.correlation_lags()
+    assert lags[numpy.argmax(abs(estimator.correlation))] == lag
+
+
+@pytest.mark.parametrize('number_of_channels', [1, 2])
+def test_streaming_matches_the_full_correlation(tmp_path,
+                                                number_of_channels):
+    files = _pair(tmp_path, 37, number_of_channels)
+    full = analysis.Analysis(*files)
+    full.correlation()
+    streamed = analysis.Analysis(
+        *files, block_size=4096, max_lag_seconds=0.05
+    )
+    streamed.correlation()
+    lags = streamed.correlation_lags()
+    indexes = lags + int(full.correlation_zero_index)
+    numpy.testing.assert_allclose(
+        streamed.correlation, full.correlation[indexes], atol=1e-9
+    )
+    assert streamed.lag().samples == full.lag().samples == 37
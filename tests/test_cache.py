@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy
+
+import cache
+
+
+def test_second_lookup_is_a_hit(tmp_path):
+    entries = cache.Cache(str(tmp_path))
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return(numpy.arange(10.0))
+
+    key = cache.make_key('file', 'resample', 8192)
+    first = entries.get_or_compute(key, compute)
+    second = entries.get_or_compute(key, compute)
+    assert len(calls) == 1
+    numpy.testing.assert_array_equal(first, second)
+    assert entries.get(cache.make_key('file', 'resample', 4096)) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    array = numpy.zeros(1000)
+    entry_bytes = array.nbytes + 128
+    entries = cache.Cache(str(tmp_path), max_bytes=2 * entry_bytes + 64)
+    entries.put('old', array)
+    entries.put('used', array)
+    # Entries are `<key>.npy` files, aged by their modification time
+    os.utime(str(tmp_path / 'old.npy'), (1, 1))
+    os.utime(str(tmp_path / 'used.npy'), (2, 2))
+    # Reading refreshes `used`, so `old` is the one to go
+    assert entries.get('used') is not None
+    entries.put('new', array)
+    assert entries.get('old') is None
+    assert entries.get('used') is not None
+    assert entries.get('new') is not None
+    assert not [n for n in os.listdir(str(tmp_path)) if 'tmp' in n]
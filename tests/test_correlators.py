@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import pytest
+
+import accuracy
+import correlators
+import synthetic
+
+SAMPLE_RATE = 8192
+
+
+@pytest.mark.parametrize('weighting', ['phat', 'scot', 'ht'])
+def test_weightings_recover_the_delays_of_a_chirp(weighting):
+    # Band-limited: the empty bins must not take over the peak
+    data = synthetic.make_signal('chirp', 4 * SAMPLE_RATE, SAMPLE_RATE)
+    for delay in accuracy.DEFAULT_DELAYS:
+        one, two = synthetic.delayed_pair(data[:, 0], delay)
+        correlation = correlators.generalized_correlation(
+            one, two, weighting
+        )
+        index = int(numpy.argmax(abs(correlation)))
+        lag = (
+            index - (len(two) - 1) +
+            correlators.parabolic_peak_offset(correlation, index)
+        )
+        assert abs(lag - delay) < 1.0
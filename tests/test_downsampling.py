@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import pytest
+import scipy.signal
+
+import downsampling
+
+
+@pytest.mark.parametrize('sample_rate, new_sample_rate', [
+    (44100, 8192), (48000, 16000), (8000, 11025)
+])
+@pytest.mark.parametrize('block_size', [1000, 65536])
+def test_polyphase_matches_resample_poly(sample_rate, new_sample_rate,
+                                         block_size):
+    data = numpy.random.RandomState(0).randn(20000, 2)
+    resampled = downsampling.resample(
+        data, sample_rate, new_sample_rate, engine='polyphase',
+        block_size=block_size
+    )
+    expected = scipy.signal.resample_poly(
+        data, new_sample_rate, sample_rate, axis=0,
+        window=downsampling.DEFAULT_FILTER_WINDOW
+    )
+    assert resampled.shape == expected.shape
+    numpy.testing.assert_allclose(resampled, expected, atol=1e-10)
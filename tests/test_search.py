@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+
+import audio_io
+import search
+
+SAMPLE_RATE = 8000
+
+
+def test_finds_the_injected_clips():
+    generator = numpy.random.RandomState(0)
+    clip = generator.randn(400)
+    recording = 0.1 * generator.randn(60000)
+    positions = [1234, 20000, 51111]
+    for position, gain in zip(positions, [1.0, -0.5, 2.0]):
+        recording[position:position + len(clip)] += gain * clip
+    matches = search.search(
+        audio_io.ArrayReader(recording, SAMPLE_RATE), clip, top=3,
+        block_size=2048
+    )
+    assert sorted(match.samples for match in matches) == positions
+    assert all(abs(match.score) > 0.9 for match in matches)
+    inverted = [m for m in matches if m.samples == 20000][0]
+    assert inverted.score < 0